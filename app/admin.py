@@ -2,24 +2,32 @@ from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
-from datetime import datetime
 
+from . import order_machine
 from .config import CURRENCY, ADMIN_IDS
-from .db import db_execute
+from .db import ORDER_STATUS_LABELS, db_execute
+from .repository import repo
 from .states import AdminStates
 from .keyboards import kb_admin_actions
+from .outbox import Priority, outbox
 from .utils import is_admin
 
 router = Router()
 
+# دکمه‌های ادمین ربات -> وضعیت‌های ماشین وضعیت سفارش (app/order_machine.py)
+_ACTION_STATUSES = {"approve": "IN_PROGRESS", "reject": "REJECTED", "delivered": "DELIVERED"}
+
 @router.message(Command("admin"))
 async def on_admin_cmd(m: Message):
     if not is_admin(m.from_user.id, ADMIN_IDS):
         await m.answer("دسترسی ادمین ندارید.")
         return
-    pending = db_execute(
-        "SELECT COUNT(*) AS c FROM orders WHERE status='در انتظار تایید پرداخت'",
-        fetchone=True,
+    pending = (
+        await repo.read(
+            db_execute,
+            "SELECT COUNT(*) AS c FROM orders WHERE status='PENDING_CONFIRM'",
+            fetchone=True,
+        )
     )["c"]
     text = (
         "👮‍♂️ پنل ادمین (ساده)\n"
@@ -36,8 +44,9 @@ async def on_admin_pending(m: Message):
     if not is_admin(m.from_user.id, ADMIN_IDS):
         await m.answer("دسترسی ادمین ندارید.")
         return
-    rows = db_execute(
-        "SELECT id, plan_title, price, status, created_at FROM orders WHERE status='در انتظار تایید پرداخت' ORDER BY id DESC LIMIT 10",
+    rows = await repo.read(
+        db_execute,
+        "SELECT id, plan_title, price, status, created_at FROM orders WHERE status='PENDING_CONFIRM' ORDER BY id DESC LIMIT 10",
         fetchall=True,
     )
     if not rows:
@@ -47,7 +56,8 @@ async def on_admin_pending(m: Message):
     for r in rows:
         created = r["created_at"].replace("T", " ")
         lines.append(
-            f"– #{r['id']} | {r['plan_title']} | {r['price']} {CURRENCY}\n  وضعیت: <b>{r['status']}</b> | {created}"
+            f"– #{r['id']} | {r['plan_title']} | {r['price']} {CURRENCY}\n"
+            f"  وضعیت: <b>{ORDER_STATUS_LABELS.get(r['status'], r['status'])}</b> | {created}"
         )
     await m.answer("🟡 سفارش‌های منتظر تایید:\n\n" + "\n".join(lines))
 
@@ -61,7 +71,7 @@ async def on_admin_search(m: Message):
         await m.answer("استفاده درست: /search 123")
         return
     oid = int(parts[1])
-    row = db_execute("SELECT * FROM orders WHERE id=?", (oid,), fetchone=True)
+    row = await repo.get_order(oid)
     if not row:
         await m.answer("سفارش یافت نشد.")
         return
@@ -69,7 +79,7 @@ async def on_admin_search(m: Message):
         f"سفارش #{row['id']}\n"
         f"مشتری: <code>{row['user_id']}</code> @{row['username'] or '—'}\n"
         f"پلن: {row['plan_title']} | مبلغ: {row['price']} {CURRENCY}\n"
-        f"وضعیت: {row['status']}\n"
+        f"وضعیت: {ORDER_STATUS_LABELS.get(row['status'], row['status'])}\n"
         f"ایجاد: {row['created_at'].replace('T',' ')}\n"
     )
     await m.answer(text, reply_markup=kb_admin_actions(row["id"]))
@@ -82,7 +92,7 @@ async def on_admin_action(c: CallbackQuery, state: FSMContext):
 
     _, action, oid_str = c.data.split(":")
     order_id = int(oid_str)
-    row = db_execute("SELECT * FROM orders WHERE id=?", (order_id,), fetchone=True)
+    row = await repo.get_order(order_id, fresh=True)
     if not row:
         await c.answer("سفارش یافت نشد.", show_alert=True)
         return
@@ -94,28 +104,26 @@ async def on_admin_action(c: CallbackQuery, state: FSMContext):
         await c.answer()
         return
 
-    new_status = None
-    if action == "approve":
-        new_status = "پرداخت تایید شد"
-    elif action == "reject":
-        new_status = "رد شد (نیاز به پیگیری)"
-    elif action == "delivered":
-        new_status = "تحویل شد"
-
-    if new_status:
-        db_execute(
-            "UPDATE orders SET status=?, updated_at=? WHERE id=?",
-            (new_status, datetime.now().isoformat(timespec="seconds"), order_id),
-        )
-        await c.answer("وضعیت به‌روزرسانی شد.")
-        try:
-            await c.bot.send_message(
-                row["user_id"],
-                f"وضعیت سفارش #{order_id} به «<b>{new_status}</b>» تغییر کرد.",
-            )
-        except Exception:
-            pass
-        await c.message.edit_reply_markup(reply_markup=kb_admin_actions(order_id))
+    new_status = _ACTION_STATUSES.get(action)
+    if new_status is None:
+        await c.answer()
+        return
+    current = row["status"] or ""
+    if not order_machine.can_transition(current, new_status, admin=True):
+        await c.answer("این تغییر وضعیت برای سفارش مجاز نیست.", show_alert=True)
+        return
+    # تسویه و برگشت کیف پول در قلاب‌های ماشین وضعیت و در همان تراکنش انجام می‌شود
+    moved = await repo.transition_order(order_id, new_status, expected=current, admin=True)
+    if moved is None:
+        await c.answer("وضعیت سفارش هم‌زمان تغییر کرده است؛ دوباره سفارش را باز کنید.", show_alert=True)
+        return
+    await c.answer("وضعیت به‌روزرسانی شد.")
+    label = ORDER_STATUS_LABELS.get(new_status, new_status)
+    text = f"وضعیت سفارش #{order_id} به «<b>{label}</b>» تغییر کرد."
+    if moved.refunded:
+        text += f"\nمبلغ {moved.refunded} {CURRENCY} به کیف پول شما برگشت."
+    outbox.send_message(c.bot, row["user_id"], text, priority=Priority.HIGH)
+    await c.message.edit_reply_markup(reply_markup=kb_admin_actions(order_id))
 
 @router.message(AdminStates.waiting_message)
 async def on_admin_send_message(m: Message, state: FSMContext):
@@ -129,12 +137,14 @@ async def on_admin_send_message(m: Message, state: FSMContext):
         await m.answer("جلسه پیام ادمین یافت نشد.")
         await state.clear()
         return
-    try:
-        await m.bot.send_message(
-            customer_id,
-            f"📬 پیام از پشتیبانی درباره سفارش #{order_id}:\n\n{m.text}",
-        )
+    # ادمین نتیجهٔ واقعی تحویل را می‌بیند، حتی اگر پیام به‌خاطر سهمیهٔ تلگرام کمی در صف بماند
+    sent = await outbox.send_message(
+        m.bot,
+        customer_id,
+        f"📬 پیام از پشتیبانی درباره سفارش #{order_id}:\n\n{m.text}",
+    )
+    if sent is not None:
         await m.answer("پیام برای مشتری ارسال شد.")
-    except Exception:
+    else:
         await m.answer("ارسال پیام ناموفق بود.")
     await state.clear()
@@ -0,0 +1,225 @@
+"""Cold-order archive in an attached database.
+
+Every pooled connection attaches ``ARCHIVE_DB_PATH`` as schema ``archive``
+(see :mod:`app.db_pool`) when it is set; archiving is off by default.
+:func:`candidates` picks finished orders that have not changed for a while:
+``EXPIRED`` / ``CANCELED`` / ``REJECTED`` for ``ARCHIVE_TERMINAL_DAYS`` and
+``COMPLETED`` for ``ARCHIVE_COMPLETED_DAYS``, counted from ``updated_at``
+so an order the admin just closed (or may still reopen) stays hot.  They
+move with their ``order_manager_messages`` and ``wallet_tx`` rows into
+``archive.*`` copies of those tables.  The hot ``orders`` table then only
+holds recent and open work, so the admin scans stay small.
+
+With WAL a commit over two databases is atomic per file, not across them,
+so a batch moves in two transactions: :func:`copy` writes the archive and
+commits, then :func:`prune` deletes the hot rows whose archive copy is
+still identical.  A crash in between only leaves the batch in both
+databases; the next run copies it again (``INSERT OR REPLACE``) and
+finishes the delete.  Orders that changed in between stay hot and their
+archive copy is dropped.
+
+The copy keeps ids, so an archived order is found by the same id.  Readers
+that must see archived rows (``get_order``, a user's history and wallet)
+query through :func:`source`, which adds the archived rows that have no
+hot copy.
+
+Archiving is not deleting: while the move runs, a row in ``archive_guard``
+tells the dashboard counter triggers to leave totals alone.  The guard is
+inserted and removed in the same transaction, so no other connection ever
+sees it.  The search index does drop archived orders.  Functions here take
+a raw connection and must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+import json
+from datetime import datetime, timedelta
+from typing import Any
+
+SCHEMA = "archive"
+TABLES = ("orders", "order_manager_messages", "wallet_tx")
+TERMINAL_STATUSES = ("EXPIRED", "CANCELED", "REJECTED")
+
+# شناسه‌ها به صورت یک آرایهٔ JSON به کوئری داده می‌شوند
+_IDS = "SELECT value FROM json_each(?)"
+
+# table -> ستون‌های جدول اصلی به همان ترتیب؛ فقط بعد از install() پر است
+_columns: dict[str, tuple[str, ...]] = {}
+
+_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_user ON orders(user_id, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_created ON orders(created_at, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_manager_messages_order ON order_manager_messages(order_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_wallet_tx_order ON wallet_tx(order_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_wallet_tx_user ON wallet_tx(user_id, created_at)",
+)
+
+
+def attached(con) -> bool:
+    return any(row[1] == SCHEMA for row in con.execute("PRAGMA database_list"))
+
+
+def _table_info(con, schema: str, table: str) -> list[tuple[str, str]]:
+    return [(row[1], row[2] or "") for row in con.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def install(con) -> bool:
+    """Create the archive tables (or add columns the hot tables gained since); ``False`` if not attached."""
+
+    if not attached(con):
+        _columns.clear()
+        return False
+    for table in TABLES:
+        main_cols = _table_info(con, "main", table)
+        existing = {name for name, _ in _table_info(con, SCHEMA, table)}
+        if not existing:
+            defs = [f'"{name}" {kind}'.strip() + (" PRIMARY KEY" if name == "id" else "") for name, kind in main_cols]
+            if table == "orders":
+                defs.append("archived_at TEXT")
+            con.execute(f"CREATE TABLE IF NOT EXISTS {SCHEMA}.{table}({', '.join(defs)})")
+        else:
+            for name, kind in main_cols:
+                if name not in existing:
+                    con.execute(f'ALTER TABLE {SCHEMA}.{table} ADD COLUMN "{name}" {kind}')
+        _columns[table] = tuple(name for name, _ in main_cols)
+    for sql in _INDEXES:
+        con.execute(sql)
+    return True
+
+
+def source(table: str) -> str:
+    """FROM-clause for ``table`` including archived rows (just ``table`` when there is no archive)."""
+
+    cols = _columns.get(table)
+    if not cols:
+        return table
+    col_sql = ", ".join(f'"{c}"' for c in cols)
+    # ردیفی که میان copy و prune در هر دو دیتابیس است فقط یک بار دیده می‌شود
+    return (
+        f"(SELECT {col_sql} FROM main.{table} UNION ALL SELECT {col_sql} FROM {SCHEMA}.{table} AS a "
+        f"WHERE NOT EXISTS (SELECT 1 FROM main.{table} AS m WHERE m.id = a.id)) AS {table}"
+    )
+
+
+def enabled() -> bool:
+    return bool(_columns)
+
+
+def get(con, table: str, key: str, value: Any) -> dict[str, Any] | None:
+    if table not in _columns:
+        return None
+    row = con.execute(f"SELECT * FROM {SCHEMA}.{table} WHERE {key}=?", (value,)).fetchone()
+    return dict(row) if row else None
+
+
+def candidates(con, *, now: datetime, terminal_days: int, completed_days: int, limit: int) -> list[int]:
+    terminal_before = (now - timedelta(days=terminal_days)).isoformat(timespec="seconds")
+    completed_before = (now - timedelta(days=completed_days)).isoformat(timespec="seconds")
+    statuses = ",".join("?" * len(TERMINAL_STATUSES))
+    # سن از آخرین تغییر سفارش حساب می‌شود (idx_orders_status_updated)؛ created_at فقط ترتیب است
+    rows = con.execute(
+        f"""
+        SELECT id FROM (
+            SELECT id, created_at FROM orders
+            WHERE status IN ({statuses}) AND updated_at < ? AND IFNULL(wallet_reserved_amount, 0) = 0
+            UNION ALL
+            SELECT id, created_at FROM orders
+            WHERE status='COMPLETED' AND updated_at < ? AND IFNULL(wallet_reserved_amount, 0) = 0
+        )
+        ORDER BY created_at, id
+        LIMIT ?
+        """,
+        (*TERMINAL_STATUSES, terminal_before, completed_before, int(limit)),
+    ).fetchall()
+    return [int(row[0]) for row in rows]
+
+
+def copy(con, order_ids: list[int], *, now: datetime) -> None:
+    """Copy ``order_ids`` and their linked rows into the archive; commit this before :func:`prune`."""
+
+    if not order_ids or not _columns:
+        return
+    ids = json.dumps(order_ids)
+    archived_at = now.isoformat(timespec="seconds")
+    for table in TABLES:
+        key = "id" if table == "orders" else "order_id"
+        cols = ", ".join(f'"{c}"' for c in _columns[table])
+        extra_col, extra_val, params = ("", "", [ids])
+        if table == "orders":
+            extra_col, extra_val, params = (", archived_at", ", ?", [archived_at, ids])
+        con.execute(
+            f"""
+            INSERT OR REPLACE INTO {SCHEMA}.{table}({cols}{extra_col})
+            SELECT {cols}{extra_val} FROM main.{table} WHERE {key} IN ({_IDS})
+            """,
+            params,
+        )
+
+
+def prune(con, order_ids: list[int]) -> int:
+    """Delete the hot rows of ``order_ids`` whose archive copy is identical (inside a write transaction).
+
+    Orders that changed since :func:`copy` stay hot and lose their archive
+    copy.  Linked rows are only deleted if they were copied.  Returns the
+    number of orders deleted.
+    """
+
+    if not order_ids or not _columns:
+        return 0
+    same = " AND ".join(f'm."{c}" IS a."{c}"' for c in _columns["orders"])
+    rows = con.execute(
+        f"""
+        SELECT m.id, a.id IS NOT NULL AND {same}
+        FROM main.orders AS m LEFT JOIN {SCHEMA}.orders AS a ON a.id = m.id
+        WHERE m.id IN ({_IDS})
+        """,
+        (json.dumps(order_ids),),
+    ).fetchall()
+    current = [int(row[0]) for row in rows if row[1]]
+    stale = [int(row[0]) for row in rows if not row[1]]
+    if stale:
+        stale_ids = json.dumps(stale)
+        for table in TABLES:
+            key = "id" if table == "orders" else "order_id"
+            con.execute(f"DELETE FROM {SCHEMA}.{table} WHERE {key} IN ({_IDS})", (stale_ids,))
+    if not current:
+        return 0
+    ids = json.dumps(current)
+    con.execute("INSERT INTO archive_guard(active) VALUES(1)")
+    for table in ("wallet_tx", "order_manager_messages"):
+        con.execute(
+            f"""
+            DELETE FROM main.{table} WHERE order_id IN ({_IDS})
+            AND id IN (SELECT id FROM {SCHEMA}.{table} WHERE order_id IN ({_IDS}))
+            """,
+            (ids, ids),
+        )
+    moved = con.execute(f"DELETE FROM main.orders WHERE id IN ({_IDS})", (ids,)).rowcount
+    con.execute("DELETE FROM archive_guard")
+    return moved
+
+
+def stats(con) -> dict[str, Any]:
+    if not _columns:
+        return {"enabled": False}
+    result: dict[str, Any] = {"enabled": True}
+    for table in TABLES:
+        result[table] = int(con.execute(f"SELECT COUNT(*) FROM {SCHEMA}.{table}").fetchone()[0])
+    row = con.execute(f"SELECT MIN(archived_at), MAX(archived_at) FROM {SCHEMA}.orders").fetchone()
+    result["first_archived_at"], result["last_archived_at"] = row[0], row[1]
+    return result
+
+
+__all__ = [
+    "SCHEMA",
+    "TABLES",
+    "TERMINAL_STATUSES",
+    "attached",
+    "candidates",
+    "copy",
+    "enabled",
+    "get",
+    "install",
+    "prune",
+    "source",
+    "stats",
+]
@@ -0,0 +1,230 @@
+"""In-process LRU + TTL cache for hot row lookups.
+
+Entries carry tags such as ``user:42``, ``order:1001`` or ``catalog``.
+Each tag hashes into a fixed table of version counters, so memory stays
+flat however many users and orders a long-running process touches.  Tags
+that share a slot only cause extra misses.  :func:`invalidate` only bumps
+counters, and an entry whose tags have moved on since it was loaded
+counts as a miss.  Counters only ever grow, so an old snapshot can never
+match again.  Because the versions are read before the row is loaded, a load
+that races with a write can never cache the old row under the new
+version.
+
+Invalidation that happens inside an open ``transaction()`` is repeated
+right after the commit.  Other threads may load the pre-commit row
+meanwhile, and the repeat makes that row stale.
+
+Reads inside a transaction bypass the cache, so read-check-write logic
+always sees the locked row.  Invalidation does not reach other processes:
+the TTL bounds how stale an entry gets when the web admin and the bot
+change each other's rows.  Reads that must not be stale skip the cache
+(``is_user_blocked``, and ``get_order`` / ``get_user`` with ``fresh=True``
+in the web admin).
+"""
+from __future__ import annotations
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable
+
+from . import db_pool
+from .config import CACHE_ENABLED, CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS
+
+_MISSING = object()
+# تعداد خانه‌های جدول نسخه (توان ۲)؛ برخورد دو تگ فقط یک miss اضافه است
+_VERSION_SLOTS = 1 << 14
+
+
+class TaggedCache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS) -> None:
+        self.max_entries = max(int(max_entries), 1)
+        self.ttl = float(ttl)
+        self._entries: OrderedDict[Any, tuple[float, tuple[tuple[int, int], ...], Any]] = OrderedDict()
+        self._versions = [0] * _VERSION_SLOTS
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _slot(tag: str) -> int:
+        return hash(tag) & (_VERSION_SLOTS - 1)
+
+    def _snapshot(self, tags: Iterable[str]) -> tuple[tuple[int, int], ...]:
+        versions = self._versions
+        return tuple((slot, versions[slot]) for slot in {self._slot(tag) for tag in tags})
+
+    def get(self, key: Any) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+            expires, snapshot, value = entry
+            versions = self._versions
+            if expires < now or any(versions[slot] != ver for slot, ver in snapshot):
+                del self._entries[key]
+                self.stale += 1
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_or_load(self, key: Any, loader: Callable[[], Any], tags: Iterable[str], ttl: float | None = None) -> Any:
+        value = self.get(key)
+        if value is not _MISSING:
+            return _copy(value)
+        tags = tuple(tags)
+        with self._lock:
+            snapshot = self._snapshot(tags)
+        value = loader()
+        # ردیف ناموجود کش نمی‌شود تا INSERT بعدی نیازی به ابطال نداشته باشد
+        if value is not None:
+            self._store(key, value, snapshot, ttl)
+        return _copy(value)
+
+    def _store(self, key: Any, value: Any, snapshot: tuple[tuple[int, int], ...], ttl: float | None) -> None:
+        expires = time.monotonic() + (self.ttl if ttl is None else float(ttl))
+        with self._lock:
+            self._entries[key] = (expires, snapshot, _copy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *tags: str) -> None:
+        with self._lock:
+            for tag in tags:
+                self._versions[self._slot(tag)] += 1
+            self.invalidations += len(tags)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._versions = [version + 1 for version in self._versions]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits * 100 / lookups, 1) if lookups else 0.0,
+            }
+
+
+def _copy(value: Any) -> Any:
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(item) if isinstance(item, dict) else item for item in value]
+    return value
+
+
+cache = TaggedCache()
+
+
+def cached(key: Any, loader: Callable[[], Any], tags: Iterable[str], ttl: float | None = None) -> Any:
+    # داخل تراکنش همیشه از خود دیتابیس می‌خوانیم تا تصمیم‌های مالی روی دادهٔ قفل‌شده باشند؛
+    # ردیف کپی فقط‌خواندنی (snapshot) کهنه‌تر از کش است و در آن نمی‌نشیند
+    if not CACHE_ENABLED or db_pool.in_transaction() or db_pool.reading_snapshot():
+        return loader()
+    return cache.get_or_load(key, loader, tags, ttl)
+
+
+def invalidate(*tags: str) -> None:
+    if not CACHE_ENABLED or not tags:
+        return
+    cache.invalidate(*tags)
+    if db_pool.in_transaction():
+        db_pool.after_commit(lambda: cache.invalidate(*tags))
+
+
+# --- ابطال خودکار بر اساس دستور SQL -------------------------------------------
+
+_WRITE_RE = re.compile(
+    r"^\s*(?:UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM|INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO)\s+(\w+)",
+    re.IGNORECASE,
+)
+_WHERE_KEY_RE = re.compile(r"\bWHERE\s+(\w+)\s*=\s*\?\s*;?\s*$", re.IGNORECASE)
+
+# table -> (row tag prefix, key column, table-wide tag)
+_TABLE_TAGS = {
+    "users": ("user", "user_id", "users"),
+    "orders": ("order", "id", "orders"),
+    "products": (None, None, "catalog"),
+}
+
+
+def tags_for_statement(sql: str, params: Any = ()) -> tuple[str, ...]:
+    """Tags a write statement touches, derived from its target table and ``WHERE key=?``."""
+
+    match = _WRITE_RE.match(sql)
+    if not match:
+        return ()
+    table = match.group(1).lower()
+    spec = _TABLE_TAGS.get(table)
+    if spec is None:
+        return ()
+    prefix, key_column, table_tag = spec
+    if prefix is None:
+        return (table_tag,)
+    head = sql.lstrip()[:7].upper()
+    if head.startswith("INSERT") and not re.search(r"\bON\s+CONFLICT\b|\bOR\s+REPLACE\b", sql, re.IGNORECASE):
+        # ردیف جدید چیزی از کش را کهنه نمی‌کند (نتیجهٔ خالی کش نمی‌شود)
+        return ()
+    where = _WHERE_KEY_RE.search(sql)
+    if where and where.group(1).lower() == key_column and params:
+        return (f"{prefix}:{params[-1]}",)
+    return (table_tag,)
+
+
+def invalidate_statement(sql: str, params: Any = ()) -> None:
+    if CACHE_ENABLED:
+        tags = tags_for_statement(sql, params)
+        if tags:
+            invalidate(*tags)
+
+
+def user_tags(user_id: Any) -> tuple[str, str]:
+    return (f"user:{user_id}", "users")
+
+
+def order_tags(order_id: Any) -> tuple[str, str]:
+    return (f"order:{order_id}", "orders")
+
+
+CATALOG_TAGS = ("catalog",)
+
+
+def stats() -> dict[str, Any]:
+    if not CACHE_ENABLED:
+        return {"enabled": False}
+    return cache.stats()
+
+
+__all__ = [
+    "CATALOG_TAGS",
+    "TaggedCache",
+    "cache",
+    "cached",
+    "invalidate",
+    "invalidate_statement",
+    "order_tags",
+    "stats",
+    "tags_for_statement",
+    "user_tags",
+]
@@ -1,5 +1,5 @@
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from .db import get_order
+from .repository import repo
 from .config import CURRENCY
 
 def _status_fa(code: str) -> str:
@@ -47,7 +47,7 @@ def _kb_checkout(oid: int, *, enable_plan: bool = False) -> InlineKeyboardMarkup
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 async def send_checkout_prompt(msg: Message, order_id: int):
-    o = get_order(order_id)
+    o = await repo.get_order(order_id)
     if not o:
         await msg.answer("سفارش پیدا نشد.")
         return
@@ -1,4 +1,4 @@
-import os
+import hashlib
 import os
 
 from dotenv import load_dotenv
@@ -20,8 +20,106 @@ SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "")
 SLA_HOURS_MIN = int(os.getenv("SLA_HOURS_MIN", "1"))
 SLA_HOURS_MAX = int(os.getenv("SLA_HOURS_MAX", "4"))
 PAYMENT_TIMEOUT_MIN = int(os.getenv("PAYMENT_TIMEOUT_MIN", "15"))
+# بازخوانی دوره‌ای مهلت‌ها از دیتابیس برای تغییراتی که از پروسهٔ دیگر (پنل وب) آمده‌اند؛ 0 = خاموش
+EXPIRY_RESYNC_SECONDS = float(os.getenv("EXPIRY_RESYNC_SECONDS", "600"))
 ORDER_ID_MIN_VALUE = int(os.getenv("ORDER_ID_MIN_VALUE", "0"))
 
+# --- SQLite tuning ---
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+DB_QUEUE_LIMIT = int(os.getenv("DB_QUEUE_LIMIT", "256"))
+DB_WRITE_COALESCE = os.getenv("DB_WRITE_COALESCE", "0").strip().lower() in {"1", "true", "yes", "on"}
+DB_COALESCE_WINDOW_MS = float(os.getenv("DB_COALESCE_WINDOW_MS", "2"))
+DB_COALESCE_MAX_BATCH = int(os.getenv("DB_COALESCE_MAX_BATCH", "200"))
+
+# --- Archive: سفارش‌های تمام‌شده به دیتابیس جدا منتقل می‌شوند ---
+# مسیر فایل دیتابیس بایگانی؛ خالی (پیش‌فرض) = بدون بایگانی. فایل جدا را به پشتیبان‌گیری اضافه کنید
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "")
+# EXPIRED / CANCELED / REJECTED بعد از این چند روز، COMPLETED بعد از این چند روز
+ARCHIVE_TERMINAL_DAYS = int(os.getenv("ARCHIVE_TERMINAL_DAYS", "7"))
+ARCHIVE_COMPLETED_DAYS = int(os.getenv("ARCHIVE_COMPLETED_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# 0 = فقط دستی (python -m app.maintenance archive run)
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+# --- Snapshot: کپی فقط‌خواندنی برای صفحه‌های گزارش پنل وب (app/snapshot.py) ---
+# خالی = همهٔ صفحه‌ها مستقیم از دیتابیس اصلی می‌خوانند
+DB_SNAPSHOT_PATH = os.getenv("DB_SNAPSHOT_PATH", "")
+# کپی کهنه‌تر از این (ثانیه) پیش از خواندن تازه می‌شود
+DB_SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("DB_SNAPSHOT_MAX_AGE_SECONDS", "60"))
+
+# --- FSM: وضعیت گفتگوی کاربران در همان دیتابیس (app/fsm_storage.py) ---
+# memory = مثل قبل فقط در حافظه (با ری‌استارت پاک می‌شود)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip().lower()
+# تغییرها با این تأخیر دسته‌ای نوشته می‌شوند؛ 0 = بلافاصله
+FSM_FLUSH_SECONDS = float(os.getenv("FSM_FLUSH_SECONDS", "1"))
+# وضعیت بدون تغییر پس از این مدت رهاشده حساب و پاک می‌شود
+FSM_STATE_TTL_SECONDS = float(os.getenv("FSM_STATE_TTL_SECONDS", str(24 * 3600)))
+# ورودی حافظه تا این مدت بدون خواندن دوباره از دیتابیس معتبر است؛ با چند پروسه 0 بگذارید
+FSM_CACHE_SECONDS = float(os.getenv("FSM_CACHE_SECONDS", "300"))
+
+# --- دریافت آپدیت‌ها: polling (پیش‌فرض) یا webhook (app/webhook.py) ---
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# آدرس Bot API؛ برای سرور محلی Bot API یا سرور جعلی تست عوض می‌شود
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+# آدرس عمومی HTTPS که تلگرام آپدیت‌ها را به آن می‌فرستد (بدون مسیر)؛ خالی = setWebhook صدا زده نمی‌شود
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# مقدار هدر X-Telegram-Bot-Api-Secret-Token؛ پیش‌فرض از توکن ربات ساخته می‌شود
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_BIND = os.getenv("WEBHOOK_BIND", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+# 1 = وب‌هوک روی همان اپ پنل وب (ADMIN_WEB_BIND / ADMIN_WEB_PORT) سوار می‌شود و یک پروسه هر دو را اجرا می‌کند
+WEBHOOK_WITH_ADMIN = os.getenv("WEBHOOK_WITH_ADMIN", "0").strip().lower() in {"1", "true", "yes", "on"}
+# بیش از این آپدیت در حال پردازش، درخواست با 503 رد می‌شود تا تلگرام بعداً دوباره بفرستد
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1000"))
+# حداکثر اتصال هم‌زمان تلگرام به وب‌هوک (پارامتر max_connections در setWebhook)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# --- پردازش آپدیت‌ها (app/dispatch.py) ---
+# آپدیت‌های هر کاربر به ترتیب و کاربران مختلف موازی روی این تعداد صف اجرا می‌شوند؛ 0 = رفتار پیش‌فرض aiogram
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "16"))
+# سقف آپدیت‌های در صف یا در حال اجرا (همهٔ صف‌ها)؛ با رسیدن به آن polling صبر می‌کند و وب‌هوک 503 می‌دهد
+DISPATCH_MAX_PENDING = int(os.getenv("DISPATCH_MAX_PENDING", "1000"))
+
+# --- صف ارسال پیام‌ها (app/outbox.py) ---
+# سقف تلگرام حدود ۳۰ پیام در ثانیه برای کل ربات و ۱ پیام در ثانیه برای هر چت (۲۰ در دقیقه در گروه) است
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+# چند پیام پشت سر هم به یک چت پیش از اعمال سهمیهٔ OUTBOX_CHAT_RATE
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_GROUP_RATE = float(os.getenv("OUTBOX_GROUP_RATE", str(20 / 60)))
+# حداکثر درخواست هم‌زمان به Bot API
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+# تعداد تلاش برای خطای شبکه، خطای سرور تلگرام یا 429
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+# با این تعداد پیام در صف، پیام‌های کم‌اولویت (انبوه) پذیرفته نمی‌شوند
+OUTBOX_QUEUE_LIMIT = int(os.getenv("OUTBOX_QUEUE_LIMIT", "10000"))
+
+# --- Durable notifications (پنل وب می‌نویسد، پروسهٔ ربات ارسال می‌کند) ---
+# فاصلهٔ بررسی جدول outbox وقتی پیام آماده‌ای نیست
+NOTIFY_POLL_SECONDS = float(os.getenv("NOTIFY_POLL_SECONDS", "1"))
+# حداکثر پیام در حال ارسال از جدول به صورت هم‌زمان
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "100"))
+# پیامی که این مدت در حالت SENDING بماند (پروسه از کار افتاده) دوباره برداشته می‌شود
+NOTIFY_LEASE_SECONDS = float(os.getenv("NOTIFY_LEASE_SECONDS", "300"))
+# تعداد تلاش پیش از ثبت وضعیت FAILED؛ فاصلهٔ تلاش‌ها از NOTIFY_RETRY_SECONDS دو برابر می‌شود
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "8"))
+NOTIFY_RETRY_SECONDS = float(os.getenv("NOTIFY_RETRY_SECONDS", "30"))
+# پیام‌های ارسال‌شده یا ناموفق پس از این تعداد روز پاک می‌شوند
+NOTIFY_RETENTION_DAYS = int(os.getenv("NOTIFY_RETENTION_DAYS", "30"))
+
+# --- Read cache ---
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1").strip().lower() in {"1", "true", "yes", "on"}
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "4096"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+# کاربری که در این بازه با همان یوزرنیم و نام دیده شده، دوباره در دیتابیس ثبت نمی‌شود
+USER_SEEN_TTL_SECONDS = float(os.getenv("USER_SEEN_TTL_SECONDS", "600"))
+
 REQUIRED_CHANNEL_ID = os.getenv("REQUIRED_CHANNEL_ID", "").strip()
 REQUIRED_CHANNEL_LINK = os.getenv("REQUIRED_CHANNEL_LINK", "").strip()
 FORCE_JOIN_MESSAGE = os.getenv(
@@ -0,0 +1,260 @@
+"""Materialised counters for the dashboard and wallet report.
+
+``stats_counters`` holds named running totals (orders per status, users,
+wallet sums per type, ...) and ``order_daily`` holds per-day order counts and
+amounts.  SQLite triggers on ``orders``, ``users``, ``wallet_tx`` and
+``service_messages`` keep both current, so the admin pages read a handful
+of rows instead of aggregating whole tables.  Totals are all-time: moving
+orders to the archive does not lower them (see :mod:`app.archive`).  The
+move bumps matching ``archived:`` counters instead, and :func:`hot_value`
+subtracts them for lists that only read the hot ``orders`` table.
+
+:func:`rebuild` recomputes everything from the raw tables and
+:func:`check` reports counters that drifted; both are exposed through
+``python -m app.maintenance counters``.  Functions here take a raw
+connection and must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from . import archive
+
+REVENUE_STATUSES = ("APPROVED", "IN_PROGRESS", "READY_TO_DELIVER", "DELIVERED", "COMPLETED")
+
+_REVENUE_SQL = "(" + ",".join(f"'{s}'" for s in REVENUE_STATUSES) + ")"
+
+# انتقال سفارش به بایگانی (app/archive.py) حذف واقعی نیست و شمارنده‌ها را کم نمی‌کند
+_NOT_ARCHIVING = "WHEN NOT EXISTS (SELECT 1 FROM archive_guard)"
+_ARCHIVING = "WHEN EXISTS (SELECT 1 FROM archive_guard)"
+ARCHIVED_PREFIX = "archived:"
+
+
+def _bump(name_sql: str, value_sql: str) -> str:
+    return (
+        f"INSERT INTO stats_counters(name, value) VALUES({name_sql}, {value_sql}) "
+        "ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;"
+    )
+
+
+def _daily(row: str, sign: str) -> str:
+    return (
+        "INSERT INTO order_daily(day, orders, amount_total) "
+        f"VALUES(substr(COALESCE({row}.created_at, ''), 1, 10), {sign}1, {sign}COALESCE({row}.amount_total, 0)) "
+        "ON CONFLICT(day) DO UPDATE SET orders=orders+excluded.orders, amount_total=amount_total+excluded.amount_total;"
+    )
+
+
+def _order_effects(row: str, sign: str) -> str:
+    status = f"'orders_status:' || COALESCE({row}.status, '')"
+    revenue = f"CASE WHEN {row}.status IN {_REVENUE_SQL} THEN {sign}COALESCE({row}.amount_total, 0) ELSE 0 END"
+    return "\n    ".join(
+        [
+            _bump("'orders_total'", f"{sign}1"),
+            _bump(status, f"{sign}1"),
+            _bump("'orders_revenue'", revenue),
+            _daily(row, sign),
+        ]
+    )
+
+
+def _user_effects(row: str, sign: str) -> str:
+    return "\n    ".join(
+        [
+            _bump("'users_total'", f"{sign}1"),
+            _bump("'user_balances'", f"{sign}COALESCE({row}.wallet_balance, 0)"),
+        ]
+    )
+
+
+def _wallet_effects(row: str, sign: str) -> str:
+    return _bump(f"'wallet:' || COALESCE({row}.type, '')", f"{sign}COALESCE({row}.amount, 0)")
+
+
+def _message_effects(sign: str) -> str:
+    return _bump("'service_messages_total'", f"{sign}1")
+
+
+def _triggers() -> dict[str, str]:
+    return {
+        "trg_counters_orders_ins": f"AFTER INSERT ON orders BEGIN\n    {_order_effects('NEW', '+')}\nEND",
+        "trg_counters_orders_del": (
+            f"AFTER DELETE ON orders {_NOT_ARCHIVING}\nBEGIN\n    {_order_effects('OLD', '-')}\nEND"
+        ),
+        "trg_counters_orders_archived": (
+            f"AFTER DELETE ON orders {_ARCHIVING}\nBEGIN\n    "
+            + _bump(f"'{ARCHIVED_PREFIX}orders_total'", "1")
+            + "\n    "
+            + _bump(f"'{ARCHIVED_PREFIX}orders_status:' || COALESCE(OLD.status, '')", "1")
+            + "\nEND"
+        ),
+        "trg_counters_orders_upd": (
+            "AFTER UPDATE OF status, amount_total, created_at ON orders\n"
+            "WHEN OLD.status IS NOT NEW.status OR OLD.amount_total IS NOT NEW.amount_total "
+            "OR OLD.created_at IS NOT NEW.created_at\n"
+            f"BEGIN\n    {_order_effects('OLD', '-')}\n    {_order_effects('NEW', '+')}\nEND"
+        ),
+        "trg_counters_users_ins": f"AFTER INSERT ON users BEGIN\n    {_user_effects('NEW', '+')}\nEND",
+        "trg_counters_users_del": f"AFTER DELETE ON users BEGIN\n    {_user_effects('OLD', '-')}\nEND",
+        "trg_counters_users_upd": (
+            "AFTER UPDATE OF wallet_balance ON users\n"
+            "WHEN OLD.wallet_balance IS NOT NEW.wallet_balance\n"
+            "BEGIN\n    "
+            + _bump("'user_balances'", "COALESCE(NEW.wallet_balance, 0) - COALESCE(OLD.wallet_balance, 0)")
+            + "\nEND"
+        ),
+        "trg_counters_wallet_ins": f"AFTER INSERT ON wallet_tx BEGIN\n    {_wallet_effects('NEW', '+')}\nEND",
+        "trg_counters_wallet_del": (
+            f"AFTER DELETE ON wallet_tx {_NOT_ARCHIVING}\nBEGIN\n    {_wallet_effects('OLD', '-')}\nEND"
+        ),
+        "trg_counters_wallet_upd": (
+            "AFTER UPDATE OF amount, type ON wallet_tx BEGIN\n"
+            f"    {_wallet_effects('OLD', '-')}\n    {_wallet_effects('NEW', '+')}\nEND"
+        ),
+        "trg_counters_messages_ins": f"AFTER INSERT ON service_messages BEGIN\n    {_message_effects('+')}\nEND",
+        "trg_counters_messages_del": f"AFTER DELETE ON service_messages BEGIN\n    {_message_effects('-')}\nEND",
+    }
+
+
+def install(con) -> None:
+    """Create (or re-create) the counter tables and their triggers."""
+
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters(
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        """
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS archive_guard(active INTEGER)")
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS order_daily(
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            amount_total INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        """
+    )
+    for name, body in _triggers().items():
+        con.execute(f"DROP TRIGGER IF EXISTS {name}")
+        con.execute(f"CREATE TRIGGER {name} {body}")
+
+
+def _expected(con) -> tuple[dict[str, int], dict[str, tuple[int, int]]]:
+    # سفارش‌ها و تراکنش‌های بایگانی‌شده هم در جمع‌ها حساب می‌شوند
+    orders, wallet_tx = archive.source("orders"), archive.source("wallet_tx")
+    counters: dict[str, int] = {}
+    row = con.execute(
+        f"""
+        SELECT COUNT(*),
+               COALESCE(SUM(CASE WHEN status IN {_REVENUE_SQL} THEN COALESCE(amount_total, 0) ELSE 0 END), 0)
+        FROM {orders}
+        """
+    ).fetchone()
+    counters["orders_total"] = int(row[0])
+    counters["orders_revenue"] = int(row[1])
+    for status, count in con.execute(f"SELECT COALESCE(status, ''), COUNT(*) FROM {orders} GROUP BY 1"):
+        counters[f"orders_status:{status}"] = int(count)
+    if orders != "orders":
+        # بایگانی‌شده = همه منهای جدول اصلی
+        hot = {"orders_total": int(con.execute("SELECT COUNT(*) FROM main.orders").fetchone()[0])}
+        for status, count in con.execute("SELECT COALESCE(status, ''), COUNT(*) FROM main.orders GROUP BY 1"):
+            hot[f"orders_status:{status}"] = int(count)
+        for name in [n for n in counters if n == "orders_total" or n.startswith("orders_status:")]:
+            archived = counters[name] - hot.get(name, 0)
+            if archived:
+                counters[ARCHIVED_PREFIX + name] = archived
+    row = con.execute("SELECT COUNT(*), COALESCE(SUM(COALESCE(wallet_balance, 0)), 0) FROM users").fetchone()
+    counters["users_total"] = int(row[0])
+    counters["user_balances"] = int(row[1])
+    for tx_type, total in con.execute(
+        f"SELECT COALESCE(type, ''), COALESCE(SUM(COALESCE(amount, 0)), 0) FROM {wallet_tx} GROUP BY 1"
+    ):
+        counters[f"wallet:{tx_type}"] = int(total)
+    counters["service_messages_total"] = int(con.execute("SELECT COUNT(*) FROM service_messages").fetchone()[0])
+    daily = {
+        day: (int(count), int(amount))
+        for day, count, amount in con.execute(
+            f"""
+            SELECT substr(COALESCE(created_at, ''), 1, 10), COUNT(*), COALESCE(SUM(COALESCE(amount_total, 0)), 0)
+            FROM {orders} GROUP BY 1
+            """
+        )
+    }
+    return counters, daily
+
+
+def rebuild(con) -> None:
+    """Recompute every counter from the raw tables (run inside a write transaction)."""
+
+    counters, daily = _expected(con)
+    con.execute("DELETE FROM stats_counters")
+    con.execute("DELETE FROM order_daily")
+    con.executemany("INSERT INTO stats_counters(name, value) VALUES(?, ?)", counters.items())
+    con.executemany(
+        "INSERT INTO order_daily(day, orders, amount_total) VALUES(?, ?, ?)",
+        ((day, orders, amount) for day, (orders, amount) in daily.items()),
+    )
+
+
+def check(con) -> list[dict[str, Any]]:
+    """Compare stored counters with fresh aggregates; returns the mismatches."""
+
+    counters, daily = _expected(con)
+    stored = {name: int(value) for name, value in con.execute("SELECT name, value FROM stats_counters")}
+    problems: list[dict[str, Any]] = []
+    for name in sorted(set(counters) | set(stored)):
+        expected, actual = counters.get(name, 0), stored.get(name, 0)
+        if expected != actual:
+            problems.append({"counter": name, "expected": expected, "actual": actual})
+    stored_daily = {
+        day: (int(orders), int(amount))
+        for day, orders, amount in con.execute("SELECT day, orders, amount_total FROM order_daily")
+    }
+    for day in sorted(set(daily) | set(stored_daily)):
+        expected, actual = daily.get(day, (0, 0)), stored_daily.get(day, (0, 0))
+        if expected != actual:
+            problems.append({"counter": f"order_daily:{day}", "expected": expected, "actual": actual})
+    return problems
+
+
+def read(con) -> dict[str, int]:
+    return {name: int(value) for name, value in con.execute("SELECT name, value FROM stats_counters")}
+
+
+def value(con, name: str) -> int:
+    row = con.execute("SELECT value FROM stats_counters WHERE name=?", (name,)).fetchone()
+    return int(row[0]) if row else 0
+
+
+def hot_value(con, name: str) -> int:
+    """``name`` without the rows that were moved to the archive."""
+
+    rows = con.execute(
+        "SELECT name, value FROM stats_counters WHERE name IN (?, ?)", (name, ARCHIVED_PREFIX + name)
+    ).fetchall()
+    values = {row[0]: int(row[1]) for row in rows}
+    return values.get(name, 0) - values.get(ARCHIVED_PREFIX + name, 0)
+
+
+def daily_totals(con, since_day: str) -> tuple[int, int]:
+    row = con.execute(
+        "SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(amount_total), 0) FROM order_daily WHERE day >= ?",
+        (since_day,),
+    ).fetchone()
+    return int(row[0]), int(row[1])
+
+
+__all__ = [
+    "ARCHIVED_PREFIX",
+    "REVENUE_STATUSES",
+    "check",
+    "daily_totals",
+    "hot_value",
+    "install",
+    "read",
+    "rebuild",
+    "value",
+]
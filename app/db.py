@@ -1,20 +1,26 @@
+import json
+import re
 import sqlite3
-from contextlib import closing
+import time
 from datetime import datetime, timedelta
-from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Callable, Iterable, Iterator
 import logging
 
-from .config import DB_PATH, ORDER_ID_MIN_VALUE, PAYMENT_TIMEOUT_MIN
+from .config import (
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_COMPLETED_DAYS,
+    ARCHIVE_TERMINAL_DAYS,
+    ORDER_ID_MIN_VALUE,
+    PAYMENT_TIMEOUT_MIN,
+    USER_SEEN_TTL_SECONDS,
+)
+from . import archive, cache, counters, ledger, migrations, order_machine, redemption, rows, write_coalescer
+from . import search as fts
+from .db_pool import after_commit, get_connection, in_transaction, transaction
+
+# فقط SELECT می‌تواند از کپی فقط‌خواندنی (app/snapshot.py) خوانده شود
+_QUERY_RE = re.compile(r"\s*SELECT\b", re.IGNORECASE)
 
-def _connect():
-    db_path = Path(DB_PATH)
-    parent = db_path.parent
-    if parent and str(parent) not in {"", "."}:
-        parent.mkdir(parents=True, exist_ok=True)
-    con = sqlite3.connect(str(db_path))
-    con.row_factory = sqlite3.Row
-    return con
 
 def db_execute(
     sql,
@@ -25,28 +31,59 @@ def db_execute(
     return_lastrowid=False,
     commit: bool | None = None,
 ):
-    with closing(_connect()) as con:
-        cur = con.cursor()
-        # خاموش کردن موقت چک کلید خارجی برای جلوگیری از کرش‌های ناخواسته در دیتابیس‌های قدیمی
-        try:
-            cur.execute("PRAGMA foreign_keys=OFF;")
-        except:
-            pass
-            
-        cur.execute(sql, params)
-        do_commit = True if commit is None else bool(commit)
-        if do_commit:
-            con.commit()
-        if return_lastrowid:
-            return cur.lastrowid
-        if fetchone:
-            r = cur.fetchone()
-            return dict(r) if r else None
-        if fetchall:
-            return [dict(x) for x in cur.fetchall()]
+    con = get_connection(primary=not _QUERY_RE.match(sql))
+    try:
+        cur = con.execute(sql, params)
+    except Exception:
+        # تراکنش ضمنی نیمه‌کاره نباید روی اتصال مشترک باز بماند
+        if not in_transaction() and con.in_transaction:
+            con.rollback()
+        raise
+    do_commit = True if commit is None else bool(commit)
+    if do_commit and not in_transaction():
+        con.commit()
+    cache.invalidate_statement(sql, params)
+    if return_lastrowid:
+        return cur.lastrowid
+    if fetchone:
+        r = cur.fetchone()
+        return dict(r) if r else None
+    if fetchall:
+        return [dict(x) for x in cur.fetchall()]
     return None
 
 
+def db_iter(sql, params=(), *, batch_size: int = 256) -> Iterator[Any]:
+    """Stream a query's rows as compact read-only tuples (see :mod:`app.rows`) without building a list."""
+
+    cur = get_connection(primary=not _QUERY_RE.match(sql)).cursor()
+    cur.row_factory = None
+    try:
+        cur.execute(sql, params)
+        yield from rows.iterate(cur, batch_size)
+    finally:
+        cur.close()
+
+
+def db_rows(sql, params=()) -> list[Any]:
+    return list(db_iter(sql, params))
+
+
+def _write(sql, params=()):
+    """Single-statement write that may be group-committed by the write coalescer.
+
+    Returns a Future when the statement was queued, ``None`` when it ran inline.
+    """
+
+    coalescer = write_coalescer.active()
+    if coalescer is None or in_transaction():
+        db_execute(sql, params)
+        return None
+    future = coalescer.submit(sql, params)
+    cache.invalidate_statement(sql, params)
+    return future
+
+
 def _ensure_order_sequence_min(min_order_id: int) -> None:
     try:
         target = int(min_order_id or 0)
@@ -56,7 +93,7 @@ def _ensure_order_sequence_min(min_order_id: int) -> None:
         return
 
     target_seq = target - 1
-    with closing(_connect()) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT IFNULL(MAX(id), 0) FROM orders")
         current_max = cur.fetchone()[0] or 0
@@ -75,350 +112,117 @@ def _ensure_order_sequence_min(min_order_id: int) -> None:
                     "UPDATE sqlite_sequence SET seq=? WHERE name='orders'",
                     (target_seq,),
                 )
-            con.commit()
         except sqlite3.OperationalError:
             cur.execute("INSERT INTO orders(id) VALUES(?)", (target_seq,))
-            con.commit()
             cur.execute("DELETE FROM orders WHERE id=?", (target_seq,))
-            con.commit()
+
+
+# بالاترین کفی که در این پروسه اعمال شده؛ شمارندهٔ AUTOINCREMENT هیچ‌وقت عقب نمی‌رود
+_order_id_floor_applied = 0
 
 
 def ensure_order_id_floor(min_order_id: int | None = None) -> None:
+    global _order_id_floor_applied
     if min_order_id is None:
         min_order_id = ORDER_ID_MIN_VALUE
-    _ensure_order_sequence_min(min_order_id)
-            
-def _table_exists(con, name):
-    cur = con.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
-    return cur.fetchone() is not None
+    try:
+        target = int(min_order_id or 0)
+    except (TypeError, ValueError):
+        target = 0
+    if target <= _order_id_floor_applied:
+        return
+    _ensure_order_sequence_min(target)
+    _order_id_floor_applied = target
 
-def _col_exists(con, table, col):
-    cur = con.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    return col in cols
 
+def init_db():
+    # مسیر سریع: دیتابیس به‌روز فقط یک PRAGMA می‌خواند
+    if migrations.current_version(get_connection()) < migrations.LATEST_VERSION:
+        with transaction() as con:
+            migrations.migrate(con)
+    # کف شمارهٔ سفارش یک بار در شروع پروسه اعمال می‌شود، نه در هر create_order
+    ensure_order_id_floor()
+    with transaction() as con:
+        archive.install(con)
 
-def _get_table_columns(cur, table: str) -> list[str]:
-    cur.execute(f"PRAGMA table_info({table})")
-    return [r[1] for r in cur.fetchall()]
 
+def get_migration_status() -> dict[str, Any]:
+    return migrations.status(get_connection())
 
-def _create_orders_table(cur) -> None:
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS orders(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER, username TEXT, first_name TEXT,
-            plan_id TEXT, plan_title TEXT, price TEXT,
-            receipt_file_id TEXT, receipt_text TEXT,
-            status TEXT, created_at TEXT, updated_at TEXT
-        );
-        """
-    )
 
+def publish_runtime_metrics(name: str, payload: dict[str, Any]) -> None:
+    """Store a process's in-memory counters so the web admin can display them."""
 
-def _add_missing_columns(con, cur) -> None:
-    add_cols = [
-        ("orders", "service_category", "TEXT"),
-        ("orders", "service_code", "TEXT"),
-        ("orders", "account_mode", "TEXT"),
-        ("orders", "customer_email", "TEXT"),
-        ("orders", "customer_secret_encrypted", "TEXT"),
-        ("orders", "amount_total", "INTEGER"),
-        ("orders", "currency", "TEXT"),
-        ("orders", "payment_type", "TEXT"),
-        ("orders", "wallet_used_amount", "INTEGER DEFAULT 0"),
-        ("orders", "wallet_reserved_amount", "INTEGER DEFAULT 0"),
-        ("orders", "await_deadline", "TEXT"),
-        ("orders", "notes", "TEXT"),
-        ("orders", "customer_message", "TEXT"),
-        ("orders", "manager_note", "TEXT"),
-        ("orders", "internal_cost", "INTEGER DEFAULT 0"),
-        ("orders", "net_revenue", "INTEGER DEFAULT 0"),
-        ("orders", "require_username", "INTEGER DEFAULT 0"),
-        ("orders", "require_password", "INTEGER DEFAULT 0"),
-        ("orders", "customer_username", "TEXT"),
-        ("orders", "customer_password", "TEXT"),
-        ("orders", "allow_first_plan", "INTEGER DEFAULT 0"),
-        ("orders", "cashback_percent", "INTEGER DEFAULT 0"),
-        ("orders", "cashback_applied_amount", "INTEGER DEFAULT 0"),
-        ("orders", "discount_id", "INTEGER"),
-        ("orders", "discount_code", "TEXT"),
-        ("orders", "discount_amount", "INTEGER DEFAULT 0"),
-        ("products", "description", "TEXT DEFAULT ''"),
-        ("products", "price", "INTEGER DEFAULT 0"),
-        ("products", "available", "INTEGER DEFAULT 1"),
-        ("products", "is_category", "INTEGER DEFAULT 0"),
-        ("products", "request_only", "INTEGER DEFAULT 0"),
-        ("products", "account_enabled", "INTEGER DEFAULT 0"),
-        ("products", "self_available", "INTEGER DEFAULT 0"),
-        ("products", "self_price", "INTEGER DEFAULT 0"),
-        # ستون‌های جدید برای نیازهای خاص مود "اکانت خودم"
-        ("products", "self_require_username", "INTEGER DEFAULT 0"),
-        ("products", "self_require_password", "INTEGER DEFAULT 0"),
-        
-        ("products", "pre_available", "INTEGER DEFAULT 0"),
-        ("products", "pre_price", "INTEGER DEFAULT 0"),
-        ("products", "require_username", "INTEGER DEFAULT 0"),
-        ("products", "require_password", "INTEGER DEFAULT 0"),
-        ("products", "allow_first_plan", "INTEGER DEFAULT 0"),
-        ("products", "cashback_enabled", "INTEGER DEFAULT 0"),
-        ("products", "cashback_percent", "INTEGER DEFAULT 0"),
-        ("products", "sort_order", "INTEGER DEFAULT 0"),
-        ("products", "created_at", "TEXT"),
-        ("products", "updated_at", "TEXT"),
-        ("users", "contact_phone", "TEXT"),
-        ("users", "contact_verified", "INTEGER DEFAULT 0"),
-        ("users", "contact_shared_at", "TEXT"),
-        ("users", "is_blocked", "INTEGER DEFAULT 0"),
-        ("service_messages", "updated_at", "TEXT"),
-        ("coupons", "is_active", "INTEGER DEFAULT 1"),
-        ("coupons", "usage_limit_per_user", "INTEGER DEFAULT 1"),
-        ("coupon_redemptions", "times_used", "INTEGER DEFAULT 1"),
-        # ستون‌های حیاتی برای رفع خطای شما
-        ("discount_redemptions", "order_id", "INTEGER"),
-        ("discount_redemptions", "times_used", "INTEGER DEFAULT 1"),
-        ("discount_redemptions", "redeemed_at", "TEXT"),
-        ("discount_redemptions", "status", "TEXT DEFAULT 'CONFIRMED'"),
-    ]
-    for t, c, typ in add_cols:
-        if _table_exists(con, t) and not _col_exists(con, t, c):
-            try:
-                cur.execute(f"ALTER TABLE {t} ADD COLUMN {c} {typ};")
-            except Exception:
-                pass
+    db_execute(
+        """
+        INSERT INTO runtime_metrics(name, payload, updated_at) VALUES(?,?,?)
+        ON CONFLICT(name) DO UPDATE SET payload=excluded.payload, updated_at=excluded.updated_at
+        """,
+        (name, json.dumps(payload, separators=(",", ":")), datetime.now().isoformat(timespec="seconds")),
+    )
 
 
-def _ensure_orders_have_id(con, cur) -> None:
-    if not _table_exists(con, "orders"):
-        return
-    cols = _get_table_columns(cur, "orders")
-    if "id" in cols:
-        return
-    cur.execute("ALTER TABLE orders RENAME TO orders_old;")
-    _create_orders_table(cur)
-    _add_missing_columns(con, cur)
-    old_cols = set(_get_table_columns(cur, "orders_old"))
-    new_cols = _get_table_columns(cur, "orders")
-    dest_cols = []
-    select_cols = []
-    if "id" in new_cols:
-        dest_cols.append("id")
-        select_cols.append("rowid")
-    for col in new_cols:
-        if col == "id" or col not in old_cols:
+def list_runtime_metrics() -> dict[str, dict[str, Any]]:
+    rows = db_execute("SELECT name, payload, updated_at FROM runtime_metrics ORDER BY name", fetchall=True)
+    metrics: dict[str, dict[str, Any]] = {}
+    for row in rows:
+        try:
+            payload = json.loads(row["payload"])
+        except (TypeError, ValueError):
             continue
-        dest_cols.append(col)
-        select_cols.append(col)
-    if dest_cols:
-        cols_sql = ",".join(dest_cols)
-        select_sql = ",".join(select_cols)
-        cur.execute(f"INSERT INTO orders ({cols_sql}) SELECT {select_sql} FROM orders_old;")
-    cur.execute("DROP TABLE orders_old;")
-    con.commit()
+        payload["updated_at"] = row["updated_at"]
+        metrics[row["name"]] = payload
+    return metrics
 
-def init_db():
-    with closing(_connect()) as con:
-        cur = con.cursor()
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            username TEXT, first_name TEXT,
-            wallet_balance INTEGER DEFAULT 0,
-            ref_by INTEGER, ref_count INTEGER DEFAULT 0,
-            earnings_total INTEGER DEFAULT 0,
-            created_at TEXT, updated_at TEXT
-        );
-        """)
-        _create_orders_table(cur)
-        _ensure_orders_have_id(con, cur)
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS products(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                parent_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
-                title TEXT NOT NULL,
-                description TEXT DEFAULT '',
-                price INTEGER DEFAULT 0,
-                available INTEGER DEFAULT 1,
-                is_category INTEGER DEFAULT 0,
-                request_only INTEGER DEFAULT 0,
-                account_enabled INTEGER DEFAULT 0,
-                self_available INTEGER DEFAULT 0,
-                self_price INTEGER DEFAULT 0,
-                self_require_username INTEGER DEFAULT 0,
-                self_require_password INTEGER DEFAULT 0,
-                pre_available INTEGER DEFAULT 0,
-                pre_price INTEGER DEFAULT 0,
-                require_username INTEGER DEFAULT 0,
-                require_password INTEGER DEFAULT 0,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT,
-                updated_at TEXT
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_products_parent ON products(parent_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_products_sort ON products(sort_order);")
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS service_messages(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                username TEXT,
-                first_name TEXT,
-                category TEXT,
-                message_text TEXT,
-                attachment_file_id TEXT,
-                created_at TEXT,
-                updated_at TEXT,
-                is_resolved INTEGER DEFAULT 0
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_service_messages_category ON service_messages(category);")
-        _add_missing_columns(con, cur)
-        con.commit()
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS wallet_tx(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            order_id INTEGER,
-            amount INTEGER NOT NULL,
-            type TEXT NOT NULL,
-            note TEXT,
-            created_at TEXT
-        );
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_user ON wallet_tx(user_id);")
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS order_manager_messages(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER NOT NULL,
-                user_id INTEGER,
-                message_text TEXT,
-                created_at TEXT
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_order_manager_messages_order ON order_manager_messages(order_id);")
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS service_message_replies(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                service_message_id INTEGER NOT NULL,
-                user_id INTEGER,
-                message_text TEXT,
-                created_at TEXT
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_service_message_replies_msg ON service_message_replies(service_message_id);")
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_manager_messages(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                message_text TEXT,
-                created_at TEXT
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_manager_messages_user ON user_manager_messages(user_id);")
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS coupons(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE NOT NULL,
-                amount INTEGER NOT NULL,
-                usage_limit INTEGER NOT NULL,
-                usage_limit_per_user INTEGER DEFAULT 1,
-                used_count INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1,
-                expires_at TEXT,
-                created_at TEXT,
-                updated_at TEXT
-            );
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS coupon_redemptions(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                coupon_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                times_used INTEGER DEFAULT 1,
-                redeemed_at TEXT,
-                UNIQUE(coupon_id, user_id),
-                FOREIGN KEY(coupon_id) REFERENCES coupons(id) ON DELETE CASCADE
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_coupon ON coupon_redemptions(coupon_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_user ON coupon_redemptions(user_id);")
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS discounts(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE NOT NULL,
-                amount INTEGER NOT NULL,
-                usage_limit INTEGER NOT NULL,
-                usage_limit_per_user INTEGER DEFAULT 1,
-                used_count INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1,
-                applies_all INTEGER DEFAULT 0,
-                product_ids TEXT DEFAULT '',
-                expires_at TEXT,
-                created_at TEXT,
-                updated_at TEXT
-            );
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS discount_redemptions(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                discount_id INTEGER NOT NULL,
-                order_id INTEGER,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                times_used INTEGER DEFAULT 1,
-                redeemed_at TEXT,
-                status TEXT DEFAULT 'CONFIRMED',
-                UNIQUE(discount_id, user_id),
-                FOREIGN KEY(discount_id) REFERENCES discounts(id) ON DELETE CASCADE
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_discount_redemptions_discount ON discount_redemptions(discount_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_discount_redemptions_user ON discount_redemptions(user_id);")
+
+# user_id -> (username, first_name, expires_at) برای کاربرانی که اخیراً ثبت/بررسی شده‌اند
+_recently_seen: dict[int, tuple[str | None, str, float]] = {}
+_RECENTLY_SEEN_MAX = 50_000
 
 
 def ensure_user(user_id: int, username: str, first_name: str):
+    first_name = first_name or ""
+    now_ts = time.monotonic()
+    seen = _recently_seen.get(user_id)
+    if seen is not None and seen[0] == username and seen[1] == first_name and seen[2] > now_ts:
+        return
+
     now = datetime.now().isoformat(timespec="seconds")
-    row = db_execute("SELECT user_id FROM users WHERE user_id=?", (user_id,), fetchone=True)
-    if not row:
-        db_execute(
-            "INSERT INTO users(user_id, username, first_name, created_at, updated_at) VALUES(?,?,?,?,?)",
-            (user_id, username, first_name or "", now, now),
-        )
-    else:
-        db_execute(
-            "UPDATE users SET username=?, first_name=?, updated_at=? WHERE user_id=?",
-            (username, first_name or "", now, user_id),
+    # فقط وقتی یوزرنیم یا نام واقعاً عوض شده باشد چیزی نوشته می‌شود
+    with transaction() as con:
+        cur = con.execute(
+            """
+            INSERT INTO users(user_id, username, first_name, created_at, updated_at) VALUES(?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username, first_name=excluded.first_name, updated_at=excluded.updated_at
+            WHERE users.username IS NOT excluded.username OR users.first_name IS NOT excluded.first_name
+            """,
+            (user_id, username, first_name, now, now),
         )
+        if cur.rowcount:
+            cache.invalidate(f"user:{user_id}")
+
+    if len(_recently_seen) >= _RECENTLY_SEEN_MAX:
+        _recently_seen.clear()
+    _recently_seen[user_id] = (username, first_name, now_ts + USER_SEEN_TTL_SECONDS)
 
 
-def get_user(user_id: int):
+def _load_user(user_id: int):
     return db_execute("SELECT * FROM users WHERE user_id=?", (user_id,), fetchone=True)
 
 
+def get_user(user_id: int, *, fresh: bool = False):
+    """The user row; ``fresh`` skips the row cache (for another process's changes, see :mod:`app.cache`)."""
+
+    if fresh:
+        return _load_user(user_id)
+    return cache.cached(
+        ("user", user_id),
+        lambda: _load_user(user_id),
+        cache.user_tags(user_id),
+    )
+
+
 def is_user_contact_verified(user_id: int) -> bool:
     user = get_user(user_id)
     if not user:
@@ -426,27 +230,72 @@ def is_user_contact_verified(user_id: int) -> bool:
     return bool(int(user.get("contact_verified") or 0))
 
 
-def set_user_contact_verified(user_id: int, phone_number: str) -> None:
+def set_user_contact_verified(user_id: int, phone_number: str):
     now = datetime.now().isoformat(timespec="seconds")
-    db_execute(
+    return _write(
         "UPDATE users SET contact_phone=?, contact_verified=1, contact_shared_at=?, updated_at=? WHERE user_id=?",
         (phone_number or "", now, now, user_id),
     )
 
 def change_wallet(user_id: int, delta: int, tx_type: str, note: str = "", order_id: int | None = None):
-    u = get_user(user_id)
-    if not u:
-        return False
-    new_bal = int(u["wallet_balance"]) + int(delta)
-    if new_bal < 0:
-        return False
-    now = datetime.now().isoformat(timespec="seconds")
-    db_execute("UPDATE users SET wallet_balance=?, updated_at=? WHERE user_id=?", (new_bal, now, user_id))
-    db_execute(
-        "INSERT INTO wallet_tx(user_id, order_id, amount, type, note, created_at) VALUES(?,?,?,?,?,?)",
-        (user_id, order_id, abs(delta), tx_type, note, now)
+    return ledger.post(user_id, delta, tx_type, note=note, order_id=order_id)
+
+
+def refund_order_to_wallet(
+    order_id: int,
+    note: str,
+    *,
+    include_used: bool = False,
+    card_refund_note: str | None = None,
+) -> int:
+    """Return an order's wallet money to its owner in one ledger batch.
+
+    The reserved amount is always refunded; ``include_used`` also returns
+    the wallet part that was already spent, and ``card_refund_note`` credits
+    the card-paid remainder.  Returns the total credited.
+    """
+
+    with transaction() as con:
+        order = get_order(order_id)
+        if not order:
+            return 0
+        return order_machine.refund(con, order, note, include_used=include_used, card_refund_note=card_refund_note)
+
+
+# شنونده‌های تغییر مهلت پرداخت؛ زمان‌بند انقضا (app/expiry.py) خودش را اینجا ثبت می‌کند
+_deadline_listeners: list[Callable[[int, str], None]] = []
+
+
+def add_deadline_listener(listener: Callable[[int, str], None]) -> None:
+    if listener not in _deadline_listeners:
+        _deadline_listeners.append(listener)
+
+
+def remove_deadline_listener(listener: Callable[[int, str], None]) -> None:
+    if listener in _deadline_listeners:
+        _deadline_listeners.remove(listener)
+
+
+def _deadline_changed(order_id: int, deadline: str) -> None:
+    def notify() -> None:
+        for listener in list(_deadline_listeners):
+            try:
+                listener(int(order_id), deadline)
+            except Exception:
+                logging.exception("deadline listener failed for order #%s", order_id)
+
+    if _deadline_listeners:
+        after_commit(notify)
+
+
+def list_payment_deadlines() -> list[dict[str, Any]]:
+    return db_execute(
+        """
+        SELECT id, await_deadline FROM orders
+        WHERE status='AWAITING_PAYMENT' AND await_deadline IS NOT NULL AND await_deadline<>''
+        """,
+        fetchall=True,
     )
-    return True
 
 
 def refresh_order_deadline(order_id: int, minutes: int | None = None) -> str:
@@ -458,9 +307,29 @@ def refresh_order_deadline(order_id: int, minutes: int | None = None) -> str:
         "UPDATE orders SET await_deadline=?, updated_at=? WHERE id=?",
         (refreshed_deadline, now.isoformat(timespec="seconds"), order_id),
     )
+    _deadline_changed(order_id, refreshed_deadline)
     return refreshed_deadline
 
-def create_order(
+_ORDER_INSERT_COLUMNS = (
+    "user_id", "username", "first_name",
+    "plan_id", "plan_title", "price",
+    "status", "created_at", "updated_at", "await_deadline",
+    "amount_total", "currency", "service_category", "service_code",
+    "account_mode", "customer_email", "notes",
+    "customer_secret_encrypted",
+    "require_username", "require_password",
+    "customer_username", "customer_password",
+    "allow_first_plan", "cashback_percent",
+    "discount_id", "discount_code", "discount_amount",
+)
+_ORDER_INSERT_SQL = (
+    f"INSERT INTO orders({', '.join(_ORDER_INSERT_COLUMNS)}) "
+    f"VALUES({','.join('?' * len(_ORDER_INSERT_COLUMNS))})"
+)
+
+
+def _order_values(
+    now: datetime,
     user,
     title: str,
     amount_total: int,
@@ -479,7 +348,7 @@ def create_order(
     allow_first_plan: bool = False,
     cashback_percent: int = 0,
     allow_free: bool = False,
-) -> int | None:
+) -> tuple | None:
     if isinstance(amount_total, str):
         amount_total = amount_total.replace(",", "").replace("،", "")
     try:
@@ -489,25 +358,13 @@ def create_order(
 
     if amount_total <= 0 and not allow_free:
         return None
-    now = datetime.now()
-    ensure_order_id_floor()
-    oid = db_execute("""
-        INSERT INTO orders(
-            user_id, username, first_name,
-            plan_id, plan_title, price,
-            status, created_at, updated_at,
-            amount_total, currency, service_category, service_code,
-            account_mode, customer_email, notes,
-            customer_secret_encrypted,
-            require_username, require_password,
-            customer_username, customer_password,
-            allow_first_plan, cashback_percent,
-            discount_id, discount_code, discount_amount
-        ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (
+    created = now.isoformat(timespec="seconds")
+    # مهلت پرداخت همراه همان INSERT نوشته می‌شود
+    await_deadline = (now + timedelta(minutes=PAYMENT_TIMEOUT_MIN)).isoformat(timespec="seconds")
+    return (
         user["user_id"], user["username"], user["first_name"] or "",
         None, title, str(amount_total),
-        "AWAITING_PAYMENT", now.isoformat(timespec="seconds"), now.isoformat(timespec="seconds"),
+        "AWAITING_PAYMENT", created, created, await_deadline,
         amount_total, currency, service_category, service_code,
         account_mode or "", customer_email or "", notes or "",
         customer_secret or "",
@@ -520,79 +377,202 @@ def create_order(
         None,
         "",
         0,
-    ), return_lastrowid=True)
-    await_deadline = (now + timedelta(minutes=PAYMENT_TIMEOUT_MIN)).isoformat(timespec="seconds")
-    db_execute("UPDATE orders SET await_deadline=? WHERE id=?", (await_deadline, oid))
+    )
+
+
+_DEADLINE_INDEX = _ORDER_INSERT_COLUMNS.index("await_deadline")
+
+
+def create_order(
+    user,
+    title: str,
+    amount_total: int,
+    currency: str,
+    service_category: str,
+    service_code: str,
+    account_mode: str | None = None,
+    customer_email: str | None = None,
+    notes: str | None = None,
+    customer_secret: str | None = None,
+    *,
+    require_username: bool = False,
+    require_password: bool = False,
+    customer_username: str | None = None,
+    customer_password: str | None = None,
+    allow_first_plan: bool = False,
+    cashback_percent: int = 0,
+    allow_free: bool = False,
+) -> int | None:
+    values = _order_values(
+        datetime.now(),
+        user,
+        title,
+        amount_total,
+        currency,
+        service_category,
+        service_code,
+        account_mode,
+        customer_email,
+        notes,
+        customer_secret,
+        require_username=require_username,
+        require_password=require_password,
+        customer_username=customer_username,
+        customer_password=customer_password,
+        allow_first_plan=allow_first_plan,
+        cashback_percent=cashback_percent,
+        allow_free=allow_free,
+    )
+    if values is None:
+        return None
+    oid = db_execute(_ORDER_INSERT_SQL, values, return_lastrowid=True)
+    _deadline_changed(oid, values[_DEADLINE_INDEX])
     return oid
 
+
+def create_orders(orders: Iterable[dict[str, Any]]) -> list[int]:
+    """Create several orders in one transaction; each item holds ``create_order`` arguments.
+
+    Raises ``ValueError`` (and creates nothing) if any item has an invalid amount.
+    """
+
+    now = datetime.now()
+    rows = []
+    for index, item in enumerate(orders):
+        values = _order_values(now, **item)
+        if values is None:
+            raise ValueError(f"Invalid order at position {index}")
+        rows.append(values)
+    ids: list[int] = []
+    with transaction() as con:
+        for values in rows:
+            oid = con.execute(_ORDER_INSERT_SQL, values).lastrowid
+            ids.append(oid)
+            _deadline_changed(oid, values[_DEADLINE_INDEX])
+    return ids
+
+
 def set_order_status(order_id: int, status: str):
-    previous = get_order(order_id)
-    db_execute(
-        "UPDATE orders SET status=?, updated_at=? WHERE id=?",
-        (status, datetime.now().isoformat(timespec="seconds"), order_id),
+    """Move an order to ``status`` from whatever status allows it (see ``order_machine.TRANSITIONS``)."""
+
+    result = order_machine.transition(order_id, status)
+    if result is None:
+        logging.info("Order #%s: transition to %s rejected", order_id, status)
+    return result
+
+
+class _PaymentRejected(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def pay_order_from_wallet(order_id: int, user_id: int, amount: int, comment: str = ""):
+    """Debit the wallet and move the order from AWAITING_PAYMENT to IN_PROGRESS in one transaction.
+
+    Returns ``(success, transition, error)``; when the order already left
+    AWAITING_PAYMENT (e.g. it expired meanwhile) nothing is debited.
+    """
+
+    now = datetime.now().isoformat(timespec="seconds")
+    try:
+        with transaction() as con:
+            if not ledger.post(user_id, -amount, "DEBIT", note=f"Order #{order_id}", order_id=order_id):
+                raise _PaymentRejected("موجودی کیف پول کافی نیست.")
+            con.execute(
+                "UPDATE orders SET wallet_used_amount=?, payment_type='WALLET', customer_message=?, updated_at=? "
+                "WHERE id=? AND user_id=?",
+                (amount, comment or "", now, order_id, user_id),
+            )
+            moved = order_machine.transition(order_id, "IN_PROGRESS", expected="AWAITING_PAYMENT")
+            if moved is None:
+                raise _PaymentRejected("سفارش دیگر قابل پرداخت نیست (ممکن است منقضی شده باشد).")
+    except _PaymentRejected as exc:
+        return False, None, exc.reason
+    return True, moved, None
+
+
+def reserve_order_wallet(order_id: int, user_id: int, amount: int):
+    """Reserve ``amount`` of the wallet for a MIXED payment in one transaction.
+
+    The RESERVE posting and the order update commit together, so the expiry
+    job always sees the reservation it has to refund.  Only an unpaid order
+    before its deadline that holds no reservation yet is updated; otherwise
+    nothing is debited.  Returns ``(success, None, error)``.
+    """
+
+    now = datetime.now().isoformat(timespec="seconds")
+    try:
+        with transaction() as con:
+            if not ledger.post(user_id, -amount, "RESERVE", note=f"Reserve for order #{order_id}", order_id=order_id):
+                raise _PaymentRejected("موجودی کیف پول کافی نیست.")
+            updated = con.execute(
+                """
+                UPDATE orders SET wallet_reserved_amount=?, payment_type='MIXED', updated_at=?
+                WHERE id=? AND user_id=? AND status='AWAITING_PAYMENT'
+                    AND (await_deadline IS NULL OR await_deadline > ?)
+                    AND IFNULL(wallet_reserved_amount, 0)=0
+                """,
+                (amount, now, order_id, user_id, now),
+            ).rowcount
+            if not updated:
+                raise _PaymentRejected("برای این سفارش قبلاً کیف پول رزرو شده یا سفارش دیگر قابل پرداخت نیست.")
+            cache.invalidate(f"order:{order_id}")
+    except _PaymentRejected as exc:
+        return False, None, exc.reason
+    return True, None, None
+
+
+def transition_order(
+    order_id: int,
+    status: str,
+    *,
+    expected: str | None = None,
+    refund_note: str | None = None,
+    card_refund_note: str | None = None,
+    admin: bool = False,
+):
+    return order_machine.transition(
+        order_id,
+        status,
+        expected=expected,
+        refund_note=refund_note,
+        card_refund_note=card_refund_note,
+        admin=admin,
     )
-    updated = get_order(order_id)
-    cashback_statuses = {"DELIVERED", "COMPLETED"}
-    if (
-        updated
-        and previous
-        and previous.get("status") != updated.get("status")
-        and updated.get("status") in cashback_statuses
-    ):
-        apply_order_cashback(order_id)
 
 def set_order_receipt(order_id: int, file_id: str | None, text: str | None):
-    db_execute("UPDATE orders SET receipt_file_id=?, receipt_text=?, updated_at=? WHERE id=?",
-               (file_id, text, datetime.now().isoformat(timespec="seconds"), order_id))
+    return _write("UPDATE orders SET receipt_file_id=?, receipt_text=?, updated_at=? WHERE id=?",
+                  (file_id, text, datetime.now().isoformat(timespec="seconds"), order_id))
 
 def set_order_payment_type(order_id: int, ptype: str):
-    db_execute("UPDATE orders SET payment_type=?, updated_at=? WHERE id=?", (ptype, datetime.now().isoformat(timespec="seconds"), order_id))
+    return _write("UPDATE orders SET payment_type=?, updated_at=? WHERE id=?", (ptype, datetime.now().isoformat(timespec="seconds"), order_id))
 
 def set_order_wallet_reserved(order_id: int, amount: int):
-    db_execute("UPDATE orders SET wallet_reserved_amount=?, updated_at=? WHERE id=?", (amount, datetime.now().isoformat(timespec="seconds"), order_id))
+    return _write("UPDATE orders SET wallet_reserved_amount=?, updated_at=? WHERE id=?", (amount, datetime.now().isoformat(timespec="seconds"), order_id))
 
 def set_order_wallet_used(order_id: int, amount: int):
-    db_execute("UPDATE orders SET wallet_used_amount=?, updated_at=? WHERE id=?", (amount, datetime.now().isoformat(timespec="seconds"), order_id))
+    return _write("UPDATE orders SET wallet_used_amount=?, updated_at=? WHERE id=?", (amount, datetime.now().isoformat(timespec="seconds"), order_id))
 
 def set_order_customer_message(order_id: int, message: str | None):
-    db_execute(
+    return _write(
         "UPDATE orders SET customer_message=?, updated_at=? WHERE id=?",
         (message or "", datetime.now().isoformat(timespec="seconds"), order_id),
     )
 
 def set_order_manager_note(order_id: int, note: str | None):
-    db_execute(
+    return _write(
         "UPDATE orders SET manager_note=?, updated_at=? WHERE id=?",
         (note or "", datetime.now().isoformat(timespec="seconds"), order_id),
     )
 
 
 def apply_order_cashback(order_id: int) -> int:
-    order = get_order(order_id)
-    if not order:
-        return 0
-    try:
-        percent = max(int(order.get("cashback_percent") or 0), 0)
-    except (TypeError, ValueError):
-        percent = 0
-    if percent <= 0:
-        return 0
-    base_amount = int(order.get("amount_total") or order.get("price") or 0)
-    cashback_total = max((base_amount * percent) // 100, 0)
-    already_applied = int(order.get("cashback_applied_amount") or 0)
-    remaining = max(cashback_total - already_applied, 0)
-    if remaining <= 0 or not order.get("user_id"):
-        return 0
-    success = change_wallet(
-        order["user_id"], remaining, "CREDIT", note=f"CASHBACK:ORDER:{order_id}", order_id=order_id
-    )
-    if not success:
-        return 0
-    db_execute(
-        "UPDATE orders SET cashback_applied_amount=?, updated_at=? WHERE id=?",
-        (cashback_total, datetime.now().isoformat(timespec="seconds"), order_id),
-    )
-    return remaining
+    with transaction() as con:
+        order = get_order(order_id)
+        if not order:
+            return 0
+        return order_machine.credit_cashback(con, order)
 
 
 def add_order_manager_message(order_id: int, user_id: int | None, message: str) -> int:
@@ -609,8 +589,8 @@ def add_order_manager_message(order_id: int, user_id: int | None, message: str)
 
 def list_order_manager_messages(order_id: int, limit: int = 50) -> list[dict[str, Any]]:
     return db_execute(
-        """
-        SELECT * FROM order_manager_messages
+        f"""
+        SELECT * FROM {archive.source("order_manager_messages")}
         WHERE order_id=?
         ORDER BY created_at DESC
         LIMIT ?
@@ -661,13 +641,25 @@ def set_order_financials(order_id: int, cost_amount: int) -> None:
     )
 
 def set_order_customer_secret(order_id: int, secret: str | None):
-    db_execute(
+    return _write(
         "UPDATE orders SET customer_secret_encrypted=?, updated_at=? WHERE id=?",
         (secret or "", datetime.now().isoformat(timespec="seconds"), order_id),
     )
 
-def get_order(order_id: int):
-    return db_execute("SELECT * FROM orders WHERE id=?", (order_id,), fetchone=True)
+def _load_order(order_id: int):
+    row = db_execute("SELECT * FROM orders WHERE id=?", (order_id,), fetchone=True)
+    if row is None:
+        # سفارش بایگانی‌شده با همان شناسه
+        row = archive.get(get_connection(), "orders", "id", order_id)
+    return row
+
+
+def get_order(order_id: int, *, fresh: bool = False):
+    """The order row, archived orders included; ``fresh`` skips the row cache."""
+
+    if fresh:
+        return _load_order(order_id)
+    return cache.cached(("order", order_id), lambda: _load_order(order_id), cache.order_tags(order_id))
 
 
 def get_order_payable_amount(order: dict | None) -> int:
@@ -685,8 +677,8 @@ def get_order_payable_amount(order: dict | None) -> int:
 
 def user_has_delivered_order(user_id: int) -> bool:
     row = db_execute(
-        """
-        SELECT 1 FROM orders
+        f"""
+        SELECT 1 FROM {archive.source("orders")}
         WHERE user_id=? AND status IN ('DELIVERED','COMPLETED')
         LIMIT 1
         """,
@@ -695,86 +687,104 @@ def user_has_delivered_order(user_id: int) -> bool:
     )
     return bool(row)
 
-def _normalize_cart_orders(user_id: int, order_id: int | None = None):
-    now = datetime.now()
-    now_iso = now.isoformat(timespec="seconds")
+# شرط وضعیت باید عیناً با شرط ایندکس جزئی idx_orders_cart یکی باشد
+_CART_WHERE = "user_id=? AND status IN ('AWAITING_PAYMENT', 'PENDING_CONFIRM') AND await_deadline > ?"
 
-    filters = ["user_id=?", "status IN ('AWAITING_PAYMENT','PENDING_CONFIRM','', 'در انتظار پرداخت')"]
-    params: list[int | str] = [user_id]
-    if order_id:
-        filters.append("id=?")
-        params.append(order_id)
 
-    candidates = db_execute(
-        f"""
-        SELECT * FROM orders
-        WHERE {' AND '.join(filters)}
-        """,
-        tuple(params),
+def list_cart_orders(user_id: int):
+    return db_execute(
+        f"SELECT * FROM orders WHERE {_CART_WHERE} ORDER BY await_deadline ASC",
+        (user_id, datetime.now().isoformat(timespec="seconds")),
         fetchall=True,
-    ) or []
+    )
 
-    valid_ids: list[int] = []
-    for o in candidates:
-        oid = int(o.get("id"))
-        status = (o.get("status") or "").strip()
-        if status in {"", "در انتظار پرداخت"}:
-            set_order_status(oid, "AWAITING_PAYMENT")
-            o["status"] = "AWAITING_PAYMENT"
-        elif status not in {"AWAITING_PAYMENT", "PENDING_CONFIRM"}:
-            continue
 
-        deadline_raw = (o.get("await_deadline") or "").strip()
-        if not deadline_raw:
-            deadline_raw = refresh_order_deadline(oid)
-            o["await_deadline"] = deadline_raw
-        try:
-            if deadline_raw and datetime.fromisoformat(deadline_raw) <= now:
-                set_order_status(oid, "EXPIRED")
-                continue
-        except ValueError:
-            deadline_raw = refresh_order_deadline(oid)
-            o["await_deadline"] = deadline_raw
+def get_cart_order(order_id: int, user_id: int):
+    return db_execute(
+        f"SELECT * FROM orders WHERE {_CART_WHERE} AND id=?",
+        (user_id, datetime.now().isoformat(timespec="seconds"), order_id),
+        fetchone=True,
+    )
 
-        valid_ids.append(oid)
+def expire_orders_and_refund():
+    """Expire every overdue unpaid order and refund its wallet reservation, in one transaction.
 
-    if not valid_ids:
-        return []
+    The status change is a single ``UPDATE ... RETURNING``; refunds go through
+    one ledger batch and the reserved amounts are cleared with one statement.
+    Returns the expired rows (as updated) for the notifier.
+    """
 
-    placeholders = ",".join("?" for _ in valid_ids)
-    return db_execute(
-        f"""
-        SELECT * FROM orders
-        WHERE id IN ({placeholders})
-          AND (await_deadline IS NULL OR await_deadline='' OR await_deadline > ?)
-        ORDER BY await_deadline ASC
-        """,
-        (*valid_ids, now_iso),
-        fetchall=True,
-    )
+    now = datetime.now().isoformat(timespec="seconds")
+    with transaction() as con:
+        expired = [
+            dict(row)
+            for row in con.execute(
+                """
+                UPDATE orders SET status='EXPIRED', updated_at=?
+                WHERE status='AWAITING_PAYMENT' AND await_deadline IS NOT NULL AND await_deadline <= ?
+                RETURNING *
+                """,
+                (now, now),
+            ).fetchall()
+        ]
+        if not expired:
+            return []
+        cache.invalidate(*(f"order:{o['id']}" for o in expired))
+        refunds = [
+            (int(o["id"]), ledger.Posting(
+                o["user_id"],
+                int(o.get("wallet_reserved_amount") or 0),
+                "REFUND",
+                f"Expire order #{int(o['id'])}",
+                int(o["id"]),
+            ))
+            for o in expired
+            if int(o.get("wallet_reserved_amount") or 0) > 0
+        ]
+        results = ledger.post_many(p for _, p in refunds)
+        refunded = {rid for (rid, _), ok in zip(refunds, results) if ok}
+        if refunded:
+            con.execute(
+                "UPDATE orders SET wallet_reserved_amount=0 WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(sorted(refunded)),),
+            )
+            for o in expired:
+                if int(o["id"]) in refunded:
+                    o["wallet_reserved_amount"] = 0
+    return expired
 
 
-def list_cart_orders(user_id: int):
-    return _normalize_cart_orders(user_id)
+def archive_cold_orders(
+    *,
+    terminal_days: int = ARCHIVE_TERMINAL_DAYS,
+    completed_days: int = ARCHIVE_COMPLETED_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+) -> int:
+    """Move one batch of finished orders to the archive database; returns how many moved.
 
+    Callers loop while a full batch comes back, so the write lock is
+    released between batches.  The archive copy is committed before the
+    hot rows are deleted (see :mod:`app.archive`).
+    """
 
-def get_cart_order(order_id: int, user_id: int):
-    orders = _normalize_cart_orders(user_id, order_id)
-    return orders[0] if orders else None
+    if not archive.enabled():
+        return 0
+    now = datetime.now()
+    with transaction() as con:
+        order_ids = archive.candidates(
+            con, now=now, terminal_days=terminal_days, completed_days=completed_days, limit=max(int(batch_size), 1)
+        )
+        archive.copy(con, order_ids, now=now)
+    if not order_ids:
+        return 0
+    with transaction() as con:
+        moved = archive.prune(con, order_ids)
+        cache.invalidate(*(f"order:{oid}" for oid in order_ids))
+    return moved
 
-def expire_orders_and_refund():
-    expired = db_execute("""
-        SELECT * FROM orders
-        WHERE status='AWAITING_PAYMENT' AND await_deadline IS NOT NULL AND await_deadline <= ?
-    """, (datetime.now().isoformat(timespec="seconds"),), fetchall=True)
-    for o in expired:
-        rid = int(o["id"])
-        reserved = int(o.get("wallet_reserved_amount") or 0)
-        if reserved > 0:
-            change_wallet(o["user_id"], reserved, "REFUND", note=f"Expire order #{rid}", order_id=rid)
-            set_order_wallet_reserved(rid, 0)
-        set_order_status(rid, "EXPIRED")
-    return expired
+
+def get_archive_stats() -> dict[str, Any]:
+    return archive.stats(get_connection())
 
 
 def create_coupon(
@@ -905,89 +915,42 @@ def get_coupon_by_code(code: str):
 
 
 def redeem_coupon(user_id: int, code: str) -> tuple[bool, dict[str, Any] | None, str | None]:
-    normalized = (code or "").strip().upper()
-    if not normalized:
-        return False, None, "کد کوپن نامعتبر است."
+    return redemption.redeem_coupon(user_id, code)
 
-    coupon = get_coupon_by_code(normalized)
-    if not coupon:
-        return False, None, "چنین کدی وجود ندارد."
 
-    if not coupon.get("is_active"):
-        return False, None, "این کوپن غیرفعال است."
+def _product_id_list(product_ids: Iterable[int] | None) -> list[int]:
+    return sorted({int(pid) for pid in product_ids or [] if str(pid).isdigit()})
 
-    try:
-        amount = int(coupon.get("amount") or 0)
-    except (TypeError, ValueError):
-        amount = 0
-    if amount <= 0:
-        return False, None, "مبلغ این کوپن معتبر نیست."
 
-    limit = int(coupon.get("usage_limit") or 0)
-    used = int(coupon.get("used_count") or 0)
-    if limit and used >= limit:
-        return False, None, "ظرفیت استفاده از این کوپن تکمیل شده است."
-
-    expires_at = coupon.get("expires_at")
-    if expires_at:
-        try:
-            expire_dt = datetime.fromisoformat(str(expires_at))
-            if datetime.now() > expire_dt:
-                return False, None, "تاریخ انقضای این کوپن گذشته است."
-        except ValueError:
-            pass
-
-    redemption = db_execute(
-        "SELECT id, times_used FROM coupon_redemptions WHERE coupon_id=? AND user_id=?",
-        (coupon["id"], user_id),
-        fetchone=True,
+def _set_discount_products(con, discount_id: int, product_ids: Iterable[int] | None) -> None:
+    con.execute("DELETE FROM discount_products WHERE discount_id=?", (discount_id,))
+    con.executemany(
+        "INSERT INTO discount_products(discount_id, product_id) VALUES(?, ?)",
+        ((discount_id, pid) for pid in _product_id_list(product_ids)),
     )
-    per_user_limit = int(coupon.get("usage_limit_per_user") or 1)
-    existing_uses = int(redemption.get("times_used") or 0) if redemption else 0
-    if per_user_limit and existing_uses >= per_user_limit:
-        return False, None, "سقف استفاده شما از این کد تکمیل شده است."
 
-    success = change_wallet(user_id, amount, "CREDIT", note=f"COUPON:{coupon['code']}")
-    if not success:
-        return False, None, "امکان واریز مبلغ کوپن وجود ندارد."
 
-    now = datetime.now().isoformat(timespec="seconds")
-    if redemption:
-        new_uses = existing_uses + 1
-        db_execute(
-            "UPDATE coupon_redemptions SET times_used=?, redeemed_at=? WHERE id=?",
-            (new_uses, now, redemption["id"]),
-        )
-    else:
-        db_execute(
+def _discount_rows(rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    products: dict[int, list[int]] = {}
+    if rows:
+        for item in db_execute(
             """
-            INSERT INTO coupon_redemptions(coupon_id, user_id, amount, times_used, redeemed_at)
-            VALUES(?,?,?,?,?)
+            SELECT discount_id, product_id FROM discount_products
+            WHERE discount_id IN (SELECT value FROM json_each(?))
+            ORDER BY discount_id, product_id
             """,
-            (coupon["id"], user_id, amount, 1, now),
-        )
-    db_execute(
-        "UPDATE coupons SET used_count=used_count+1, updated_at=? WHERE id=?",
-        (now, coupon["id"]),
-    )
-    user = get_user(user_id)
-    balance = int(user.get("wallet_balance") or 0) if user else 0
-    return True, {"amount": amount, "balance": balance, "code": coupon["code"]}, None
-
-
-def _serialize_product_ids(product_ids: Iterable[int]) -> str:
-    return ",".join(str(int(pid)) for pid in product_ids if str(pid).isdigit())
-
-
-def _parse_product_ids(raw: str | None) -> list[int]:
-    if not raw:
-        return []
-    items = []
-    for part in str(raw).split(","):
-        part = part.strip()
-        if part.isdigit():
-            items.append(int(part))
-    return items
+            (json.dumps([row["id"] for row in rows]),),
+            fetchall=True,
+        ) or []:
+            products.setdefault(item["discount_id"], []).append(item["product_id"])
+    for row in rows:
+        if not row.get("expires_at"):
+            row["expires_at"] = None
+        row["usage_limit_per_user"] = int(row.get("usage_limit_per_user") or 1)
+        row["is_active"] = bool(int(row.get("is_active") or 0))
+        row["applies_all"] = bool(int(row.get("applies_all") or 0))
+        row["product_ids"] = products.get(row["id"], [])
+    return rows
 
 
 def create_discount(
@@ -1001,34 +964,36 @@ def create_discount(
     expires_at: str | None = None,
 ) -> int:
     now = datetime.now().isoformat(timespec="seconds")
-    normalized = (code or "").strip().upper()
+    normalized = redemption.normalize_code(code)
     if not normalized:
         raise ValueError("Discount code cannot be empty")
     per_user = 1 if usage_limit_per_user is None else int(usage_limit_per_user)
-    product_list = _serialize_product_ids(product_ids or [])
-    return db_execute(
-        """
-        INSERT INTO discounts(
-            code, amount, usage_limit, usage_limit_per_user,
-            used_count, is_active, applies_all, product_ids, expires_at,
-            created_at, updated_at
-        ) VALUES(?,?,?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            normalized,
-            int(amount),
-            int(usage_limit),
-            per_user,
-            0,
-            1,
-            1 if applies_all else 0,
-            product_list,
-            expires_at,
-            now,
-            now,
-        ),
-        return_lastrowid=True,
-    )
+    with transaction() as con:
+        discount_id = con.execute(
+            """
+            INSERT INTO discounts(
+                code, code_norm, amount, usage_limit, usage_limit_per_user,
+                used_count, is_active, applies_all, expires_at,
+                created_at, updated_at
+            ) VALUES(?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                normalized,
+                normalized,
+                int(amount),
+                int(usage_limit),
+                per_user,
+                0,
+                1,
+                1 if applies_all else 0,
+                expires_at,
+                now,
+                now,
+            ),
+        ).lastrowid
+        _set_discount_products(con, discount_id, product_ids)
+        after_commit(redemption.invalidate_discounts)
+    return discount_id
 
 
 def update_discount(
@@ -1044,26 +1009,26 @@ def update_discount(
     is_active: bool | int | None = None,
 ) -> bool:
     now = datetime.now().isoformat(timespec="seconds")
-    normalized = (code or "").strip().upper()
+    normalized = redemption.normalize_code(code)
     if not normalized:
         return False
     updates = [
         "code=?",
+        "code_norm=?",
         "amount=?",
         "usage_limit=?",
         "usage_limit_per_user=?",
         "applies_all=?",
-        "product_ids=?",
         "expires_at=?",
         "updated_at=?",
     ]
     params: list[Any] = [
+        normalized,
         normalized,
         int(amount),
         int(usage_limit),
         int(usage_limit_per_user),
         1 if applies_all else 0,
-        _serialize_product_ids(product_ids or []),
         expires_at,
         now,
     ]
@@ -1071,14 +1036,17 @@ def update_discount(
         updates.append("is_active=?")
         params.append(1 if bool(is_active) else 0)
     params.append(discount_id)
-    db_execute(
-        f"""
-        UPDATE discounts
-        SET {', '.join(updates)}
-        WHERE id=?
-        """,
-        tuple(params),
-    )
+    with transaction() as con:
+        con.execute(
+            f"""
+            UPDATE discounts
+            SET {', '.join(updates)}
+            WHERE id=?
+            """,
+            tuple(params),
+        )
+        _set_discount_products(con, discount_id, product_ids)
+        after_commit(redemption.invalidate_discounts)
     return True
 
 
@@ -1088,10 +1056,15 @@ def set_discount_active(discount_id: int, active: bool) -> None:
         "UPDATE discounts SET is_active=?, updated_at=? WHERE id=?",
         (1 if active else 0, now, discount_id),
     )
+    after_commit(redemption.invalidate_discounts)
 
 
 def delete_discount(discount_id: int) -> None:
-    db_execute("DELETE FROM discounts WHERE id=?", (discount_id,))
+    # foreign_keys خاموش است؛ ردیف‌های وابسته دستی پاک می‌شوند
+    with transaction() as con:
+        con.execute("DELETE FROM discount_products WHERE discount_id=?", (discount_id,))
+        con.execute("DELETE FROM discounts WHERE id=?", (discount_id,))
+        after_commit(redemption.invalidate_discounts)
 
 
 def list_discounts(limit: int = 100, offset: int = 0) -> list[dict[str, Any]]:
@@ -1104,41 +1077,20 @@ def list_discounts(limit: int = 100, offset: int = 0) -> list[dict[str, Any]]:
         (limit, offset),
         fetchall=True,
     ) or []
-    for row in rows:
-        if not row.get("expires_at"):
-            row["expires_at"] = None
-        row["usage_limit_per_user"] = int(row.get("usage_limit_per_user") or 1)
-        row["is_active"] = bool(int(row.get("is_active") or 0))
-        row["applies_all"] = bool(int(row.get("applies_all") or 0))
-        row["product_ids"] = _parse_product_ids(row.get("product_ids"))
-    return rows
+    return _discount_rows(rows)
 
 
 def get_discount(discount_id: int):
     row = db_execute("SELECT * FROM discounts WHERE id=?", (discount_id,), fetchone=True)
-    if row:
-        if not row.get("expires_at"):
-            row["expires_at"] = None
-        row["usage_limit_per_user"] = int(row.get("usage_limit_per_user") or 1)
-        row["is_active"] = bool(int(row.get("is_active") or 0))
-        row["applies_all"] = bool(int(row.get("applies_all") or 0))
-        row["product_ids"] = _parse_product_ids(row.get("product_ids"))
-    return row
+    return _discount_rows([row])[0] if row else None
 
 
 def get_discount_by_code(code: str):
-    normalized = (code or "").strip().upper()
+    normalized = redemption.normalize_code(code)
     if not normalized:
         return None
-    row = db_execute("SELECT * FROM discounts WHERE UPPER(code)=?", (normalized,), fetchone=True)
-    if row:
-        if not row.get("expires_at"):
-            row["expires_at"] = None
-        row["usage_limit_per_user"] = int(row.get("usage_limit_per_user") or 1)
-        row["is_active"] = bool(int(row.get("is_active") or 0))
-        row["applies_all"] = bool(int(row.get("applies_all") or 0))
-        row["product_ids"] = _parse_product_ids(row.get("product_ids"))
-    return row
+    row = db_execute("SELECT * FROM discounts WHERE code_norm=?", (normalized,), fetchone=True)
+    return _discount_rows([row])[0] if row else None
 
 
 def list_discount_redemptions(discount_id: int) -> list[dict[str, Any]]:
@@ -1154,161 +1106,23 @@ def list_discount_redemptions(discount_id: int) -> list[dict[str, Any]]:
     ) or []
 
 
-def _order_product_id(order: dict | None) -> int | None:
-    if not order:
-        return None
-    code = order.get("service_code") or ""
-    if code.startswith("product:"):
-        try:
-            return int(code.split(":", 1)[1])
-        except (IndexError, ValueError):
-            return None
-    return None
-
-
-def _repair_discount_table(con, cur) -> None:
-    """Checks and repairs the discount_redemptions table structure to prevent errors."""
-    try:
-        cur.execute("PRAGMA table_info(discount_redemptions)")
-        columns = {row["name"] for row in cur.fetchall()}
-        
-        if "order_id" not in columns:
-            cur.execute("ALTER TABLE discount_redemptions ADD COLUMN order_id INTEGER")
-        
-        if "times_used" not in columns:
-            cur.execute("ALTER TABLE discount_redemptions ADD COLUMN times_used INTEGER DEFAULT 1")
-        
-        if "redeemed_at" not in columns:
-            cur.execute("ALTER TABLE discount_redemptions ADD COLUMN redeemed_at TEXT")
-            
-        if "status" not in columns:
-            cur.execute("ALTER TABLE discount_redemptions ADD COLUMN status TEXT DEFAULT 'CONFIRMED'")
-            
-        con.commit()
-    except Exception:
-        pass
-
-
 def apply_discount_to_order(
     order_id: int, user_id: int, code: str
 ) -> tuple[bool, dict[str, Any] | None, str | None]:
-    try:
-        with closing(_connect()) as con:
-            _repair_discount_table(con, con.cursor())
-    except Exception:
-        pass
-
-    order = get_order(order_id)
-    if not order or order.get("user_id") != user_id:
-        return False, None, "سفارش نامعتبر است."
-    if order.get("status") != "AWAITING_PAYMENT":
-        return False, None, "وضعیت سفارش اجازه ثبت تخفیف نمی‌دهد."
-    if (order.get("discount_code") or "").strip():
-        return False, None, "روی این سفارش قبلاً کد تخفیف ثبت شده است."
-
-    normalized = (code or "").strip().upper()
-    if not normalized:
-        return False, None, "کد تخفیف نامعتبر است."
-    discount = get_discount_by_code(normalized)
-    if not discount:
-        return False, None, "کد تخفیف یافت نشد."
-    if not discount.get("is_active"):
-        return False, None, "این کد تخفیف غیرفعال است."
-
-    try:
-        amount = int(discount.get("amount") or 0)
-    except (TypeError, ValueError):
-        amount = 0
-    if amount <= 0:
-        return False, None, "مبلغ تخفیف معتبر نیست."
-
-    limit = int(discount.get("usage_limit") or 0)
-    used = int(discount.get("used_count") or 0)
-    if limit and used >= limit:
-        return False, None, "ظرفیت استفاده از این کد تکمیل شده است."
-
-    expires_at = discount.get("expires_at")
-    if expires_at:
-        try:
-            expire_dt = datetime.fromisoformat(str(expires_at))
-            if datetime.now() > expire_dt:
-                return False, None, "تاریخ انقضای این کد گذشته است."
-        except ValueError:
-            pass
-
-    product_id = _order_product_id(order)
-    allowed_products = discount.get("product_ids") or []
-    if isinstance(allowed_products, str):
-        allowed_products = _parse_product_ids(allowed_products)
-
-    if (not discount.get("applies_all")) and allowed_products and product_id is not None:
-        if product_id not in allowed_products:
-            return False, None, "این کد برای محصول انتخاب‌شده معتبر نیست."
-
-    redemption = db_execute(
-        "SELECT id, times_used FROM discount_redemptions WHERE discount_id=? AND user_id=?",
-        (discount["id"], user_id),
-        fetchone=True,
-    )
-    per_user_limit = int(discount.get("usage_limit_per_user") or 1)
-    existing_uses = int(redemption.get("times_used") or 0) if redemption else 0
-    if per_user_limit and existing_uses >= per_user_limit:
-        return False, None, "سقف استفاده شما از این کد تکمیل شده است."
-
-    base_amount = int(order.get("amount_total") or order.get("price") or 0)
-    discount_value = min(max(amount, 0), max(base_amount, 0))
-    payable = max(base_amount - discount_value, 0)
-
-    now = datetime.now().isoformat(timespec="seconds")
-
-    db_execute(
-        """
-        UPDATE orders
-        SET discount_id=?, discount_code=?, discount_amount=?, updated_at=?
-        WHERE id=?
-        """,
-        (discount["id"], discount["code"], discount_value, now, order_id),
-    )
-
-    if redemption:
-        new_uses = existing_uses + 1
-        db_execute(
-            """
-            UPDATE discount_redemptions 
-            SET times_used=?, order_id=?, redeemed_at=?, status=? 
-            WHERE id=?
-            """,
-            (new_uses, order_id, now, "CONFIRMED", redemption["id"]),
-        )
-    else:
-        db_execute(
-            """
-            INSERT INTO discount_redemptions(
-                discount_id, user_id, order_id, amount, 
-                times_used, redeemed_at, status
-            ) VALUES(?,?,?,?,?,?,?)
-            """,
-            (discount["id"], user_id, order_id, discount_value, 1, now, "CONFIRMED"),
-        )
-
-    db_execute(
-        "UPDATE discounts SET used_count=used_count+1, updated_at=? WHERE id=?",
-        (now, discount["id"]),
-    )
-
-    return True, {"discount": discount_value, "payable": payable, "code": discount["code"]}, None
+    return redemption.apply_discount(order_id, user_id, code)
 
 
 # ====== Stats & History ======
 def get_user_stats(user_id: int):
     u = db_execute("SELECT * FROM users WHERE user_id=?", (user_id,), fetchone=True) or {}
-    total = db_execute("SELECT COUNT(*) AS c FROM orders WHERE user_id=?", (user_id,), fetchone=True)["c"]
+    orders = archive.source("orders")
+    total = db_execute(f"SELECT COUNT(*) AS c FROM {orders} WHERE user_id=?", (user_id,), fetchone=True)["c"]
     inprog = db_execute("""
         SELECT COUNT(*) AS c FROM orders
         WHERE user_id=? AND status IN ('PENDING_CONFIRM','PENDING_PLAN','APPROVED','IN_PROGRESS','READY_TO_DELIVER')
     """, (user_id,), fetchone=True)["c"]
-    done = db_execute("""
-        SELECT COUNT(*) AS c FROM orders
+    done = db_execute(f"""
+        SELECT COUNT(*) AS c FROM {orders}
         WHERE user_id=? AND status IN ('DELIVERED','COMPLETED')
     """, (user_id,), fetchone=True)["c"]
     return {
@@ -1320,7 +1134,9 @@ def get_user_stats(user_id: int):
         "orders_done": int(done or 0),
     }
 
-def list_orders_by_category(user_id: int, category: str, limit: int = 10, offset: int = 0):
+def list_orders_by_category(
+    user_id: int, category: str, limit: int = 10, offset: int = 0, *, before_id: int | None = None
+):
     where = "user_id=?"
     params = [user_id]
     if category == "inprog":
@@ -1331,8 +1147,14 @@ def list_orders_by_category(user_id: int, category: str, limit: int = 10, offset
         where += " AND 1=1"
     else:
         where += " AND 1=0"
-
-    sql = f"SELECT * FROM orders WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?"
+    if before_id is not None:
+        # نشانگر شناسه: صفحهٔ بعد از آخرین سفارش نمایش‌داده‌شده شروع می‌شود
+        where += " AND id<?"
+        params.append(before_id)
+        offset = 0
+
+    # تاریخچهٔ کاربر سفارش‌های بایگانی‌شده را هم نشان می‌دهد
+    sql = f"SELECT * FROM {archive.source('orders')} WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?"
     params += [limit, offset]
     return db_execute(sql, tuple(params), fetchall=True)
 
@@ -1347,7 +1169,7 @@ def count_orders_by_category(user_id: int, category: str):
         where += " AND 1=1"
     else:
         where += " AND 1=0"
-    sql = f"SELECT COUNT(*) AS c FROM orders WHERE {where}"
+    sql = f"SELECT COUNT(*) AS c FROM {archive.source('orders')} WHERE {where}"
     r = db_execute(sql, tuple(params), fetchone=True)
     return int(r["c"] if r else 0)
 
@@ -1394,22 +1216,115 @@ def _build_where(parts: Iterable[str]) -> str:
     return " AND ".join(clauses) if clauses else "1=1"
 
 
+# --- صفحه‌بندی کلیدی (keyset) -------------------------------------------------
+# فهرست‌ها از جدید به قدیم روی (created_at, key) مرتب‌اند و نشانگر صفحه
+# «created_at|key» آخرین یا اولین ردیف صفحهٔ فعلی است؛ هر صفحه یک seek روی
+# ایندکس است و عمق صفحه هزینه‌ای ندارد. نتایج رتبه‌دار FTS کلید پایدار ندارند
+# و با نشانگر «@offset» صفحه‌بندی می‌شوند.
+
+COUNT_CAP = 1000
+
+
+def _encode_cursor(row: dict[str, Any], key: str) -> str:
+    return f"{row.get('created_at') or ''}|{row[key]}"
+
+
+def _decode_cursor(token: str | None) -> tuple[str, int] | None:
+    if not token or "|" not in token:
+        return None
+    created_at, _, key = token.rpartition("|")
+    try:
+        return created_at, int(key)
+    except ValueError:
+        return None
+
+
+def _fetch_page(
+    select_sql: str,
+    where_parts: list[str],
+    params: list[Any],
+    *,
+    created_col: str,
+    key_col: str,
+    key: str,
+    rank_order: str | None = None,
+    cursor: str | None = None,
+    direction: str = "next",
+    limit: int = 20,
+) -> dict[str, Any]:
+    limit = max(int(limit), 1)
+    if rank_order:
+        offset = int(cursor[1:]) if cursor and cursor[1:].isdigit() and cursor.startswith("@") else 0
+        sql = f"{select_sql} WHERE {_build_where(where_parts)} ORDER BY {rank_order} LIMIT ? OFFSET ?"
+        rows = db_rows(sql, (*params, limit + 1, offset))
+        return {
+            "items": rows[:limit],
+            "next": f"@{offset + limit}" if len(rows) > limit else None,
+            "prev": f"@{max(offset - limit, 0)}" if offset > 0 else None,
+        }
+
+    position = _decode_cursor(cursor)
+    backwards = direction == "prev" and position is not None
+    parts = list(where_parts)
+    values = list(params)
+    if position is not None:
+        parts.append(f"({created_col}, {key_col}) {'>' if backwards else '<'} (?, ?)")
+        values.extend(position)
+    order = "ASC" if backwards else "DESC"
+    sql = (
+        f"{select_sql} WHERE {_build_where(parts)} "
+        f"ORDER BY {created_col} {order}, {key_col} {order} LIMIT ?"
+    )
+    rows = db_rows(sql, (*values, limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        if not has_more:
+            # به ابتدای فهرست رسیدیم؛ صفحهٔ اول را کامل نشان می‌دهیم
+            return _fetch_page(
+                select_sql, where_parts, params,
+                created_col=created_col, key_col=key_col, key=key, limit=limit,
+            )
+        rows.reverse()
+        return {
+            "items": rows,
+            "next": _encode_cursor(rows[-1], key),
+            "prev": _encode_cursor(rows[0], key),
+        }
+    return {
+        "items": rows,
+        "next": _encode_cursor(rows[-1], key) if has_more else None,
+        "prev": _encode_cursor(rows[0], key) if position is not None and rows else None,
+    }
+
+
+def _count(source: str, where_parts: list[str], params: list[Any], cap: int | None) -> int:
+    where_sql = _build_where(where_parts)
+    if cap:
+        # شمارش کامل روی جستجوهای پرنتیجه گران است؛ بیش از cap فقط «+cap» نمایش داده می‌شود
+        sql = f"SELECT COUNT(*) AS c FROM (SELECT 1 FROM {source} WHERE {where_sql} LIMIT {int(cap) + 1})"
+    else:
+        sql = f"SELECT COUNT(*) AS c FROM {source} WHERE {where_sql}"
+    result = db_execute(sql, tuple(params), fetchone=True)
+    return int(result["c"] if result else 0)
+
+
+def _counter(name: str) -> int:
+    return counters.value(get_connection(), name)
+
+
 def get_dashboard_snapshot():
     now = datetime.now()
-    last_7_days = (now - timedelta(days=7)).isoformat(timespec="seconds")
-    last_30_days = (now - timedelta(days=30)).isoformat(timespec="seconds")
+    # شمارنده‌ها با تریگر به‌روز می‌مانند؛ بازه‌های زمانی با دقت روز از order_daily خوانده می‌شوند
+    last_7_days = (now - timedelta(days=7)).date().isoformat()
+    last_30_days = (now - timedelta(days=30)).date().isoformat()
 
-    totals = db_execute(
-        "SELECT COUNT(*) AS total FROM orders",
-        fetchone=True,
-    ) or {"total": 0}
-    users = db_execute("SELECT COUNT(*) AS total FROM users", fetchone=True) or {"total": 0}
+    con = get_connection()
+    values = counters.read(con)
     status_counts = {
-        row["status"]: row["c"]
-        for row in db_execute(
-            "SELECT status, COUNT(*) AS c FROM orders GROUP BY status",
-            fetchall=True,
-        )
+        name.split(":", 1)[1]: value
+        for name, value in values.items()
+        if name.startswith("orders_status:") and value
     }
     awaiting = status_counts.get("AWAITING_PAYMENT", 0)
     pending = status_counts.get("PENDING_CONFIRM", 0)
@@ -1421,93 +1336,82 @@ def get_dashboard_snapshot():
         status_counts.get(code, 0)
         for code in ("DELIVERED", "COMPLETED")
     )
-
-    revenue_total = db_execute(
-        """
-        SELECT COALESCE(SUM(amount_total), 0) AS total
-        FROM orders
-        WHERE status IN ('APPROVED','IN_PROGRESS','READY_TO_DELIVER','DELIVERED','COMPLETED')
-        """,
-        fetchone=True,
-    )["total"]
-    revenue_30 = db_execute(
-        """
-        SELECT COALESCE(SUM(amount_total), 0) AS total
-        FROM orders
-        WHERE created_at >= ?
-    """,
-        (last_30_days,),
-        fetchone=True,
-    )["total"]
-    new_orders_week = db_execute(
-        "SELECT COUNT(*) AS c FROM orders WHERE created_at >= ?",
-        (last_7_days,),
-        fetchone=True,
-    )["c"]
-
+    new_orders_week, _ = counters.daily_totals(con, last_7_days)
+    _, revenue_30 = counters.daily_totals(con, last_30_days)
     wallet_totals = {
-        row["type"]: row["total"]
-        for row in db_execute(
-            "SELECT type, COALESCE(SUM(amount), 0) AS total FROM wallet_tx GROUP BY type",
-            fetchall=True,
-        )
+        name.split(":", 1)[1]: value
+        for name, value in values.items()
+        if name.startswith("wallet:")
     }
 
     return {
-        "orders_total": totals["total"],
-        "users_total": users["total"],
+        "orders_total": values.get("orders_total", 0),
+        "users_total": values.get("users_total", 0),
+        "messages_total": values.get("service_messages_total", 0),
         "awaiting_payment": awaiting,
         "pending_confirm": pending,
         "in_queue": in_queue,
         "delivered": delivered,
-        "revenue_total": revenue_total or 0,
-        "revenue_30_days": revenue_30 or 0,
-        "new_orders_week": new_orders_week or 0,
+        "revenue_total": values.get("orders_revenue", 0),
+        "revenue_30_days": revenue_30,
+        "new_orders_week": new_orders_week,
         "wallet_totals": wallet_totals,
         "status_counts": status_counts,
     }
 
 
+# --- ستون‌های فهرست‌ها ----------------------------------------------------------
+# فهرست‌ها فقط ستون‌هایی را می‌خوانند که جدول‌های پنل نشان می‌دهند (نه ۴۰ ستون orders)
+# و ردیف‌ها تاپل فقط‌خواندنی از app/rows.py هستند؛ برای تغییر، dict(row) بسازید.
+
+ORDER_LIST_COLUMNS = (
+    "id", "user_id", "username", "first_name", "plan_title", "service_code", "customer_email",
+    "amount_total", "price", "status", "created_at", "updated_at",
+)
+USER_LIST_COLUMNS = (
+    "user_id", "username", "first_name", "contact_phone", "wallet_balance", "ref_count", "created_at",
+)
+WALLET_TX_LIST_COLUMNS = ("id", "user_id", "order_id", "type", "amount", "note", "created_at")
+
+
+def _select(table: str, columns: Iterable[str]) -> str:
+    return ", ".join(f"{table}.{column}" for column in columns)
+
+
 def list_recent_orders(limit: int = 8):
-    return db_execute(
-        "SELECT * FROM orders ORDER BY created_at DESC LIMIT ?",
+    return db_rows(
+        f"SELECT {_select('orders', ORDER_LIST_COLUMNS)} FROM orders ORDER BY created_at DESC LIMIT ?",
         (limit,),
-        fetchall=True,
     )
 
 
 def list_recent_users(limit: int = 6):
-    return db_execute(
-        "SELECT * FROM users ORDER BY created_at DESC LIMIT ?",
+    return db_rows(
+        f"SELECT {_select('users', USER_LIST_COLUMNS)} FROM users ORDER BY created_at DESC LIMIT ?",
         (limit,),
-        fetchall=True,
     )
 
 
 def list_recent_wallet_tx(limit: int = 10):
-    return db_execute(
-        "SELECT * FROM wallet_tx ORDER BY created_at DESC LIMIT ?",
+    return db_rows(
+        f"SELECT {_select('wallet_tx', WALLET_TX_LIST_COLUMNS)} FROM wallet_tx ORDER BY created_at DESC LIMIT ?",
         (limit,),
-        fetchall=True,
     )
 
 
-def list_orders(
-    *,
-    status: str | None = None,
-    search: str | None = None,
-    limit: int = 20,
-    offset: int = 0,
-    user_id: int | None = None,
-):
+def _order_filters(
+    status: str | None, search: str | None, user_id: int | None
+) -> tuple[str, list[str], list[Any], bool]:
+    source = "orders"
     where_parts: list[str] = []
     params: list[Any] = []
+    ranked = False
 
     if user_id is not None:
-        where_parts.append("user_id=?")
+        where_parts.append("orders.user_id=?")
         params.append(user_id)
     if status and status != "all":
-        where_parts.append("status=?")
+        where_parts.append("orders.status=?")
         params.append(status)
 
     if search:
@@ -1515,94 +1419,149 @@ def list_orders(
         if term.startswith("#"):
             term = term[1:]
         if term.isdigit():
-            where_parts.append("id=?")
+            where_parts.append("orders.id=?")
             params.append(int(term))
+        elif (match := fts.match_query(term)) is not None:
+            source = "orders JOIN orders_fts ON orders_fts.rowid=orders.id"
+            where_parts.append("orders_fts MATCH ?")
+            params.append(match)
+            ranked = True
         else:
-            like = f"%{term.lower()}%"
-            where_parts.append(
-                "(LOWER(username) LIKE ? OR LOWER(first_name) LIKE ? OR LOWER(plan_title) LIKE ? OR LOWER(customer_email) LIKE ?)"
+            clause, like_params = fts.like_clause(
+                ("orders.username", "orders.first_name", "orders.plan_title", "orders.customer_email"), term
             )
-            params.extend([like, like, like, like])
+            where_parts.append(clause)
+            params.extend(like_params)
+    return source, where_parts, params, ranked
+
 
+def list_orders(
+    *,
+    status: str | None = None,
+    search: str | None = None,
+    limit: int = 20,
+    offset: int = 0,
+    user_id: int | None = None,
+):
+    source, where_parts, params, ranked = _order_filters(status, search, user_id)
     where_sql = _build_where(where_parts)
-    sql = f"SELECT * FROM orders WHERE {where_sql} ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    order_sql = "orders_fts.rank, orders.created_at DESC, orders.id DESC" if ranked else "orders.created_at DESC, orders.id DESC"
+    sql = f"SELECT {_select('orders', ORDER_LIST_COLUMNS)} FROM {source} WHERE {where_sql} ORDER BY {order_sql} LIMIT ? OFFSET ?"
     params.extend([limit, offset])
-    return db_execute(sql, tuple(params), fetchall=True)
+    return db_rows(sql, tuple(params))
 
 
-def count_orders(status: str | None = None, search: str | None = None, user_id: int | None = None) -> int:
-    where_parts: list[str] = []
-    params: list[Any] = []
-    if user_id is not None:
-        where_parts.append("user_id=?")
-        params.append(user_id)
-    if status and status != "all":
-        where_parts.append("status=?")
-        params.append(status)
-    if search:
-        term = search.strip()
-        if term.startswith("#"):
-            term = term[1:]
-        if term.isdigit():
-            where_parts.append("id=?")
-            params.append(int(term))
-        else:
-            like = f"%{term.lower()}%"
-            where_parts.append(
-                "(LOWER(username) LIKE ? OR LOWER(first_name) LIKE ? OR LOWER(plan_title) LIKE ? OR LOWER(customer_email) LIKE ?)"
-            )
-            params.extend([like, like, like, like])
+def list_orders_page(
+    *,
+    status: str | None = None,
+    search: str | None = None,
+    user_id: int | None = None,
+    cursor: str | None = None,
+    direction: str = "next",
+    limit: int = 20,
+) -> dict[str, Any]:
+    source, where_parts, params, ranked = _order_filters(status, search, user_id)
+    return _fetch_page(
+        f"SELECT {_select('orders', ORDER_LIST_COLUMNS)} FROM {source}",
+        where_parts,
+        params,
+        created_col="orders.created_at",
+        key_col="orders.id",
+        key="id",
+        rank_order="orders_fts.rank, orders.id DESC" if ranked else None,
+        cursor=cursor,
+        direction=direction,
+        limit=limit,
+    )
 
-    where_sql = _build_where(where_parts)
-    sql = f"SELECT COUNT(*) AS c FROM orders WHERE {where_sql}"
-    result = db_execute(sql, tuple(params), fetchone=True)
-    return int(result["c"] if result else 0)
+
+def count_orders(
+    status: str | None = None,
+    search: str | None = None,
+    user_id: int | None = None,
+    *,
+    cap: int | None = None,
+) -> int:
+    if not search and user_id is None:
+        # فهرست فقط جدول اصلی را می‌خواند؛ سفارش‌های بایگانی‌شده از جمع کم می‌شوند
+        name = "orders_total" if not status or status == "all" else f"orders_status:{status}"
+        return counters.hot_value(get_connection(), name)
+    source, where_parts, params, _ = _order_filters(status, search, user_id)
+    return _count(source, where_parts, params, cap)
 
 
-def update_order_notes(order_id: int, notes: str) -> None:
-    set_order_manager_note(order_id, notes)
+def update_order_notes(order_id: int, notes: str):
+    return set_order_manager_note(order_id, notes)
 
 
 def list_wallet_tx_for_order(order_id: int) -> list[dict[str, Any]]:
     return db_execute(
-        "SELECT * FROM wallet_tx WHERE order_id=? ORDER BY created_at DESC",
+        f"SELECT * FROM {archive.source('wallet_tx')} WHERE order_id=? ORDER BY created_at DESC",
         (order_id,),
         fetchall=True,
     )
 
 
-def list_users(search: str | None = None, limit: int = 20, offset: int = 0):
+def _user_filters(search: str | None) -> tuple[str, list[str], list[Any], bool]:
+    source = "users"
     where_parts: list[str] = []
     params: list[Any] = []
+    ranked = False
     if search:
         term = search.strip()
-        like = f"%{term.lower()}%"
+        match = fts.match_query(term)
         if term.isdigit():
-            where_parts.append("user_id=?")
-            params.append(int(term))
-        where_parts.append("(LOWER(username) LIKE ? OR LOWER(first_name) LIKE ?)")
-        params.extend([like, like])
+            # آیدی عددی یا بخشی از شماره تلفن
+            if match is not None:
+                where_parts.append("(users.user_id=? OR users.user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?))")
+                params.extend([int(term), match])
+            else:
+                where_parts.append("users.user_id=?")
+                params.append(int(term))
+        elif match is not None:
+            source = "users JOIN users_fts ON users_fts.rowid=users.user_id"
+            where_parts.append("users_fts MATCH ?")
+            params.append(match)
+            ranked = True
+        else:
+            clause, like_params = fts.like_clause(("users.username", "users.first_name"), term)
+            where_parts.append(clause)
+            params.extend(like_params)
+    return source, where_parts, params, ranked
+
+
+def list_users(search: str | None = None, limit: int = 20, offset: int = 0):
+    source, where_parts, params, ranked = _user_filters(search)
     where_sql = _build_where(where_parts)
-    sql = f"SELECT * FROM users WHERE {where_sql} ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    order_sql = "users_fts.rank, users.created_at DESC" if ranked else "users.created_at DESC, users.user_id DESC"
+    sql = f"SELECT {_select('users', USER_LIST_COLUMNS)} FROM {source} WHERE {where_sql} ORDER BY {order_sql} LIMIT ? OFFSET ?"
     params.extend([limit, offset])
-    return db_execute(sql, tuple(params), fetchall=True)
+    return db_rows(sql, tuple(params))
+
+
+def list_users_page(
+    search: str | None = None, *, cursor: str | None = None, direction: str = "next", limit: int = 20
+) -> dict[str, Any]:
+    source, where_parts, params, ranked = _user_filters(search)
+    return _fetch_page(
+        f"SELECT {_select('users', USER_LIST_COLUMNS)} FROM {source}",
+        where_parts,
+        params,
+        created_col="users.created_at",
+        key_col="users.user_id",
+        key="user_id",
+        rank_order="users_fts.rank, users.user_id DESC" if ranked else None,
+        cursor=cursor,
+        direction=direction,
+        limit=limit,
+    )
 
 
-def count_users(search: str | None = None) -> int:
-    where_parts: list[str] = []
-    params: list[Any] = []
-    if search:
-        term = search.strip()
-        like = f"%{term.lower()}%"
-        if term.isdigit():
-            where_parts.append("user_id=?")
-            params.append(int(term))
-        where_parts.append("(LOWER(username) LIKE ? OR LOWER(first_name) LIKE ?)")
-        params.extend([like, like])
-    where_sql = _build_where(where_parts)
-    sql = f"SELECT COUNT(*) AS c FROM users WHERE {where_sql}"
-    result = db_execute(sql, tuple(params), fetchone=True)
-    return int(result["c"] if result else 0)
+def count_users(search: str | None = None, *, cap: int | None = None) -> int:
+    if not search:
+        return _counter("users_total")
+    source, where_parts, params, _ = _user_filters(search)
+    return _count(source, where_parts, params, cap)
 
 
 def set_user_blocked(user_id: int, blocked: bool) -> None:
@@ -1613,33 +1572,28 @@ def set_user_blocked(user_id: int, blocked: bool) -> None:
 
 
 def is_user_blocked(user_id: int) -> bool:
-    user = get_user(user_id)
-    if not user:
-        return False
-    return bool(int(user.get("is_blocked") or 0))
+    # پنل وب در پروسهٔ دیگری کاربر را مسدود می‌کند و کش این پروسه خبردار نمی‌شود
+    row = db_execute("SELECT is_blocked FROM users WHERE user_id=?", (user_id,), fetchone=True)
+    return bool(int((row or {}).get("is_blocked") or 0))
 
 
 def list_wallet_tx_for_user(user_id: int, limit: int = 20):
-    return db_execute(
-        "SELECT * FROM wallet_tx WHERE user_id=? ORDER BY created_at DESC LIMIT ?",
+    return db_rows(
+        f"SELECT {_select('wallet_tx', WALLET_TX_LIST_COLUMNS)} FROM {archive.source('wallet_tx')} "
+        "WHERE user_id=? ORDER BY created_at DESC LIMIT ?",
         (user_id, limit),
-        fetchall=True,
     )
 
 
 def get_wallet_summary():
-    totals = db_execute(
-        "SELECT type, COALESCE(SUM(amount), 0) AS total FROM wallet_tx GROUP BY type",
-        fetchall=True,
-    )
-    by_type = {row["type"]: row["total"] for row in totals}
-    balance_total = db_execute(
-        "SELECT COALESCE(SUM(wallet_balance), 0) AS total FROM users",
-        fetchone=True,
-    )["total"]
+    values = counters.read(get_connection())
     return {
-        "by_type": by_type,
-        "user_balances": balance_total or 0,
+        "by_type": {
+            name.split(":", 1)[1]: value
+            for name, value in values.items()
+            if name.startswith("wallet:")
+        },
+        "user_balances": values.get("user_balances", 0),
     }
 
 
@@ -1671,33 +1625,82 @@ def create_service_message(
     )
 
 
+def _service_message_filters(
+    category: str | None, search: str | None
+) -> tuple[str, list[str], list[Any], bool]:
+    source = "service_messages"
+    where_parts: list[str] = []
+    params: list[Any] = []
+    ranked = False
+    if category:
+        where_parts.append("service_messages.category=?")
+        params.append(category)
+    if search and search.strip():
+        term = search.strip()
+        match = fts.match_query(term)
+        if match is not None:
+            source = "service_messages JOIN service_messages_fts ON service_messages_fts.rowid=service_messages.id"
+            where_parts.append("service_messages_fts MATCH ?")
+            params.append(match)
+            ranked = True
+        else:
+            clause, like_params = fts.like_clause(
+                ("service_messages.username", "service_messages.first_name", "service_messages.message_text"), term
+            )
+            where_parts.append(clause)
+            params.extend(like_params)
+    return source, where_parts, params, ranked
+
+
 def list_service_messages(
     *,
     category: str | None = None,
+    search: str | None = None,
     limit: int = 20,
     offset: int = 0,
 ) -> list[dict[str, Any]]:
-    where_parts: list[str] = []
-    params: list[Any] = []
-    if category:
-        where_parts.append("category=?")
-        params.append(category)
+    source, where_parts, params, ranked = _service_message_filters(category, search)
     where_sql = _build_where(where_parts)
-    sql = f"SELECT * FROM service_messages WHERE {where_sql} ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    order_sql = (
+        "service_messages_fts.rank, service_messages.created_at DESC"
+        if ranked
+        else "service_messages.created_at DESC, service_messages.id DESC"
+    )
+    sql = f"SELECT service_messages.* FROM {source} WHERE {where_sql} ORDER BY {order_sql} LIMIT ? OFFSET ?"
     params.extend([limit, offset])
     return db_execute(sql, tuple(params), fetchall=True)
 
 
-def count_service_messages(category: str | None = None) -> int:
-    where_parts: list[str] = []
-    params: list[Any] = []
-    if category:
-        where_parts.append("category=?")
-        params.append(category)
-    where_sql = _build_where(where_parts)
-    sql = f"SELECT COUNT(*) AS c FROM service_messages WHERE {where_sql}"
-    result = db_execute(sql, tuple(params), fetchone=True)
-    return int(result["c"] if result else 0)
+def list_service_messages_page(
+    *,
+    category: str | None = None,
+    search: str | None = None,
+    cursor: str | None = None,
+    direction: str = "next",
+    limit: int = 20,
+) -> dict[str, Any]:
+    source, where_parts, params, ranked = _service_message_filters(category, search)
+    return _fetch_page(
+        f"SELECT service_messages.* FROM {source}",
+        where_parts,
+        params,
+        created_col="service_messages.created_at",
+        key_col="service_messages.id",
+        key="id",
+        rank_order="service_messages_fts.rank, service_messages.id DESC" if ranked else None,
+        cursor=cursor,
+        direction=direction,
+        limit=limit,
+    )
+
+
+def count_service_messages(
+    category: str | None = None, search: str | None = None, *, cap: int | None = None
+) -> int:
+    if not category and not (search and search.strip()):
+        return _counter("service_messages_total")
+    source, where_parts, params, _ = _service_message_filters(category, search)
+    return _count(source, where_parts, params, cap)
 
 
 def get_service_message(message_id: int) -> dict[str, Any] | None:
@@ -1743,23 +1746,35 @@ def set_service_message_status(message_id: int, resolved: bool) -> None:
 
 
 def list_products(parent_id: int | None = None) -> list[dict[str, Any]]:
-    return db_execute(
-        """
-        SELECT * FROM products
-        WHERE COALESCE(parent_id, 0)=COALESCE(?, 0)
-        ORDER BY sort_order ASC, title ASC
-        """,
-        (parent_id,),
-        fetchall=True,
+    return cache.cached(
+        ("products", parent_id),
+        lambda: db_execute(
+            """
+            SELECT * FROM products
+            WHERE COALESCE(parent_id, 0)=COALESCE(?, 0)
+            ORDER BY sort_order ASC, title ASC
+            """,
+            (parent_id,),
+            fetchall=True,
+        ),
+        cache.CATALOG_TAGS,
     )
 
 
 def list_all_products() -> list[dict[str, Any]]:
-    return db_execute("SELECT * FROM products ORDER BY sort_order ASC, title ASC", fetchall=True)
+    return cache.cached(
+        ("products", "*"),
+        lambda: db_execute("SELECT * FROM products ORDER BY sort_order ASC, title ASC", fetchall=True),
+        cache.CATALOG_TAGS,
+    )
 
 
 def get_product(product_id: int) -> dict[str, Any] | None:
-    return db_execute("SELECT * FROM products WHERE id=?", (product_id,), fetchone=True)
+    return cache.cached(
+        ("product", product_id),
+        lambda: db_execute("SELECT * FROM products WHERE id=?", (product_id,), fetchone=True),
+        cache.CATALOG_TAGS,
+    )
 
 
 def has_sort_conflict(
@@ -1939,30 +1954,7 @@ def delete_product(product_id: int) -> None:
 
 def remove_order_discount(order_id: int) -> bool:
     """Removes discount from an order and cleans up redemption records."""
-    order = get_order(order_id)
-    if not order:
-        return False
-    
-    discount_id = order.get("discount_id")
-    if not discount_id:
-        return True  # قبلاً تخفیف نداشته
-
-    # 1. حذف رکورد استفاده از جدول discount_redemptions
-    db_execute("DELETE FROM discount_redemptions WHERE order_id=?", (order_id,))
-
-    # 2. کاهش شمارنده استفاده در جدول discounts
-    db_execute("UPDATE discounts SET used_count = MAX(0, used_count - 1) WHERE id=?", (discount_id,))
-
-    # 3. صفر کردن فیلدهای تخفیف در جدول orders
-    db_execute(
-        """
-        UPDATE orders 
-        SET discount_id=NULL, discount_code='', discount_amount=0, updated_at=?
-        WHERE id=?
-        """,
-        (datetime.now().isoformat(timespec="seconds"), order_id)
-    )
-    return True
+    return redemption.release_discount(order_id)
 
 # در فایل app/db.py اضافه شود
 
@@ -0,0 +1,246 @@
+"""Long-lived SQLite connections shared by the ``app.db`` helpers.
+
+Every thread gets its own connection which is opened once, configured once
+(WAL, busy timeout, cache sizes) and then reused for every statement.  The
+``sqlite3`` statement cache keeps prepared statements around per connection,
+so hot queries are compiled only once per thread.
+
+A caller can mark its context with :func:`read_from_snapshot`; reads made
+from it outside a transaction then go to the read-only copy that
+:mod:`app.snapshot` registers with :func:`set_snapshot_source`.  Writes and
+transactions always use the thread's own connection.
+"""
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Iterator
+
+from .config import (
+    ARCHIVE_DB_PATH,
+    DB_BUSY_TIMEOUT_MS,
+    DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE,
+    DB_PATH,
+    DB_STATEMENT_CACHE,
+    DB_SYNCHRONOUS,
+)
+
+logger = logging.getLogger(__name__)
+
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+_local = threading.local()
+_registry_lock = threading.Lock()
+_connections: dict[int, sqlite3.Connection] = {}
+# close_all_connections آن را بالا می‌برد تا نخ‌های دیگر اتصال بسته‌شدهٔ خود را کنار بگذارند
+_generation = 0
+_drain_hook: Callable[[], None] | None = None
+_snapshot_source: Callable[[], sqlite3.Connection | None] | None = None
+# repository.py توابع را با copy_context روی نخ‌ها اجرا می‌کند، پس این علامت همراه فراخوانی می‌رود
+_snapshot_reads: ContextVar[bool] = ContextVar("db_snapshot_reads", default=False)
+
+
+def _synchronous() -> str:
+    synchronous = (DB_SYNCHRONOUS or "").strip().upper()
+    return synchronous if synchronous in _SYNCHRONOUS_MODES else "NORMAL"
+
+
+def _apply_pragmas(con: sqlite3.Connection) -> None:
+    synchronous = _synchronous()
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute(f"PRAGMA busy_timeout={max(int(DB_BUSY_TIMEOUT_MS), 0)};")
+    con.execute(f"PRAGMA synchronous={synchronous};")
+    con.execute(f"PRAGMA cache_size=-{max(int(DB_CACHE_SIZE_KB), 0)};")
+    con.execute(f"PRAGMA mmap_size={max(int(DB_MMAP_SIZE), 0)};")
+    con.execute("PRAGMA temp_store=MEMORY;")
+    # دیتابیس‌های قدیمی کلید خارجی ناسازگار دارند؛ مثل قبل چک کلید خارجی خاموش می‌ماند
+    con.execute("PRAGMA foreign_keys=OFF;")
+
+
+def open_connection(path: str | None = None) -> sqlite3.Connection:
+    db_path = Path(path or DB_PATH)
+    parent = db_path.parent
+    if parent and str(parent) not in {"", "."}:
+        parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(
+        str(db_path),
+        timeout=max(int(DB_BUSY_TIMEOUT_MS), 0) / 1000,
+        cached_statements=max(int(DB_STATEMENT_CACHE), 0),
+        check_same_thread=False,
+    )
+    con.row_factory = sqlite3.Row
+    _apply_pragmas(con)
+    if path is None and ARCHIVE_DB_PATH:
+        # بایگانی سفارش‌های سرد (app/archive.py) در همهٔ اتصال‌ها با نام archive در دسترس است
+        con.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+        con.execute("PRAGMA archive.journal_mode=WAL;")
+        con.execute(f"PRAGMA archive.synchronous={_synchronous()};")
+    return con
+
+
+def set_drain_hook(hook: Callable[[], None] | None) -> None:
+    """Register a callback run before a thread uses its connection outside a transaction.
+
+    The write coalescer uses it to land queued writes before anyone reads.
+    """
+
+    global _drain_hook
+    _drain_hook = hook
+
+
+def set_snapshot_source(source: Callable[[], sqlite3.Connection | None] | None) -> None:
+    """Register where snapshot reads go; ``source`` may return ``None`` to fall back to the primary."""
+
+    global _snapshot_source
+    _snapshot_source = source
+
+
+def read_from_snapshot(enabled: bool = True) -> None:
+    """Route the current context's reads to the snapshot (for the rest of the context)."""
+
+    _snapshot_reads.set(enabled)
+
+
+def reading_snapshot() -> bool:
+    return _snapshot_source is not None and _snapshot_reads.get() and not getattr(_local, "tx_depth", 0)
+
+
+def get_connection(*, primary: bool = False) -> sqlite3.Connection:
+    """Return the connection owned by the calling thread, opening it on first use.
+
+    In a context marked with :func:`read_from_snapshot` it returns the
+    snapshot connection instead, unless ``primary`` is set (writes).
+    """
+
+    if not primary and reading_snapshot():
+        con = _snapshot_source()
+        if con is not None:
+            return con
+    hook = _drain_hook
+    if hook is not None and not getattr(_local, "tx_depth", 0):
+        hook()
+    con = getattr(_local, "con", None)
+    if con is not None and getattr(_local, "generation", None) != _generation:
+        # close_all_connections از نخ دیگری این اتصال را بسته است
+        con = _local.con = None
+        _local.tx_depth = 0
+    if con is None:
+        con = open_connection()
+        with _registry_lock:
+            _connections[threading.get_ident()] = con
+            _local.generation = _generation
+        _local.con = con
+        _local.tx_depth = 0
+    return con
+
+
+def close_connection() -> None:
+    con = getattr(_local, "con", None)
+    if con is None:
+        return
+    _local.con = None
+    _local.tx_depth = 0
+    with _registry_lock:
+        _connections.pop(threading.get_ident(), None)
+    try:
+        con.close()
+    except sqlite3.Error:
+        logger.exception("Failed to close SQLite connection")
+
+
+def close_all_connections() -> None:
+    """Close every pooled connection (used on shutdown).
+
+    Threads that are still alive open a fresh connection on their next call
+    instead of using the closed one.
+    """
+
+    global _generation
+    with _registry_lock:
+        items = list(_connections.values())
+        _connections.clear()
+        _generation += 1
+    _local.con = None
+    _local.tx_depth = 0
+    for con in items:
+        try:
+            con.close()
+        except sqlite3.Error:
+            logger.exception("Failed to close SQLite connection")
+
+
+def in_transaction() -> bool:
+    return getattr(_local, "tx_depth", 0) > 0
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """Run ``callback`` once the thread's outermost transaction commits (dropped on rollback)."""
+
+    if not in_transaction():
+        callback()
+        return
+    pending = getattr(_local, "after_commit", None)
+    if pending is None:
+        pending = _local.after_commit = []
+    pending.append(callback)
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Run a block of statements atomically on the thread's connection.
+
+    ``BEGIN IMMEDIATE`` takes the write lock up front so read-check-write
+    sequences inside the block cannot interleave with another writer.
+    Nested blocks become savepoints of the outermost transaction.
+    """
+
+    con = get_connection(primary=True)
+    depth = getattr(_local, "tx_depth", 0)
+    savepoint = f"sp_{depth}"
+    if depth == 0:
+        if con.in_transaction:
+            con.rollback()
+        con.execute("BEGIN IMMEDIATE")
+    else:
+        con.execute(f"SAVEPOINT {savepoint}")
+    _local.tx_depth = depth + 1
+    try:
+        yield con
+    except BaseException:
+        _local.tx_depth = depth
+        if depth == 0:
+            _local.after_commit = None
+            if con.in_transaction:
+                con.rollback()
+        else:
+            con.execute(f"ROLLBACK TO {savepoint}")
+            con.execute(f"RELEASE {savepoint}")
+        raise
+    _local.tx_depth = depth
+    if depth == 0:
+        con.commit()
+        callbacks, _local.after_commit = getattr(_local, "after_commit", None), None
+        for callback in callbacks or ():
+            callback()
+    else:
+        con.execute(f"RELEASE {savepoint}")
+
+
+__all__ = [
+    "after_commit",
+    "close_all_connections",
+    "close_connection",
+    "get_connection",
+    "in_transaction",
+    "open_connection",
+    "read_from_snapshot",
+    "reading_snapshot",
+    "set_drain_hook",
+    "set_snapshot_source",
+    "transaction",
+]
@@ -0,0 +1,145 @@
+"""Per-user ordered, concurrent processing of Telegram updates.
+
+aiogram's polling either handles updates one at a time or starts a task per
+update.  One at a time lets a slow checkout (receipt upload, admin fan-out)
+hold up every other user; a task per update lets two quick callbacks of the
+same user race on their FSM state and order rows.
+
+:class:`OrderedDispatcher` hashes every update by ``from_user.id`` (the chat
+id when there is no user) into one of ``DISPATCH_WORKERS`` queues, each
+drained by a single worker task.  Updates of one user are therefore handled
+strictly in arrival order, and different users run in parallel.  Users that
+share a queue also share its order, so a very slow handler delays roughly
+``1 / DISPATCH_WORKERS`` of the other users, not all of them.
+
+``feed_update`` only enqueues, and it waits while ``DISPATCH_MAX_PENDING``
+updates are queued or running.  Polling (with ``handle_as_tasks=False``)
+then stops fetching, and the webhook runs into ``WEBHOOK_MAX_PENDING`` and
+answers 503.  The limit is shared by all queues on purpose: a per-queue
+limit would let one slow user's full queue stop the intake for everybody.  ``emit_shutdown`` lets the queues run empty before the
+dispatcher's own shutdown closes the FSM storage.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+
+from .config import DISPATCH_MAX_PENDING, DISPATCH_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+def _user_key(update: Update) -> int:
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.user is not None:
+        return context.user.id
+    if context.chat is not None:
+        return context.chat.id
+    # آپدیت بدون کاربر و چت (مثلاً نظرسنجی) به ترتیب نیاز ندارد
+    return update.update_id
+
+
+class OrderedDispatcher(Dispatcher):
+    def __init__(
+        self,
+        *,
+        workers: int = DISPATCH_WORKERS,
+        max_pending: int = DISPATCH_MAX_PENDING,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.workers = max(int(workers), 0)
+        self.max_pending = max(int(max_pending), 1)
+        self._queues: list[asyncio.Queue] = []
+        self._slots: asyncio.Semaphore | None = None
+        self._workers: list[asyncio.Task] = []
+        self.enqueued = 0
+        self.handled = 0
+        self.failed = 0
+        self.blocked = 0
+        self._wait_seconds = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def ordered(self) -> bool:
+        return self.workers > 0
+
+    def _start(self) -> None:
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._workers = [
+            asyncio.create_task(self._work(queue), name=f"dispatch-{i}") for i, queue in enumerate(self._queues)
+        ]
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        if not self.ordered:
+            return await super().feed_update(bot, update, **kwargs)
+        if not self._workers:
+            self._start()
+        if self._slots.locked():
+            # به سقف آپدیت‌های در جریان رسیده‌ایم؛ دریافت‌کننده تا آزاد شدن جا منتظر می‌ماند
+            self.blocked += 1
+        await self._slots.acquire()
+        self._queues[_user_key(update) % self.workers].put_nowait((time.monotonic(), bot, update, kwargs))
+        self.enqueued += 1
+        return None
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while True:
+            queued_at, bot, update, kwargs = await queue.get()
+            waited = time.monotonic() - queued_at
+            self._wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+            try:
+                await super().feed_update(bot, update, **kwargs)
+            except Exception:
+                self.failed += 1
+                logger.exception("update %s failed", update.update_id)
+            finally:
+                self.handled += 1
+                self._slots.release()
+                queue.task_done()
+
+    async def drain(self, timeout: float = 30.0) -> None:
+        """Wait until every queued update is handled (at most ``timeout`` seconds), then stop the workers."""
+
+        workers, self._workers = self._workers, []
+        if not workers:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("dropping %s queued updates at shutdown", sum(q.qsize() for q in self._queues))
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def emit_shutdown(self, *args: Any, **kwargs: Any) -> None:
+        # هندلرهای در صف هنوز به FSM نیاز دارند؛ shutdown خود Dispatcher آن را می‌بندد
+        await self.drain()
+        await super().emit_shutdown(*args, **kwargs)
+
+    def stats(self) -> dict[str, Any]:
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": sum(depths),
+            "max_depth": max(depths, default=0),
+            "depths": depths,
+            "enqueued": self.enqueued,
+            "handled": self.handled,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "avg_wait_ms": round(self._wait_seconds / self.handled * 1000, 2) if self.handled else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+        }
+
+
+__all__ = ["OrderedDispatcher"]
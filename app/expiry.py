@@ -0,0 +1,189 @@
+"""Deadline-driven expiry of unpaid orders.
+
+The scheduler keeps every ``AWAITING_PAYMENT`` deadline in a min-heap and
+sleeps until the earliest one, so an order expires at its deadline instead
+of on the next poll, and an idle bot issues no queries at all.
+
+Deadlines come from the database at startup and from
+:func:`app.db.add_deadline_listener`, which ``create_order`` and
+``refresh_order_deadline`` notify after commit (from whichever worker
+thread ran them).  A refreshed deadline simply pushes a newer heap entry;
+the older entry is recognised as stale when it surfaces.  The actual expiry
+is still ``expire_orders_and_refund``, which re-checks status and deadline
+in the database, so a wake-up for an order that was paid or extended
+meanwhile does nothing.  ``EXPIRY_RESYNC_SECONDS`` reloads the heap from the
+database now and then, to pick up deadlines written by another process.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from . import db
+from .config import EXPIRY_RESYNC_SECONDS
+from .repository import repo
+
+logger = logging.getLogger(__name__)
+
+# تایمرهای asyncio ممکن است کمی زودتر بیدار شوند؛ مهلت‌ها دقت ثانیه دارند
+_GRACE_SECONDS = 0.05
+_RETRY_SECONDS = 5.0
+
+ExpiredCallback = Callable[[list[dict[str, Any]]], Awaitable[None]]
+
+
+def _timestamp(deadline: str) -> float | None:
+    try:
+        return datetime.fromisoformat(str(deadline).strip()).timestamp()
+    except ValueError:
+        return None
+
+
+class ExpiryScheduler:
+    def __init__(self, on_expired: ExpiredCallback | None = None, resync_seconds: float = EXPIRY_RESYNC_SECONDS) -> None:
+        self.on_expired = on_expired
+        self.resync_seconds = float(resync_seconds)
+        self._heap: list[tuple[float, int]] = []
+        self._deadlines: dict[int, float] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.fired = 0
+        self.expired = 0
+
+    # --- زمان‌بندی --------------------------------------------------------------
+
+    def schedule(self, order_id: int, deadline: str) -> None:
+        """Track ``deadline`` for ``order_id``; safe to call from any thread."""
+
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        ts = _timestamp(deadline)
+        if ts is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._push(int(order_id), ts)
+        else:
+            loop.call_soon_threadsafe(self._push, int(order_id), ts)
+
+    def _push(self, order_id: int, ts: float) -> None:
+        self._deadlines[order_id] = ts
+        heapq.heappush(self._heap, (ts, order_id))
+        if self._wakeup is not None and self._heap[0] == (ts, order_id):
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> list[int]:
+        due: list[int] = []
+        while self._heap and self._heap[0][0] <= now:
+            ts, order_id = heapq.heappop(self._heap)
+            # مهلت تمدیدشده ورودی تازه‌تری دارد؛ ورودی قدیمی نادیده گرفته می‌شود
+            if self._deadlines.get(order_id) != ts:
+                continue
+            del self._deadlines[order_id]
+            due.append(order_id)
+        return due
+
+    def _next_delay(self) -> float | None:
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.time() + _GRACE_SECONDS, 0.0)
+
+    async def _load(self) -> None:
+        rows = await repo.list_payment_deadlines()
+        self._heap = []
+        self._deadlines = {}
+        for row in rows:
+            ts = _timestamp(row.get("await_deadline") or "")
+            if ts is not None:
+                self._deadlines[int(row["id"])] = ts
+                self._heap.append((ts, int(row["id"])))
+        heapq.heapify(self._heap)
+
+    # --- اجرا -------------------------------------------------------------------
+
+    async def _fire(self, order_ids: list[int]) -> None:
+        self.fired += 1
+        try:
+            expired = await repo.expire_orders_and_refund()
+        except Exception:
+            logger.exception("expiry failed for orders %s; retrying", order_ids)
+            retry_at = time.time() + _RETRY_SECONDS
+            for order_id in order_ids:
+                self._push(order_id, retry_at)
+            return
+        self.expired += len(expired)
+        if expired:
+            logger.info("Expired orders: %s", [o["id"] for o in expired])
+            if self.on_expired is not None:
+                try:
+                    await self.on_expired(expired)
+                except Exception:
+                    logger.exception("expiry callback failed")
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        db.add_deadline_listener(self.schedule)
+        try:
+            await self._load()
+            resync_at = time.monotonic() + self.resync_seconds if self.resync_seconds > 0 else None
+            while True:
+                due = self._pop_due(time.time())
+                if due:
+                    await self._fire(due)
+                    continue
+                timeout = self._next_delay()
+                if resync_at is not None:
+                    until_resync = max(resync_at - time.monotonic(), 0.0)
+                    timeout = until_resync if timeout is None else min(timeout, until_resync)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if resync_at is not None and time.monotonic() >= resync_at:
+                    try:
+                        await self._load()
+                    except Exception:
+                        logger.exception("expiry resync failed")
+                    resync_at = time.monotonic() + self.resync_seconds
+        finally:
+            db.remove_deadline_listener(self.schedule)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(), name="expiry-scheduler")
+        return self._task
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict[str, Any]:
+        next_delay = self._next_delay()
+        return {
+            "pending": len(self._deadlines),
+            "heap": len(self._heap),
+            "next_in": round(next_delay, 1) if next_delay is not None else None,
+            "fired": self.fired,
+            "expired": self.expired,
+        }
+
+
+__all__ = ["ExpiryScheduler"]
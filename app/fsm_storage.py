@@ -0,0 +1,284 @@
+"""aiogram FSM storage in the bot's SQLite database.
+
+:class:`SQLiteStorage` keeps each conversation (``CheckoutStates``,
+``CatalogStates``, ...) in an ``fsm_state`` row, so a restart no longer
+drops users halfway through a payment.  State and data are held in memory
+as the compact JSON that is stored, which also means every ``get_data``
+returns a fresh copy.  Reads are served from memory.  Changes mark the
+entry dirty, and a background task writes all dirty entries every
+``FSM_FLUSH_SECONDS`` in one transaction on the writer lane.  A crash
+therefore loses at most that much FSM progress; ``FSM_FLUSH_SECONDS=0``
+writes through on every change.
+
+An entry is trusted for ``FSM_CACHE_SECONDS`` after it was loaded or
+written and is dropped from memory afterwards.  Conversations untouched for
+``FSM_STATE_TTL_SECONDS`` are abandoned: they read as empty and are
+deleted by the periodic sweep.  Several bot processes can share the
+table only if each user is always handled by the same process, or with
+``FSM_CACHE_SECONDS=0`` and ``FSM_FLUSH_SECONDS=0``.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from .config import FSM_CACHE_SECONDS, FSM_FLUSH_SECONDS, FSM_STATE_TTL_SECONDS, FSM_STORAGE
+from .db_pool import get_connection, transaction
+from .repository import repo
+
+logger = logging.getLogger(__name__)
+
+_EMPTY = "{}"
+# پاک‌سازی وضعیت‌های رهاشده در دیتابیس حداکثر هر چند وقت یک بار
+_SWEEP_SECONDS = 600.0
+
+
+def install(con) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_state(
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)")
+
+
+def _dump(data: Mapping[str, Any]) -> str:
+    return json.dumps(dict(data), ensure_ascii=False, separators=(",", ":")) if data else _EMPTY
+
+
+def _state_name(state: StateType) -> str | None:
+    return state.state if isinstance(state, State) else state
+
+
+class _Entry:
+    __slots__ = ("state", "data", "updated_at", "loaded_at", "version")
+
+    def __init__(self, state: str | None, data: str, updated_at: float, loaded_at: float) -> None:
+        self.state = state
+        self.data = data
+        # زمان دیواری آخرین تغییر (برای TTL در دیتابیس)؛ loaded_at مونوتونیک است
+        self.updated_at = updated_at
+        self.loaded_at = loaded_at
+        self.version = 0
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and self.data == _EMPTY
+
+
+def _install() -> None:
+    with transaction() as con:
+        install(con)
+
+
+def _load_row(key: str, since: float) -> tuple[str | None, str, float] | None:
+    row = get_connection(primary=True).execute(
+        "SELECT state, data, updated_at FROM fsm_state WHERE key=? AND updated_at >= ?",
+        (key, since),
+    ).fetchone()
+    return (row[0], row[1] or _EMPTY, float(row[2])) if row else None
+
+
+def _write_rows(upserts: list[tuple[str, str | None, str, float]], deletes: list[tuple[str]]) -> None:
+    with transaction() as con:
+        if upserts:
+            con.executemany(
+                """
+                INSERT INTO fsm_state(key, state, data, updated_at) VALUES(?,?,?,?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+                """,
+                upserts,
+            )
+        if deletes:
+            con.executemany("DELETE FROM fsm_state WHERE key=?", deletes)
+
+
+def _delete_abandoned(before: float) -> int:
+    with transaction() as con:
+        return con.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,)).rowcount
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        *,
+        flush_seconds: float = FSM_FLUSH_SECONDS,
+        cache_seconds: float = FSM_CACHE_SECONDS,
+        state_ttl: float = FSM_STATE_TTL_SECONDS,
+        key_builder: KeyBuilder | None = None,
+    ) -> None:
+        self.flush_seconds = float(flush_seconds)
+        self.cache_seconds = float(cache_seconds)
+        self.state_ttl = float(state_ttl)
+        self.key_builder = key_builder or DefaultKeyBuilder(
+            with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        self._entries: dict[str, _Entry] = {}
+        self._dirty: set[str] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._swept_at = 0.0
+        self._installed = False
+        self.loads = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.abandoned = 0
+        self.evicted = 0
+
+    # --- ورودی‌های حافظه ----------------------------------------------------------
+
+    def _valid(self, key: str, entry: _Entry, now: float) -> bool:
+        return key in self._dirty or now - entry.loaded_at < self.cache_seconds
+
+    async def _ensure_table(self) -> None:
+        # bot.py قدیمی مهاجرت‌ها را اجرا نمی‌کند؛ جدول یک بار در هر پروسه ساخته می‌شود
+        if not self._installed:
+            await repo.write(_install)
+            self._installed = True
+
+    async def _entry(self, key: str) -> _Entry:
+        started = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and self._valid(key, entry, started):
+            return entry
+        await self._ensure_table()
+        self.loads += 1
+        row = await repo.read(_load_row, key, time.time() - self.state_ttl)
+        current = self._entries.get(key)
+        if current is not None and current.loaded_at >= started:
+            # در حین خواندن، همین کلید بارگذاری یا تغییر شده و تازه‌تر از این نتیجه است
+            return current
+        state, data, updated_at = row or (None, _EMPTY, time.time())
+        entry = _Entry(state, data, updated_at, time.monotonic())
+        self._entries[key] = entry
+        return entry
+
+    async def _changed(self, key: str, entry: _Entry) -> None:
+        entry.updated_at = time.time()
+        entry.loaded_at = time.monotonic()
+        entry.version += 1
+        self._dirty.add(key)
+        if self.flush_seconds <= 0:
+            await self.flush()
+        elif self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="fsm-flush")
+
+    # --- BaseStorage --------------------------------------------------------------
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        entry = await self._entry(storage_key)
+        name = _state_name(state)
+        if entry.state != name:
+            entry.state = name
+            await self._changed(storage_key, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, Mapping):
+            raise ValueError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        storage_key = self.key_builder.build(key)
+        entry = await self._entry(storage_key)
+        # همین‌جا سریال می‌شود تا دادهٔ غیر JSON در همان هندلر خطا بدهد، نه در flush
+        payload = _dump(data)
+        if entry.data != payload:
+            entry.data = payload
+            await self._changed(storage_key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        entry = await self._entry(self.key_builder.build(key))
+        return json.loads(entry.data)
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    # --- نوشتن دسته‌ای ------------------------------------------------------------
+
+    async def flush(self) -> int:
+        """Write every dirty entry in one transaction; returns the number of rows written."""
+
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch = {key: self._entries[key] for key in self._dirty}
+            versions = {key: entry.version for key, entry in batch.items()}
+            upserts = [(k, e.state, e.data, e.updated_at) for k, e in batch.items() if not e.empty]
+            deletes = [(k,) for k, e in batch.items() if e.empty]
+            await self._ensure_table()
+            await repo.write(_write_rows, upserts, deletes)
+            for key, version in versions.items():
+                entry = self._entries.get(key)
+                if entry is not None and entry.version == version:
+                    self._dirty.discard(key)
+                    if entry.empty:
+                        # گفتگوی پاک‌شده در حافظه نمی‌ماند
+                        del self._entries[key]
+            self.flushes += 1
+            self.rows_written += len(batch)
+            return len(batch)
+
+    async def sweep(self) -> None:
+        """Drop entries that outlived the cache window and delete abandoned conversations."""
+
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if not self._valid(k, e, now)]:
+            del self._entries[key]
+            self.evicted += 1
+        self._swept_at = now
+        await self._ensure_table()
+        self.abandoned += await repo.write(_delete_abandoned, time.time() - self.state_ttl)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+                if time.monotonic() - self._swept_at >= _SWEEP_SECONDS:
+                    await self.sweep()
+            except Exception:
+                # ورودی‌ها dirty می‌مانند و دور بعد دوباره نوشته می‌شوند
+                logger.exception("FSM flush failed")
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "dirty": len(self._dirty),
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "evicted": self.evicted,
+            "abandoned": self.abandoned,
+        }
+
+
+def create_storage() -> BaseStorage:
+    """The FSM storage selected by ``FSM_STORAGE`` (``sqlite`` or ``memory``)."""
+
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage()
+
+
+__all__ = ["SQLiteStorage", "create_storage", "install"]
@@ -330,9 +330,9 @@ def ik_history_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def ik_history_more(cat: str, next_page: int) -> InlineKeyboardMarkup:
+def ik_history_more(cat: str, before_id: int) -> InlineKeyboardMarkup:
     rows = [
-        [InlineKeyboardButton(text="⬇️ نمایش بیشتر", callback_data=f"hist:show:{cat}:p{next_page}")],
+        [InlineKeyboardButton(text="⬇️ نمایش بیشتر", callback_data=f"hist:show:{cat}:b{before_id}")],
         [InlineKeyboardButton(text="🔙 بازگشت", callback_data="hist:menu")],
     ]
     return InlineKeyboardMarkup(inline_keyboard=rows)
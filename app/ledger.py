@@ -0,0 +1,96 @@
+"""Wallet ledger: balance moves and their ``wallet_tx`` rows, committed together.
+
+A posting is a guarded ``UPDATE users SET wallet_balance = wallet_balance + ?``
+that only matches while the resulting balance stays non-negative, followed
+by the matching ``wallet_tx`` insert.  Both run in the same transaction, so
+two concurrent debits can never overdraw a wallet and a balance change is
+never recorded without its transaction row.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable
+
+from . import cache
+from .db_pool import transaction
+
+
+@dataclass(frozen=True)
+class Posting:
+    user_id: int
+    delta: int
+    tx_type: str
+    note: str = ""
+    order_id: int | None = None
+
+
+_INSERT_TX = "INSERT INTO wallet_tx(user_id, order_id, amount, type, note, created_at) VALUES(?,?,?,?,?,?)"
+
+
+def _move(con, posting: Posting, now: str) -> bool:
+    delta = int(posting.delta)
+    cur = con.execute(
+        """
+        UPDATE users SET wallet_balance=IFNULL(wallet_balance, 0)+?, updated_at=?
+        WHERE user_id=? AND IFNULL(wallet_balance, 0)+? >= 0
+        """,
+        (delta, now, posting.user_id, delta),
+    )
+    if cur.rowcount != 1:
+        return False
+    cache.invalidate(f"user:{posting.user_id}")
+    return True
+
+
+def _tx_row(posting: Posting, now: str) -> tuple:
+    return (posting.user_id, posting.order_id, abs(int(posting.delta)), posting.tx_type, posting.note or "", now)
+
+
+def post(user_id: int, delta: int, tx_type: str, note: str = "", order_id: int | None = None) -> bool:
+    """Move ``delta`` in or out of a wallet; ``False`` if the user is missing or funds are short."""
+
+    posting = Posting(user_id, int(delta), tx_type, note, order_id)
+    now = datetime.now().isoformat(timespec="seconds")
+    with transaction() as con:
+        if not _move(con, posting, now):
+            return False
+        con.execute(_INSERT_TX, _tx_row(posting, now))
+        return True
+
+
+def post_many(postings: Iterable[Posting], *, all_or_nothing: bool = False) -> list[bool]:
+    """Apply several postings under one commit.
+
+    Each posting is guarded on its own and the result list says which ones
+    went through; their ``wallet_tx`` rows are written with one batched
+    insert.  With ``all_or_nothing`` a single rejected posting rolls the
+    whole batch back and every entry comes back ``False``.
+    """
+
+    items = list(postings)
+    if not items:
+        return []
+    now = datetime.now().isoformat(timespec="seconds")
+    results: list[bool] = []
+    try:
+        with transaction() as con:
+            rows = []
+            for posting in items:
+                ok = _move(con, posting, now)
+                if not ok and all_or_nothing:
+                    raise _BatchRejected
+                results.append(ok)
+                if ok:
+                    rows.append(_tx_row(posting, now))
+            con.executemany(_INSERT_TX, rows)
+    except _BatchRejected:
+        return [False] * len(items)
+    return results
+
+
+class _BatchRejected(Exception):
+    pass
+
+
+__all__ = ["Posting", "post", "post_many"]
@@ -1,14 +1,32 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
+from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import BotCommand, BotCommandScopeDefault, MenuButtonCommands
-from .config import BOT_TOKEN, DEFAULT_BOT_PROPS
-from .db import init_db, expire_orders_and_refund
+from . import cache, write_coalescer
+from .config import (
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_INTERVAL_SECONDS,
+    BOT_MODE,
+    BOT_TOKEN,
+    DEFAULT_BOT_PROPS,
+    TELEGRAM_API_URL,
+)
+from .db import init_db
+from .dispatch import OrderedDispatcher
+from .expiry import ExpiryScheduler
+from .fsm_storage import create_storage
+from .db_pool import close_all_connections
+from .repository import repo
 from .products import seed_default_catalog
 from .public import router as public_router
 from .admin import router as admin_router
 from .logging_utils import setup_logging
+from .notifications import NotificationRelay
+from .outbox import outbox
+from .webhook import WebhookHandler, serve as serve_webhook
 
 
 setup_logging()
@@ -27,37 +45,103 @@ async def setup_bot_menu(bot: Bot):
     # دکمهٔ Menu را روی نمایشِ همین کامندها می‌گذاریم
     await bot.set_chat_menu_button(menu_button=MenuButtonCommands())
 
-async def expire_loop(bot: Bot):
+def expiry_notifier(bot: Bot):
+    async def notify(expired):
+        for o in expired:
+            uid = o["user_id"]; oid = o["id"]
+            outbox.send_message(bot, uid, f"⏰ سفارش #{oid} به دلیل عدم پرداخت در ۱۵ دقیقه منقضی شد.")
+    return notify
+
+async def metrics_loop(
+    scheduler: ExpiryScheduler,
+    dp: OrderedDispatcher,
+    relay: NotificationRelay,
+    webhook: WebhookHandler | None = None,
+):
+    # آمار کش و صف‌های دیتابیس این پروسه برای نمایش در پنل وب ذخیره می‌شود
     while True:
         try:
-            expired = expire_orders_and_refund()
-            for o in expired:
-                uid = o["user_id"]; oid = o["id"]
-                try:
-                    await bot.send_message(uid, f"⏰ سفارش #{oid} به دلیل عدم پرداخت در ۱۵ دقیقه منقضی شد.")
-                except Exception:
-                    pass
-            if expired:
-                logging.info("Expired orders: %s", [e["id"] for e in expired])
+            await repo.publish_runtime_metrics(
+                "bot",
+                {
+                    "cache": cache.stats(),
+                    "repository": repo.stats(),
+                    "write_coalescer": write_coalescer.stats(),
+                    "expiry": scheduler.stats(),
+                    "fsm": dp.storage.stats() if hasattr(dp.storage, "stats") else None,
+                    "dispatch": dp.stats(),
+                    "outbox": outbox.stats(),
+                    "notifications": relay.stats(),
+                    "webhook": webhook.stats() if webhook is not None else None,
+                },
+            )
         except Exception as e:
-            logging.exception("expire_loop error: %s", e)
+            logging.exception("metrics_loop error: %s", e)
         await asyncio.sleep(30)
 
+async def archive_loop():
+    # سفارش‌های تمام‌شده دسته‌دسته به دیتابیس بایگانی می‌روند؛ بین دسته‌ها قفل نوشتن آزاد می‌شود
+    while True:
+        try:
+            moved = 0
+            while True:
+                batch = await repo.archive_cold_orders()
+                moved += batch
+                if batch < ARCHIVE_BATCH_SIZE:
+                    break
+                await asyncio.sleep(1)
+            if moved:
+                logging.info("Archived %s orders", moved)
+        except Exception as e:
+            logging.exception("archive_loop error: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
 async def main():
     init_db()
     seed_default_catalog()
-    bot = Bot(BOT_TOKEN, default=DEFAULT_BOT_PROPS)
-    dp = Dispatcher()
+    # TELEGRAM_API_URL برای سرور محلی Bot API یا سرور جعلی تست
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    bot = Bot(BOT_TOKEN, session=session, default=DEFAULT_BOT_PROPS)
+    # وضعیت گفتگوها در دیتابیس می‌ماند تا ری‌استارت کاربر را وسط پرداخت رها نکند
+    # آپدیت‌های هر کاربر به ترتیب، کاربران مختلف موازی (DISPATCH_WORKERS)
+    dp = OrderedDispatcher(storage=create_storage())
     dp.include_router(public_router)
     dp.include_router(admin_router)
+    # اعلان‌هایی که پنل وب در جدول outbox ثبت می‌کند از همین پروسه ارسال می‌شوند
+    relay = NotificationRelay(bot)
+    # پیش از بسته شدن نشست ربات در پایان polling، پیام‌های صف ارسال می‌شوند؛
+    # relay اول بسته می‌شود تا نتیجهٔ پیام‌های در حال ارسال در جدول ثبت شود
+    dp.shutdown.register(relay.close)
+    dp.shutdown.register(outbox.close)
 
     # منو را ست کن
     await setup_bot_menu(bot)
 
-    # تسک انقضا
-    asyncio.create_task(expire_loop(bot))
+    # زمان‌بند انقضا: هر سفارش دقیقاً سر مهلت خودش منقضی می‌شود
+    scheduler = ExpiryScheduler(expiry_notifier(bot))
+    scheduler.start()
+    relay.start()
+    webhook = WebhookHandler(dp, bot) if BOT_MODE == "webhook" else None
+    asyncio.create_task(metrics_loop(scheduler, dp, relay, webhook))
+    if ARCHIVE_INTERVAL_SECONDS > 0:
+        asyncio.create_task(archive_loop())
 
-    await dp.start_polling(bot)
+    try:
+        if webhook is not None:
+            # تلگرام آپدیت‌ها را خودش می‌فرستد؛ رفت‌وبرگشت long polling حذف می‌شود
+            await serve_webhook(webhook)
+        else:
+            # وب‌هوکِ ثبت‌شده از اجرای قبلی getUpdates را با خطای Conflict متوقف می‌کند
+            await bot.delete_webhook()
+            # با صف‌های مرتب، polling تا جا باز شدن در صف آپدیت بعدی را نمی‌گیرد
+            await dp.start_polling(bot, handle_as_tasks=not dp.ordered)
+    finally:
+        await scheduler.stop()
+        await dp.storage.close()
+        # صف‌ها پیش از بستن اتصال‌ها کامل خالی می‌شوند
+        repo.shutdown(wait=True)
+        write_coalescer.shutdown()
+        close_all_connections()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,89 @@
+"""Database maintenance commands.
+
+    python -m app.maintenance counters check
+    python -m app.maintenance counters rebuild
+    python -m app.maintenance search rebuild [orders|users|service_messages]
+    python -m app.maintenance archive status
+    python -m app.maintenance archive run [--terminal-days N] [--completed-days N]
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+
+from . import archive, counters
+from . import search as fts
+from .config import ARCHIVE_COMPLETED_DAYS, ARCHIVE_TERMINAL_DAYS
+from .db import archive_cold_orders, init_db
+from .db_pool import close_all_connections, get_connection, transaction
+
+
+def _counters(args: argparse.Namespace) -> int:
+    if args.action == "rebuild":
+        with transaction() as con:
+            counters.rebuild(con)
+        print("شمارنده‌ها از روی جدول‌ها بازسازی شدند.")
+        return 0
+    problems = counters.check(get_connection())
+    if not problems:
+        print("همهٔ شمارنده‌ها با جدول‌ها همخوانی دارند.")
+        return 0
+    for item in problems:
+        print(f"{item['counter']}: expected={item['expected']} actual={item['actual']}")
+    print(f"{len(problems)} شمارندهٔ ناهمخوان؛ برای اصلاح: python -m app.maintenance counters rebuild")
+    return 1
+
+
+def _search(args: argparse.Namespace) -> int:
+    with transaction() as con:
+        fts.rebuild(con, args.table)
+    print("نمایهٔ جستجو بازسازی شد.")
+    return 0
+
+
+def _archive(args: argparse.Namespace) -> int:
+    if not archive.enabled():
+        print("بایگانی خاموش است (ARCHIVE_DB_PATH خالی است).")
+        return 1
+    if args.action == "run":
+        total = 0
+        while True:
+            moved = archive_cold_orders(terminal_days=args.terminal_days, completed_days=args.completed_days)
+            total += moved
+            if not moved:
+                break
+        print(f"{total} سفارش به بایگانی منتقل شد.")
+    for name, value in archive.stats(get_connection()).items():
+        print(f"{name}: {value}")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_counters = sub.add_parser("counters", help="dashboard counters (stats_counters / order_daily)")
+    p_counters.add_argument("action", choices=["check", "rebuild"])
+    p_counters.set_defaults(func=_counters)
+
+    p_search = sub.add_parser("search", help="full-text search index (FTS5)")
+    p_search.add_argument("action", choices=["rebuild"])
+    p_search.add_argument("table", nargs="?", choices=sorted(fts.INDEXES))
+    p_search.set_defaults(func=_search)
+
+    p_archive = sub.add_parser("archive", help="move finished orders to the archive database")
+    p_archive.add_argument("action", choices=["status", "run"])
+    p_archive.add_argument("--terminal-days", type=int, default=ARCHIVE_TERMINAL_DAYS)
+    p_archive.add_argument("--completed-days", type=int, default=ARCHIVE_COMPLETED_DAYS)
+    p_archive.set_defaults(func=_archive)
+
+    args = parser.parse_args(argv)
+    init_db()
+    try:
+        return args.func(args)
+    finally:
+        close_all_connections()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
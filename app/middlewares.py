@@ -4,7 +4,7 @@ from aiogram import BaseMiddleware
 from aiogram.types import CallbackQuery, Message
 from typing import Any, Awaitable, Callable, Dict
 
-from .db import is_user_blocked
+from .repository import repo
 
 
 class BlockedUserMiddleware(BaseMiddleware):
@@ -15,7 +15,7 @@ class BlockedUserMiddleware(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         user = getattr(event, "from_user", None)
-        if user and is_user_blocked(user.id):
+        if user and await repo.is_user_blocked(user.id):
             if isinstance(event, Message):
                 await event.answer("⛔️ دسترسی شما به خدمات ربات محدود شده است. لطفاً با پشتیبانی تماس بگیرید.")
             elif isinstance(event, CallbackQuery):
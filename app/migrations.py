@@ -0,0 +1,589 @@
+"""Versioned schema migrations keyed on ``PRAGMA user_version``.
+
+Each entry in :data:`MIGRATIONS` is applied once, in order, inside the
+caller's transaction, and bumps ``user_version`` to its number.  A database
+that is already up to date costs a single pragma read on startup.
+
+Migration steps receive the raw connection and must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Any, Callable
+
+from . import archive, counters
+from .config import PAYMENT_TIMEOUT_MIN
+from . import search as fts
+
+logger = logging.getLogger(__name__)
+
+
+def _table_exists(con, name):
+    cur = con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return cur.fetchone() is not None
+
+def _col_exists(con, table, col):
+    cur = con.cursor()
+    cur.execute(f"PRAGMA table_info({table})")
+    cols = [r[1] for r in cur.fetchall()]
+    return col in cols
+
+
+def _get_table_columns(cur, table: str) -> list[str]:
+    cur.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in cur.fetchall()]
+
+
+def _create_orders_table(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS orders(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER, username TEXT, first_name TEXT,
+            plan_id TEXT, plan_title TEXT, price TEXT,
+            receipt_file_id TEXT, receipt_text TEXT,
+            status TEXT, created_at TEXT, updated_at TEXT
+        );
+        """
+    )
+
+
+def _add_missing_columns(con, cur) -> None:
+    add_cols = [
+        ("orders", "service_category", "TEXT"),
+        ("orders", "service_code", "TEXT"),
+        ("orders", "account_mode", "TEXT"),
+        ("orders", "customer_email", "TEXT"),
+        ("orders", "customer_secret_encrypted", "TEXT"),
+        ("orders", "amount_total", "INTEGER"),
+        ("orders", "currency", "TEXT"),
+        ("orders", "payment_type", "TEXT"),
+        ("orders", "wallet_used_amount", "INTEGER DEFAULT 0"),
+        ("orders", "wallet_reserved_amount", "INTEGER DEFAULT 0"),
+        ("orders", "await_deadline", "TEXT"),
+        ("orders", "notes", "TEXT"),
+        ("orders", "customer_message", "TEXT"),
+        ("orders", "manager_note", "TEXT"),
+        ("orders", "internal_cost", "INTEGER DEFAULT 0"),
+        ("orders", "net_revenue", "INTEGER DEFAULT 0"),
+        ("orders", "require_username", "INTEGER DEFAULT 0"),
+        ("orders", "require_password", "INTEGER DEFAULT 0"),
+        ("orders", "customer_username", "TEXT"),
+        ("orders", "customer_password", "TEXT"),
+        ("orders", "allow_first_plan", "INTEGER DEFAULT 0"),
+        ("orders", "cashback_percent", "INTEGER DEFAULT 0"),
+        ("orders", "cashback_applied_amount", "INTEGER DEFAULT 0"),
+        ("orders", "discount_id", "INTEGER"),
+        ("orders", "discount_code", "TEXT"),
+        ("orders", "discount_amount", "INTEGER DEFAULT 0"),
+        ("products", "description", "TEXT DEFAULT ''"),
+        ("products", "price", "INTEGER DEFAULT 0"),
+        ("products", "available", "INTEGER DEFAULT 1"),
+        ("products", "is_category", "INTEGER DEFAULT 0"),
+        ("products", "request_only", "INTEGER DEFAULT 0"),
+        ("products", "account_enabled", "INTEGER DEFAULT 0"),
+        ("products", "self_available", "INTEGER DEFAULT 0"),
+        ("products", "self_price", "INTEGER DEFAULT 0"),
+        # ستون‌های جدید برای نیازهای خاص مود "اکانت خودم"
+        ("products", "self_require_username", "INTEGER DEFAULT 0"),
+        ("products", "self_require_password", "INTEGER DEFAULT 0"),
+        
+        ("products", "pre_available", "INTEGER DEFAULT 0"),
+        ("products", "pre_price", "INTEGER DEFAULT 0"),
+        ("products", "require_username", "INTEGER DEFAULT 0"),
+        ("products", "require_password", "INTEGER DEFAULT 0"),
+        ("products", "allow_first_plan", "INTEGER DEFAULT 0"),
+        ("products", "cashback_enabled", "INTEGER DEFAULT 0"),
+        ("products", "cashback_percent", "INTEGER DEFAULT 0"),
+        ("products", "sort_order", "INTEGER DEFAULT 0"),
+        ("products", "created_at", "TEXT"),
+        ("products", "updated_at", "TEXT"),
+        ("users", "contact_phone", "TEXT"),
+        ("users", "contact_verified", "INTEGER DEFAULT 0"),
+        ("users", "contact_shared_at", "TEXT"),
+        ("users", "is_blocked", "INTEGER DEFAULT 0"),
+        ("service_messages", "updated_at", "TEXT"),
+        ("coupons", "is_active", "INTEGER DEFAULT 1"),
+        ("coupons", "usage_limit_per_user", "INTEGER DEFAULT 1"),
+        ("coupon_redemptions", "times_used", "INTEGER DEFAULT 1"),
+        # ستون‌های حیاتی برای رفع خطای شما
+        ("discount_redemptions", "order_id", "INTEGER"),
+        ("discount_redemptions", "times_used", "INTEGER DEFAULT 1"),
+        ("discount_redemptions", "redeemed_at", "TEXT"),
+        ("discount_redemptions", "status", "TEXT DEFAULT 'CONFIRMED'"),
+    ]
+    for t, c, typ in add_cols:
+        if _table_exists(con, t) and not _col_exists(con, t, c):
+            try:
+                cur.execute(f"ALTER TABLE {t} ADD COLUMN {c} {typ};")
+            except Exception:
+                pass
+
+
+def _ensure_orders_have_id(con, cur) -> None:
+    if not _table_exists(con, "orders"):
+        return
+    cols = _get_table_columns(cur, "orders")
+    if "id" in cols:
+        return
+    cur.execute("ALTER TABLE orders RENAME TO orders_old;")
+    _create_orders_table(cur)
+    _add_missing_columns(con, cur)
+    old_cols = set(_get_table_columns(cur, "orders_old"))
+    new_cols = _get_table_columns(cur, "orders")
+    dest_cols = []
+    select_cols = []
+    if "id" in new_cols:
+        dest_cols.append("id")
+        select_cols.append("rowid")
+    for col in new_cols:
+        if col == "id" or col not in old_cols:
+            continue
+        dest_cols.append(col)
+        select_cols.append(col)
+    if dest_cols:
+        cols_sql = ",".join(dest_cols)
+        select_sql = ",".join(select_cols)
+        cur.execute(f"INSERT INTO orders ({cols_sql}) SELECT {select_sql} FROM orders_old;")
+    cur.execute("DROP TABLE orders_old;")
+
+
+def _baseline_schema(con) -> None:
+    """Schema as it stood before versioning; every statement is idempotent."""
+
+    cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        username TEXT, first_name TEXT,
+        wallet_balance INTEGER DEFAULT 0,
+        ref_by INTEGER, ref_count INTEGER DEFAULT 0,
+        earnings_total INTEGER DEFAULT 0,
+        created_at TEXT, updated_at TEXT
+    );
+    """)
+    _create_orders_table(cur)
+    _ensure_orders_have_id(con, cur)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS products(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parent_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            title TEXT NOT NULL,
+            description TEXT DEFAULT '',
+            price INTEGER DEFAULT 0,
+            available INTEGER DEFAULT 1,
+            is_category INTEGER DEFAULT 0,
+            request_only INTEGER DEFAULT 0,
+            account_enabled INTEGER DEFAULT 0,
+            self_available INTEGER DEFAULT 0,
+            self_price INTEGER DEFAULT 0,
+            self_require_username INTEGER DEFAULT 0,
+            self_require_password INTEGER DEFAULT 0,
+            pre_available INTEGER DEFAULT 0,
+            pre_price INTEGER DEFAULT 0,
+            require_username INTEGER DEFAULT 0,
+            require_password INTEGER DEFAULT 0,
+            sort_order INTEGER DEFAULT 0,
+            created_at TEXT,
+            updated_at TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_parent ON products(parent_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_sort ON products(sort_order);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS service_messages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            category TEXT,
+            message_text TEXT,
+            attachment_file_id TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            is_resolved INTEGER DEFAULT 0
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_service_messages_category ON service_messages(category);")
+    _add_missing_columns(con, cur)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_tx(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        order_id INTEGER,
+        amount INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        note TEXT,
+        created_at TEXT
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_user ON wallet_tx(user_id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS order_manager_messages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            user_id INTEGER,
+            message_text TEXT,
+            created_at TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_manager_messages_order ON order_manager_messages(order_id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS service_message_replies(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            service_message_id INTEGER NOT NULL,
+            user_id INTEGER,
+            message_text TEXT,
+            created_at TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_service_message_replies_msg ON service_message_replies(service_message_id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_manager_messages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message_text TEXT,
+            created_at TEXT
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_manager_messages_user ON user_manager_messages(user_id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS coupons(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            amount INTEGER NOT NULL,
+            usage_limit INTEGER NOT NULL,
+            usage_limit_per_user INTEGER DEFAULT 1,
+            used_count INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            expires_at TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS coupon_redemptions(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            coupon_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            times_used INTEGER DEFAULT 1,
+            redeemed_at TEXT,
+            UNIQUE(coupon_id, user_id),
+            FOREIGN KEY(coupon_id) REFERENCES coupons(id) ON DELETE CASCADE
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_coupon ON coupon_redemptions(coupon_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_user ON coupon_redemptions(user_id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS discounts(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            amount INTEGER NOT NULL,
+            usage_limit INTEGER NOT NULL,
+            usage_limit_per_user INTEGER DEFAULT 1,
+            used_count INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            applies_all INTEGER DEFAULT 0,
+            product_ids TEXT DEFAULT '',
+            expires_at TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS discount_redemptions(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discount_id INTEGER NOT NULL,
+            order_id INTEGER,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            times_used INTEGER DEFAULT 1,
+            redeemed_at TEXT,
+            status TEXT DEFAULT 'CONFIRMED',
+            UNIQUE(discount_id, user_id),
+            FOREIGN KEY(discount_id) REFERENCES discounts(id) ON DELETE CASCADE
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_discount_redemptions_discount ON discount_redemptions(discount_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_discount_redemptions_user ON discount_redemptions(user_id);")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT
+        );
+        """
+    )
+
+
+def _runtime_metrics(con) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runtime_metrics(
+            name TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            updated_at TEXT
+        );
+        """
+    )
+
+
+def _stats_counters(con) -> None:
+    counters.install(con)
+    counters.rebuild(con)
+
+
+def _search_index(con) -> None:
+    fts.install(con)
+    fts.rebuild(con)
+
+
+def _keyset_indexes(con) -> None:
+    # مقایسهٔ (created_at, id) با NULL هیچ‌وقت درست نیست و ردیف از صفحه‌بندی جا می‌ماند
+    for table in ("orders", "users", "service_messages"):
+        con.execute(
+            f"UPDATE {table} SET created_at=COALESCE(updated_at, '1970-01-01T00:00:00') WHERE created_at IS NULL"
+        )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at, user_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_service_messages_created ON service_messages(created_at, id)")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_service_messages_category_created "
+        "ON service_messages(category, created_at, id)"
+    )
+    # پیشوند ایندکس‌های جدید هستند
+    con.execute("DROP INDEX IF EXISTS idx_orders_status")
+    con.execute("DROP INDEX IF EXISTS idx_orders_user")
+    con.execute("DROP INDEX IF EXISTS idx_service_messages_category")
+
+
+def _cart_statuses(con) -> None:
+    # وضعیت‌های قدیمی سبد خرید یک بار یکدست می‌شوند تا خواندن سبد هیچ نوشتنی نداشته باشد
+    con.execute("UPDATE orders SET status='AWAITING_PAYMENT' WHERE status IN ('', 'در انتظار پرداخت')")
+    # مهلت گم‌شده یا نامعتبر از روی زمان ثبت سفارش بازسازی می‌شود
+    con.execute(
+        """
+        UPDATE orders
+        SET await_deadline=COALESCE(
+            strftime('%Y-%m-%dT%H:%M:%S', created_at, ?),
+            strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime', ?)
+        )
+        WHERE status IN ('AWAITING_PAYMENT', 'PENDING_CONFIRM')
+          AND (await_deadline IS NULL OR datetime(await_deadline) IS NULL)
+        """,
+        (f"+{PAYMENT_TIMEOUT_MIN} minutes", f"+{PAYMENT_TIMEOUT_MIN} minutes"),
+    )
+    con.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_cart ON orders(user_id, await_deadline)
+        WHERE status IN ('AWAITING_PAYMENT', 'PENDING_CONFIRM')
+        """
+    )
+
+
+def _has_unique_key(con, table: str, columns: tuple[str, ...]) -> bool:
+    for index in con.execute(f"PRAGMA index_list({table})").fetchall():
+        if not index["unique"]:
+            continue
+        cols = tuple(row["name"] for row in con.execute(f"PRAGMA index_info({index['name']})").fetchall())
+        if cols == columns:
+            return True
+    return False
+
+
+def _redemption_keys(con) -> None:
+    # دیتابیس‌های قدیمی به‌جای (discount_id, user_id) روی order_id یکتا بودند؛
+    # upsert سهم هر کاربر به کلید یکتای (discount_id, user_id) نیاز دارد.
+    con.execute("DROP INDEX IF EXISTS idx_discount_redemptions_discount")
+    if _has_unique_key(con, "discount_redemptions", ("discount_id", "user_id")):
+        return
+    con.execute(
+        """
+        UPDATE discount_redemptions
+        SET times_used=(
+            SELECT SUM(IFNULL(d.times_used, 1)) FROM discount_redemptions d
+            WHERE d.discount_id=discount_redemptions.discount_id AND d.user_id=discount_redemptions.user_id
+        )
+        WHERE id IN (SELECT MAX(id) FROM discount_redemptions GROUP BY discount_id, user_id HAVING COUNT(*) > 1)
+        """
+    )
+    con.execute(
+        """
+        DELETE FROM discount_redemptions
+        WHERE id NOT IN (SELECT MAX(id) FROM discount_redemptions GROUP BY discount_id, user_id)
+        """
+    )
+    con.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_discount_redemptions_code_user "
+        "ON discount_redemptions(discount_id, user_id)"
+    )
+
+
+def _discount_products(con) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS discount_products(
+            discount_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            PRIMARY KEY(discount_id, product_id),
+            FOREIGN KEY(discount_id) REFERENCES discounts(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_discount_products_product ON discount_products(product_id, discount_id)"
+    )
+    if _col_exists(con, "discounts", "product_ids"):
+        rows = con.execute("SELECT id, product_ids FROM discounts WHERE IFNULL(product_ids, '') != ''").fetchall()
+        con.executemany(
+            "INSERT OR IGNORE INTO discount_products(discount_id, product_id) VALUES(?, ?)",
+            (
+                (row["id"], int(part))
+                for row in rows
+                for part in (p.strip() for p in str(row["product_ids"]).split(","))
+                if part.isdigit()
+            ),
+        )
+        con.execute("ALTER TABLE discounts DROP COLUMN product_ids")
+
+    # کد یکدست‌شده با ایندکس یکتا؛ UPPER(code)=? نمی‌توانست از ایندکس code استفاده کند
+    if not _col_exists(con, "discounts", "code_norm"):
+        con.execute("ALTER TABLE discounts ADD COLUMN code_norm TEXT")
+    # از کدهای تکراری (فقط در حروف کوچک/بزرگ) قدیمی‌ترین نگه داشته می‌شود
+    con.execute(
+        """
+        UPDATE discounts SET code_norm=UPPER(TRIM(code))
+        WHERE id IN (SELECT MIN(id) FROM discounts GROUP BY UPPER(TRIM(code)))
+        """
+    )
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_discounts_code_norm ON discounts(code_norm)")
+
+
+def _archive_support(con) -> None:
+    # تریگرهای حذف شمارنده‌ها حالا انتقال به بایگانی را نادیده می‌گیرند
+    counters.install(con)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_wallet_tx_order ON wallet_tx(order_id)")
+
+
+def _archived_counters(con) -> None:
+    # شمارنده‌های archived: برای جمع فهرست سفارش‌ها؛ بایگانی باید پیش از rebuild وصل باشد
+    archive.install(con)
+    counters.install(con)
+    counters.rebuild(con)
+
+
+def _archive_age_index(con) -> None:
+    # سن بایگانی از updated_at حساب می‌شود؛ ردیف بدون updated_at هرگز بایگانی نمی‌شد
+    con.execute("UPDATE orders SET updated_at=created_at WHERE updated_at IS NULL")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_updated ON orders(status, updated_at, id)")
+
+
+def _fsm_state(con) -> None:
+    from .fsm_storage import install  # ایمپورت داخلی: fsm_storage به repository و aiogram وابسته است
+
+    install(con)
+
+
+def _notification_outbox(con) -> None:
+    from .notifications import install  # ایمپورت داخلی: notifications به repository و aiogram وابسته است
+
+    install(con)
+
+
+# (version, name, step) — شماره‌ها فقط افزایش می‌یابند و مرحله‌های قبلی نباید تغییر کنند
+MIGRATIONS: list[tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "baseline schema", _baseline_schema),
+    (2, "runtime metrics", _runtime_metrics),
+    (3, "dashboard counters", _stats_counters),
+    (4, "full-text search index", _search_index),
+    (5, "keyset pagination indexes", _keyset_indexes),
+    (6, "normalise cart order statuses", _cart_statuses),
+    (7, "unique per-user discount redemptions", _redemption_keys),
+    (8, "discount products table and normalised codes", _discount_products),
+    (9, "order archive support", _archive_support),
+    (10, "persistent FSM state", _fsm_state),
+    (11, "notification outbox", _notification_outbox),
+    (12, "archived order counters", _archived_counters),
+    (13, "archive age index on updated_at", _archive_age_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(con) -> int:
+    return int(con.execute("PRAGMA user_version").fetchone()[0])
+
+
+def pending(con) -> list[tuple[int, str]]:
+    version = current_version(con)
+    return [(num, name) for num, name, _ in MIGRATIONS if num > version]
+
+
+def migrate(con) -> int:
+    """Apply every pending step; the caller owns the (write) transaction."""
+
+    version = current_version(con)
+    if version > LATEST_VERSION:
+        logger.warning("Database schema v%s is newer than this code (v%s)", version, LATEST_VERSION)
+        return version
+    for num, name, step in MIGRATIONS:
+        if num <= version:
+            continue
+        logger.info("Applying schema migration %s: %s", num, name)
+        step(con)
+        con.execute(f"PRAGMA user_version={int(num)}")
+        con.execute(
+            "INSERT OR REPLACE INTO schema_migrations(version, name, applied_at) VALUES(?,?,?)",
+            (num, name, datetime.now().isoformat(timespec="seconds")),
+        )
+        version = num
+    return version
+
+
+def status(con) -> dict[str, Any]:
+    version = current_version(con)
+    applied: list[dict[str, Any]] = []
+    if _table_exists(con, "schema_migrations"):
+        applied = [
+            dict(row)
+            for row in con.execute(
+                "SELECT version, name, applied_at FROM schema_migrations ORDER BY version"
+            ).fetchall()
+        ]
+    return {
+        "version": version,
+        "latest": LATEST_VERSION,
+        "up_to_date": version >= LATEST_VERSION,
+        "pending": [{"version": num, "name": name} for num, name in pending(con)],
+        "applied": applied,
+    }
+
+
+__all__ = ["LATEST_VERSION", "MIGRATIONS", "current_version", "migrate", "pending", "status"]
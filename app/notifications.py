@@ -0,0 +1,345 @@
+"""Durable customer notifications: the web admin writes, the bot process sends.
+
+The admin panel used to own a ``Bot`` and send messages from inside its
+request handlers, so every action waited for Telegram and a message was
+lost whenever Telegram was slow or down.  Now :func:`enqueue` only inserts a
+row into the ``outbox`` table and the request returns.  :class:`NotificationRelay`
+runs in the bot process, claims due rows and hands them to the in-memory
+:data:`app.outbox.outbox`, which applies Telegram's rate limits.
+
+Every row goes ``PENDING`` -> ``SENDING`` -> ``SENT`` or ``FAILED``:
+
+* claiming a row moves it to ``SENDING`` with a lease of
+  ``NOTIFY_LEASE_SECONDS``; the relay renews the lease while the row waits
+  in the in-memory outbox and never claims a row it still holds, so only
+  rows of a process that died are claimed again once the lease ran out and
+  delivery is at least once;
+* 429s, network and server errors put the row back to ``PENDING`` with a
+  backoff starting at ``NOTIFY_RETRY_SECONDS``, until ``NOTIFY_MAX_ATTEMPTS``;
+  "blocked by the user" and other bad requests fail at once;
+* a ``dedupe_key`` is unique, so an action that is submitted twice queues
+  one message.
+
+``attempts``, ``last_error`` and ``sent_at`` are shown on the order page.
+Finished rows are deleted after ``NOTIFY_RETENTION_DAYS``.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from . import cache
+from .config import (
+    NOTIFY_BATCH_SIZE,
+    NOTIFY_LEASE_SECONDS,
+    NOTIFY_MAX_ATTEMPTS,
+    NOTIFY_POLL_SECONDS,
+    NOTIFY_RETENTION_DAYS,
+    NOTIFY_RETRY_SECONDS,
+)
+from .db_pool import get_connection, transaction
+from .outbox import Priority, outbox
+from .repository import repo
+
+logger = logging.getLogger(__name__)
+
+PENDING, SENDING, SENT, FAILED = "PENDING", "SENDING", "SENT", "FAILED"
+STATUS_LABELS = {
+    PENDING: "در صف",
+    SENDING: "در حال ارسال",
+    SENT: "ارسال شد",
+    FAILED: "ناموفق",
+}
+
+# پاک‌سازی ردیف‌های قدیمی حداکثر هر چند وقت یک بار
+_PURGE_SECONDS = 3600.0
+_ERROR_MAX_LEN = 300
+
+
+def install(con) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 1,
+            dedupe_key TEXT,
+            order_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+        """
+    )
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_dedupe ON outbox(dedupe_key) WHERE dedupe_key IS NOT NULL")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_outbox_order ON outbox(order_id) WHERE order_id IS NOT NULL")
+
+
+def _now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _insert(chat_id: int, text: str, priority: int, dedupe_key: str | None, order_id: int | None) -> int | None:
+    now = _now_iso()
+    with transaction() as con:
+        cur = con.execute(
+            """
+            INSERT INTO outbox(chat_id, text, priority, dedupe_key, order_id, next_attempt_at, created_at, updated_at)
+            VALUES(?,?,?,?,?,?,?,?)
+            ON CONFLICT DO NOTHING
+            """,
+            (chat_id, text, priority, dedupe_key, order_id, time.time(), now, now),
+        )
+        return cur.lastrowid if cur.rowcount else None
+
+
+def _claim(limit: int, lease: float, held: list[int]) -> list[dict[str, Any]]:
+    now = time.time()
+    with transaction() as con:
+        rows = con.execute(
+            """
+            SELECT id, chat_id, text, priority, attempts, order_id FROM outbox
+            WHERE status IN ('PENDING', 'SENDING') AND next_attempt_at <= ?
+                AND id NOT IN (SELECT value FROM json_each(?))
+            ORDER BY priority, id LIMIT ?
+            """,
+            (now, json.dumps(held), limit),
+        ).fetchall()
+        if rows:
+            con.executemany(
+                "UPDATE outbox SET status='SENDING', attempts=attempts+1, next_attempt_at=?, updated_at=? WHERE id=?",
+                [(now + lease, _now_iso(), row["id"]) for row in rows],
+            )
+            # اعلان یعنی پنل وب سفارش یا کاربر را تغییر داده؛ کش این پروسه زودتر از TTL کنار می‌رود
+            cache.invalidate(
+                *{f"user:{row['chat_id']}" for row in rows},
+                *{f"order:{row['order_id']}" for row in rows if row["order_id"]},
+            )
+    return [dict(row, attempts=row["attempts"] + 1) for row in rows]
+
+
+def _renew(held: list[int], lease: float) -> None:
+    with transaction() as con:
+        con.execute(
+            """
+            UPDATE outbox SET next_attempt_at=?
+            WHERE status='SENDING' AND id IN (SELECT value FROM json_each(?))
+            """,
+            (time.time() + lease, json.dumps(held)),
+        )
+
+
+def _finish(row_id: int, status: str, error: str | None, retry_at: float | None) -> None:
+    now = _now_iso()
+    with transaction() as con:
+        con.execute(
+            """
+            UPDATE outbox SET status=?, last_error=?, next_attempt_at=COALESCE(?, next_attempt_at),
+                sent_at=CASE WHEN ?='SENT' THEN ? ELSE sent_at END, updated_at=?
+            WHERE id=? AND status='SENDING'
+            """,
+            (status, error, retry_at, status, now, now, row_id),
+        )
+
+
+def _purge(before: str) -> int:
+    with transaction() as con:
+        return con.execute(
+            "DELETE FROM outbox WHERE status IN ('SENT', 'FAILED') AND updated_at < ?", (before,)
+        ).rowcount
+
+
+def _for_order(order_id: int) -> list[dict[str, Any]]:
+    rows = get_connection().execute(
+        """
+        SELECT id, status, attempts, last_error, created_at, sent_at, updated_at, substr(text, 1, 120) AS preview
+        FROM outbox WHERE order_id=? ORDER BY id DESC LIMIT 50
+        """,
+        (order_id,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _counts() -> dict[str, int]:
+    counts = {status: 0 for status in STATUS_LABELS}
+    for status, count in get_connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"):
+        counts[status] = count
+    return counts
+
+
+async def enqueue(
+    chat_id: int,
+    text: str,
+    *,
+    priority: int = Priority.NORMAL,
+    dedupe_key: str | None = None,
+    order_id: int | None = None,
+) -> int | None:
+    """Queue ``text`` for ``chat_id``; returns the row id, or ``None`` if ``dedupe_key`` is already queued."""
+
+    if not chat_id:
+        raise ValueError("chat_id is required")
+    return await repo.write(_insert, int(chat_id), text, int(priority), dedupe_key, order_id)
+
+
+async def for_order(order_id: int) -> list[dict[str, Any]]:
+    """The latest notifications of an order with their delivery status, newest first."""
+
+    return await repo.read(_for_order, order_id)
+
+
+async def counts() -> dict[str, int]:
+    return await repo.read(_counts)
+
+
+def _transient(error: BaseException | None) -> bool:
+    # None یعنی صف حافظه پیام را نپذیرفت یا پیش از ارسال بسته شد
+    return error is None or isinstance(error, (TelegramRetryAfter, TelegramNetworkError, TelegramServerError))
+
+
+class NotificationRelay:
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        poll_seconds: float = NOTIFY_POLL_SECONDS,
+        batch_size: int = NOTIFY_BATCH_SIZE,
+        lease_seconds: float = NOTIFY_LEASE_SECONDS,
+        max_attempts: int = NOTIFY_MAX_ATTEMPTS,
+        retry_seconds: float = NOTIFY_RETRY_SECONDS,
+        retention_days: int = NOTIFY_RETENTION_DAYS,
+    ) -> None:
+        self.bot = bot
+        self.poll_seconds = max(float(poll_seconds), 0.05)
+        self.batch_size = max(int(batch_size), 1)
+        self.lease_seconds = float(lease_seconds)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.retry_seconds = float(retry_seconds)
+        self.retention_days = int(retention_days)
+        self._task: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        # شناسهٔ ردیف‌هایی که هنوز در صف حافظهٔ همین پروسه‌اند
+        self._held: set[int] = set()
+        self._renewed_at = time.monotonic()
+        self._purged_at = 0.0
+        self.claimed = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="notification-relay")
+
+    async def _run(self) -> None:
+        while True:
+            claimed = 0
+            try:
+                if self._held and time.monotonic() - self._renewed_at >= self.lease_seconds / 2:
+                    # صف حافظه ممکن است بیش از lease منتظر بماند (429 طولانی)
+                    self._renewed_at = time.monotonic()
+                    await repo.write(_renew, sorted(self._held), self.lease_seconds)
+                room = self.batch_size - len(self._deliveries)
+                if room > 0:
+                    rows = await repo.write(_claim, room, self.lease_seconds, sorted(self._held))
+                    claimed = len(rows)
+                    self.claimed += claimed
+                    if not self._held:
+                        self._renewed_at = time.monotonic()
+                    for row in rows:
+                        self._held.add(row["id"])
+                        task = asyncio.create_task(self._deliver(row))
+                        self._deliveries.add(task)
+                        task.add_done_callback(self._deliveries.discard)
+                if self.retention_days > 0 and time.monotonic() - self._purged_at >= _PURGE_SECONDS:
+                    self._purged_at = time.monotonic()
+                    before = (datetime.now() - timedelta(days=self.retention_days)).isoformat(timespec="seconds")
+                    await repo.write(_purge, before)
+            except Exception:
+                logger.exception("notification relay failed")
+            if claimed < self.batch_size:
+                # جدول خالی شد؛ تا دور بعد منتظر می‌مانیم
+                await asyncio.sleep(self.poll_seconds)
+            else:
+                await asyncio.sleep(0)
+
+    async def _deliver(self, row: dict[str, Any]) -> None:
+        try:
+            await self._send(row)
+        finally:
+            self._held.discard(row["id"])
+
+    async def _send(self, row: dict[str, Any]) -> None:
+        error: BaseException | None = None
+        try:
+            result = await outbox.send_message(
+                self.bot, row["chat_id"], row["text"], priority=row["priority"], errors=True
+            )
+        except Exception as e:
+            result, error = None, e
+        if result is not None:
+            self.sent += 1
+            await repo.write(_finish, row["id"], SENT, None, None)
+            return
+        reason = (f"{type(error).__name__}: {error}" if error else "not sent")[:_ERROR_MAX_LEN]
+        if _transient(error) and row["attempts"] < self.max_attempts:
+            self.retried += 1
+            delay = self.retry_seconds * 2 ** (row["attempts"] - 1)
+            if isinstance(error, TelegramRetryAfter):
+                delay = max(delay, float(error.retry_after))
+            await repo.write(_finish, row["id"], PENDING, reason, time.time() + min(delay, 3600.0))
+        else:
+            self.failed += 1
+            logger.info("notification %s to %s failed: %s", row["id"], row["chat_id"], reason)
+            await repo.write(_finish, row["id"], FAILED, reason, None)
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Stop claiming and record the messages already handed to the outbox (at most ``timeout`` seconds)."""
+
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self._deliveries:
+            _, pending = await asyncio.wait(set(self._deliveries), timeout=timeout)
+            if pending:
+                # ردیف‌ها در SENDING می‌مانند و پس از پایان lease دوباره ارسال می‌شوند
+                logger.warning("notification relay: %s deliveries still running at shutdown", len(pending))
+                for delivery in pending:
+                    delivery.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "in_flight": len(self._deliveries),
+            "claimed": self.claimed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+__all__ = [
+    "FAILED",
+    "PENDING",
+    "SENDING",
+    "SENT",
+    "STATUS_LABELS",
+    "NotificationRelay",
+    "counts",
+    "enqueue",
+    "for_order",
+    "install",
+]
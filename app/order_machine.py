@@ -0,0 +1,290 @@
+"""Order status transitions.
+
+``TRANSITIONS`` declares which status may follow which.  A transition is a
+single compare-and-set statement::
+
+    UPDATE orders SET status=? ... WHERE id=? AND status IN (<allowed sources>) RETURNING *
+
+so of two concurrent attempts at the same move only the first matches; the
+second gets ``None``.  When several source statuses are allowed, the
+current status is read first under the same write lock, so
+:attr:`Transition.from_status` is always the status that was replaced.  The money side
+effects of entering a status (cashback, settling the wallet reservation,
+refunds) are hooks registered with :func:`on_enter`.  They run in the same
+transaction against the returned row and record what they did on the
+:class:`Transition`, which callers use for their notifications.
+
+Functions here take order rows or ids and must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Iterable
+
+from . import cache, ledger
+from .db_pool import transaction
+
+# وضعیت‌های قدیمی که پیش از یکدست‌سازی در دیتابیس مانده‌اند
+LEGACY_AWAITING = ("", "در انتظار پرداخت")
+
+ACTIVE = ("IN_PROGRESS", "READY_TO_DELIVER", "DELIVERED", "COMPLETED")
+# رزرو کیف پول با ورود به این وضعیت‌ها قطعی (مصرف‌شده) می‌شود
+SETTLE_STATUSES = ACTIVE
+CASHBACK_STATUSES = ("DELIVERED", "COMPLETED")
+
+# from -> وضعیت‌های مجاز بعدی؛ EXPIRED و CANCELED و REJECTED پایانی‌اند
+TRANSITIONS: dict[str, frozenset[str]] = {
+    **{legacy: frozenset({"AWAITING_PAYMENT", "EXPIRED", "CANCELED"}) for legacy in LEGACY_AWAITING},
+    "AWAITING_PAYMENT": frozenset({"PENDING_CONFIRM", "PENDING_PLAN", *ACTIVE, "EXPIRED", "CANCELED", "REJECTED"}),
+    "PENDING_CONFIRM": frozenset({"PENDING_CONFIRM", "PENDING_PLAN", *ACTIVE, "EXPIRED", "CANCELED", "REJECTED"}),
+    "PENDING_PLAN": frozenset({*ACTIVE, "CANCELED", "REJECTED"}),
+    "PLAN_CONFIRMED": frozenset({*ACTIVE, "REJECTED"}),
+    "APPROVED": frozenset({*ACTIVE, "REJECTED"}),
+    "IN_PROGRESS": frozenset({"READY_TO_DELIVER", "DELIVERED", "COMPLETED", "REJECTED"}),
+    "READY_TO_DELIVER": frozenset({"IN_PROGRESS", "DELIVERED", "COMPLETED", "REJECTED"}),
+    "DELIVERED": frozenset({"IN_PROGRESS", "READY_TO_DELIVER", "COMPLETED", "REJECTED"}),
+    "COMPLETED": frozenset({"IN_PROGRESS", "DELIVERED", "REJECTED"}),
+    "EXPIRED": frozenset(),
+    "CANCELED": frozenset(),
+    "REJECTED": frozenset(),
+}
+
+# فقط از پنل مدیر: سفارشی که سر مهلت پرداخت شده ولی منقضی شده دوباره فعال می‌شود.
+# رزرو کیف پول آن در انقضا برگشت خورده است، پس این مسیر فقط برای پرداخت کارتی است.
+ADMIN_TRANSITIONS: dict[str, frozenset[str]] = {
+    "EXPIRED": frozenset({"PENDING_CONFIRM", "IN_PROGRESS"}),
+}
+
+
+def _targets(from_status: str, admin: bool) -> frozenset[str]:
+    targets = TRANSITIONS.get(from_status, frozenset())
+    if admin:
+        targets |= ADMIN_TRANSITIONS.get(from_status, frozenset())
+    return targets
+
+
+def sources(to_status: str, *, admin: bool = False) -> tuple[str, ...]:
+    return tuple(sorted(src for src in TRANSITIONS if to_status in _targets(src, admin)))
+
+
+def can_transition(from_status: str | None, to_status: str, *, admin: bool = False) -> bool:
+    return to_status in _targets(from_status or "", admin)
+
+
+@dataclass
+class Transition:
+    order: dict[str, Any]
+    from_status: str | None
+    to_status: str
+    settled: int = 0
+    cashback: int = 0
+    refunded: int = 0
+    refund_note: str | None = None
+    card_refund_note: str | None = None
+
+
+_HOOKS: dict[str, list[Callable[[Any, Transition], None]]] = {}
+
+
+def on_enter(*statuses: str) -> Callable:
+    """Register ``hook(con, transition)`` to run inside the transaction when an order enters ``statuses``."""
+
+    def register(hook: Callable[[Any, Transition], None]) -> Callable[[Any, Transition], None]:
+        for status in statuses:
+            _HOOKS.setdefault(status, []).append(hook)
+        return hook
+
+    return register
+
+
+def transition(
+    order_id: int,
+    to_status: str,
+    *,
+    expected: str | Iterable[str] | None = None,
+    refund_note: str | None = None,
+    card_refund_note: str | None = None,
+    admin: bool = False,
+) -> Transition | None:
+    """Move an order to ``to_status`` if its current status allows it.
+
+    ``expected`` narrows the accepted current status(es), normally to what
+    the caller last saw; ``admin`` also allows :data:`ADMIN_TRANSITIONS`.  Returns ``None`` when the order is missing, the
+    move is not in :data:`TRANSITIONS`, or another writer got there first.
+    """
+
+    if isinstance(expected, str) or expected is None:
+        expected_set = None if expected is None else {expected}
+    else:
+        expected_set = set(expected)
+    allowed = [src for src in sources(to_status, admin=admin) if expected_set is None or src in expected_set]
+    if not allowed:
+        return None
+
+    now = datetime.now().isoformat(timespec="seconds")
+    placeholders = ",".join("?" * len(allowed))
+    with transaction() as con:
+        from_status = allowed[0]
+        if len(allowed) > 1:
+            current = con.execute("SELECT IFNULL(status, '') FROM orders WHERE id=?", (order_id,)).fetchone()
+            if current is None or current[0] not in allowed:
+                return None
+            from_status = current[0]
+        row = con.execute(
+            f"""
+            UPDATE orders SET status=?, updated_at=?
+            WHERE id=? AND IFNULL(status, '') IN ({placeholders})
+            RETURNING *
+            """,
+            (to_status, now, order_id, *allowed),
+        ).fetchone()
+        if row is None:
+            return None
+        cache.invalidate(f"order:{order_id}")
+        result = Transition(
+            order=dict(row),
+            from_status=from_status,
+            to_status=to_status,
+            refund_note=refund_note,
+            card_refund_note=card_refund_note,
+        )
+        for hook in _HOOKS.get(to_status, ()):
+            hook(con, result)
+    return result
+
+
+# --- اثرهای مالی -------------------------------------------------------------
+
+
+def settle_reservation(con, order: dict[str, Any]) -> int:
+    reserved = int(order.get("wallet_reserved_amount") or 0)
+    if reserved <= 0:
+        return 0
+    used = int(order.get("wallet_used_amount") or 0) + reserved
+    con.execute(
+        "UPDATE orders SET wallet_reserved_amount=0, wallet_used_amount=? WHERE id=?",
+        (used, order["id"]),
+    )
+    order["wallet_reserved_amount"] = 0
+    order["wallet_used_amount"] = used
+    cache.invalidate(f"order:{order['id']}")
+    return reserved
+
+
+def credit_cashback(con, order: dict[str, Any]) -> int:
+    try:
+        percent = max(int(order.get("cashback_percent") or 0), 0)
+    except (TypeError, ValueError):
+        percent = 0
+    if percent <= 0 or not order.get("user_id"):
+        return 0
+    base_amount = int(order.get("amount_total") or order.get("price") or 0)
+    cashback_total = max((base_amount * percent) // 100, 0)
+    remaining = max(cashback_total - int(order.get("cashback_applied_amount") or 0), 0)
+    if remaining <= 0:
+        return 0
+    order_id = int(order["id"])
+    if not ledger.post(order["user_id"], remaining, "CREDIT", note=f"CASHBACK:ORDER:{order_id}", order_id=order_id):
+        return 0
+    con.execute(
+        "UPDATE orders SET cashback_applied_amount=?, updated_at=? WHERE id=?",
+        (cashback_total, datetime.now().isoformat(timespec="seconds"), order_id),
+    )
+    order["cashback_applied_amount"] = cashback_total
+    cache.invalidate(f"order:{order_id}")
+    return remaining
+
+
+def refund(
+    con,
+    order: dict[str, Any],
+    note: str,
+    *,
+    include_used: bool = False,
+    card_refund_note: str | None = None,
+) -> int:
+    """Credit an order's wallet money (and optionally its card part) back to its owner."""
+
+    if not order.get("user_id"):
+        return 0
+    order_id = int(order["id"])
+    user_id = int(order["user_id"])
+    reserved = int(order.get("wallet_reserved_amount") or 0)
+    used = int(order.get("wallet_used_amount") or 0)
+    total = int(order.get("amount_total") or 0)
+    card_part = max(total - reserved - used, 0)
+
+    postings: list[tuple[str | None, ledger.Posting]] = []
+    if reserved > 0:
+        postings.append(("wallet_reserved_amount", ledger.Posting(user_id, reserved, "REFUND", note, order_id)))
+    if include_used and used > 0:
+        postings.append(("wallet_used_amount", ledger.Posting(user_id, used, "REFUND", note, order_id)))
+    if card_refund_note is not None and card_part > 0:
+        postings.append((None, ledger.Posting(user_id, card_part, "CREDIT", card_refund_note, order_id)))
+    results = ledger.post_many(p for _, p in postings)
+
+    refunded = 0
+    now = datetime.now().isoformat(timespec="seconds")
+    for (column, posting), ok in zip(postings, results):
+        if not ok:
+            continue
+        refunded += posting.delta
+        if column:
+            con.execute(f"UPDATE orders SET {column}=0, updated_at=? WHERE id=?", (now, order_id))
+            order[column] = 0
+    if refunded:
+        cache.invalidate(f"order:{order_id}")
+    return refunded
+
+
+@on_enter(*SETTLE_STATUSES)
+def _settle_hook(con, t: Transition) -> None:
+    t.settled = settle_reservation(con, t.order)
+
+
+@on_enter(*CASHBACK_STATUSES)
+def _cashback_hook(con, t: Transition) -> None:
+    t.cashback = credit_cashback(con, t.order)
+
+
+@on_enter("CANCELED")
+def _cancel_hook(con, t: Transition) -> None:
+    order_id = t.order["id"]
+    t.refunded = refund(con, t.order, t.refund_note or f"Cancel order #{order_id}")
+
+
+@on_enter("EXPIRED")
+def _expire_hook(con, t: Transition) -> None:
+    # همان یادداشت انقضای گروهی (expire_orders_and_refund)
+    t.refunded = refund(con, t.order, t.refund_note or f"Expire order #{t.order['id']}")
+
+
+@on_enter("REJECTED")
+def _reject_hook(con, t: Transition) -> None:
+    order_id = t.order["id"]
+    t.refunded = refund(
+        con,
+        t.order,
+        t.refund_note or f"Order #{order_id} rejected",
+        include_used=True,
+        card_refund_note=t.card_refund_note or f"Order #{order_id} card refund",
+    )
+
+
+__all__ = [
+    "ACTIVE",
+    "ADMIN_TRANSITIONS",
+    "CASHBACK_STATUSES",
+    "LEGACY_AWAITING",
+    "SETTLE_STATUSES",
+    "TRANSITIONS",
+    "Transition",
+    "can_transition",
+    "credit_cashback",
+    "on_enter",
+    "refund",
+    "settle_reservation",
+    "sources",
+    "transition",
+]
@@ -0,0 +1,366 @@
+"""Rate-limited queue for outgoing Telegram messages.
+
+Notifications used to be sent inline, one ``await bot.send_message`` after
+the other, with every error swallowed.  A burst (a receipt fanned out to
+all admins, a wave of expiry notices) then ran into Telegram's limits of
+about 30 messages per second per bot and one per second per chat (20 per
+minute in groups), and the 429s were silently lost.
+
+:data:`outbox` queues aiogram method objects (``SendMessage``,
+``SendPhoto``, ...) and delivers them from one background task:
+
+* a global token bucket (``OUTBOX_GLOBAL_RATE``) and one per chat
+  (``OUTBOX_CHAT_RATE`` / ``OUTBOX_CHAT_BURST``, ``OUTBOX_GROUP_RATE`` for
+  negative chat ids), so a busy chat never holds up the others;
+* at most ``OUTBOX_CONCURRENCY`` requests in flight and one per chat, which
+  keeps the messages of a chat in order;
+* :class:`Priority`: the most urgent waiting message of any ready chat goes
+  first, so payment confirmations overtake bulk messages;
+* ``RetryAfter`` (429) pauses only that chat for the time Telegram asks;
+  network and server errors are retried with backoff up to
+  ``OUTBOX_MAX_ATTEMPTS``; "blocked by the user" and other bad requests fail
+  at once.
+
+:meth:`Outbox.send` returns a future with the sent ``Message`` (or
+whatever the method returns), or ``None`` when delivery failed; it never
+raises, so fire-and-forget callers do not leak unretrieved exceptions.
+Callers that record the outcome (the durable queue in
+:mod:`app.notifications`) pass ``errors=True`` and get the last exception
+instead.
+Bulk (``LOW``) messages are refused once ``OUTBOX_QUEUE_LIMIT`` messages
+are waiting.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendMessage, TelegramMethod
+
+from .config import (
+    OUTBOX_CHAT_BURST,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_CONCURRENCY,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_GROUP_RATE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_QUEUE_LIMIT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    HIGH = 0  # پرداخت و وضعیت سفارش
+    NORMAL = 1  # اعلان‌های عادی
+    LOW = 2  # پیام‌های انبوه و تبلیغاتی
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _fill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """Monotonic time at which one token is available."""
+
+        self._fill(now)
+        if self.tokens >= 1.0 or self.rate <= 0:
+            return now
+        return now + (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._fill(now)
+        self.tokens -= 1.0
+
+
+class _Job:
+    __slots__ = ("bot", "method", "priority", "seq", "future", "errors", "queued_at", "attempts")
+
+    def __init__(
+        self, bot: Bot, method: TelegramMethod, priority: int, seq: int, future: asyncio.Future, errors: bool
+    ) -> None:
+        self.bot = bot
+        self.method = method
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.errors = errors
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+    def __lt__(self, other: _Job) -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Chat:
+    __slots__ = ("jobs", "bucket", "not_before", "in_flight", "ticket")
+
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.jobs: list[_Job] = []
+        self.bucket = bucket
+        self.not_before = 0.0
+        self.in_flight = False
+        # هر زمان‌بندی دوباره ticket را عوض می‌کند و ورودی‌های قدیمی صف‌ها باطل می‌شوند
+        self.ticket = 0
+
+
+class Outbox:
+    def __init__(
+        self,
+        *,
+        global_rate: float = OUTBOX_GLOBAL_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: float = OUTBOX_CHAT_BURST,
+        group_rate: float = OUTBOX_GROUP_RATE,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        queue_limit: int = OUTBOX_QUEUE_LIMIT,
+    ) -> None:
+        self.global_rate = float(global_rate)
+        self.chat_rate = float(chat_rate)
+        self.chat_burst = float(chat_burst)
+        self.group_rate = float(group_rate)
+        self.concurrency = max(int(concurrency), 1)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.queue_limit = max(int(queue_limit), 1)
+        # بدون انفجار: در هر بازهٔ یک‌ثانیه‌ای حداکثر global_rate + 1 پیام
+        self._global = TokenBucket(self.global_rate, 1)
+        self._chats: dict[Any, _Chat] = {}
+        # (priority, seq, ticket, chat_id) برای چت‌هایی که همین حالا مجاز به ارسال‌اند
+        self._ready: list[tuple[int, int, int, Any]] = []
+        # (ready_at, seq, ticket, chat_id) برای چت‌هایی که منتظر سهمیه یا RetryAfter هستند
+        self._waiting: list[tuple[float, int, int, Any]] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._task: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self._latency_total = 0.0
+        self.max_latency = 0.0
+
+    # --- صف ---------------------------------------------------------------------
+
+    def send(
+        self, bot: Bot, method: TelegramMethod, *, priority: int = Priority.NORMAL, errors: bool = False
+    ) -> asyncio.Future:
+        """Queue ``method`` for ``bot``; the future resolves to its result, or ``None`` if delivery failed.
+
+        With ``errors=True`` a failed delivery sets the last exception on the future instead.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        if priority >= Priority.LOW and self.pending >= self.queue_limit:
+            self.dropped += 1
+            future.set_result(None)
+            return future
+        self._ensure_running()
+        chat_id = getattr(method, "chat_id", None)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _Chat(TokenBucket(rate, self.chat_burst))
+        priority = min(max(int(priority), Priority.HIGH), Priority.LOW)
+        job = _Job(bot, method, priority, next(self._seq), future, errors)
+        heapq.heappush(chat.jobs, job)
+        self.pending += 1
+        if not chat.in_flight and chat.jobs[0] is job:
+            # پیام تازه جلوی صف این چت است (چت تازه یا اولویت بالاتر)
+            self._schedule(chat_id, chat)
+        return future
+
+    def send_message(
+        self,
+        bot: Bot,
+        chat_id: int | str,
+        text: str,
+        *,
+        priority: int = Priority.NORMAL,
+        errors: bool = False,
+        **kwargs: Any,
+    ) -> asyncio.Future:
+        return self.send(bot, SendMessage(chat_id=chat_id, text=text, **kwargs), priority=priority, errors=errors)
+
+    def _schedule(self, chat_id: Any, chat: _Chat) -> None:
+        chat.ticket += 1
+        now = time.monotonic()
+        ready_at = max(chat.bucket.ready_at(now), chat.not_before)
+        if ready_at <= now:
+            head = chat.jobs[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat.ticket, chat_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, next(self._seq), chat.ticket, chat_id))
+        self._wakeup.set()
+
+    def _valid(self, chat_id: Any, ticket: int) -> _Chat | None:
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.ticket != ticket or chat.in_flight or not chat.jobs:
+            return None
+        return chat
+
+    def _next_ready(self, now: float) -> tuple[Any, _Chat] | None:
+        while self._waiting and self._waiting[0][0] <= now:
+            _, _, ticket, chat_id = heapq.heappop(self._waiting)
+            chat = self._valid(chat_id, ticket)
+            if chat is not None:
+                head = chat.jobs[0]
+                heapq.heappush(self._ready, (head.priority, head.seq, ticket, chat_id))
+        while self._ready:
+            _, _, ticket, chat_id = heapq.heappop(self._ready)
+            chat = self._valid(chat_id, ticket)
+            if chat is not None:
+                return chat_id, chat
+        return None
+
+    # --- ارسال ------------------------------------------------------------------
+
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._run(), name="outbox")
+
+    async def _run(self) -> None:
+        while True:
+            await self._slots.acquire()
+            delay = self._global.ready_at(time.monotonic()) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while True:
+                now = time.monotonic()
+                picked = self._next_ready(now)
+                if picked is not None:
+                    break
+                self._wakeup.clear()
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            chat_id, chat = picked
+            now = time.monotonic()
+            self._global.take(now)
+            chat.bucket.take(now)
+            chat.in_flight = True
+            chat.ticket += 1
+            job = heapq.heappop(chat.jobs)
+            task = asyncio.create_task(self._deliver(chat_id, chat, job))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: Any, chat: _Chat, job: _Job) -> None:
+        job.attempts += 1
+        done, ok, result, error = True, False, None, None
+        try:
+            result = await job.bot(job.method)
+            ok = True
+        except TelegramRetryAfter as e:
+            error = e
+            self.rate_limited += 1
+            chat.not_before = time.monotonic() + float(e.retry_after)
+            done = job.attempts >= self.max_attempts
+        except (TelegramNetworkError, TelegramServerError) as e:
+            error = e
+            done = job.attempts >= self.max_attempts
+            if not done:
+                chat.not_before = time.monotonic() + min(2.0 ** (job.attempts - 1), 30.0)
+            else:
+                logger.warning("outbox: giving up on chat %s after %s attempts: %s", chat_id, job.attempts, e)
+        except Exception as e:
+            # کاربر ربات را بسته، چت وجود ندارد، متن نامعتبر است و ...
+            error = e
+            logger.info("outbox: %s to chat %s failed: %s", type(job.method).__name__, chat_id, e)
+        finally:
+            chat.in_flight = False
+            self._slots.release()
+        if done:
+            self.pending -= 1
+            if not ok:
+                self.failed += 1
+            else:
+                self.sent += 1
+                latency = time.monotonic() - job.queued_at
+                self._latency_total += latency
+                self.max_latency = max(self.max_latency, latency)
+            if job.future.done():
+                pass
+            elif not ok and job.errors and error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+        else:
+            self.retried += 1
+            heapq.heappush(chat.jobs, job)
+        if chat.jobs:
+            self._schedule(chat_id, chat)
+        elif self._chats.get(chat_id) is chat:
+            del self._chats[chat_id]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Deliver what is queued (at most ``timeout`` seconds), then stop; leftovers resolve to ``None``."""
+
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self._deliveries:
+            await asyncio.wait(set(self._deliveries), timeout=max(deadline - time.monotonic(), 0.1))
+        if self.pending:
+            logger.warning("outbox: %s messages were not delivered before shutdown", self.pending)
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                if not job.future.done():
+                    job.future.set_result(None)
+        self._chats.clear()
+        self._ready.clear()
+        self._waiting.clear()
+        self.pending = 0
+
+    def stats(self) -> dict[str, Any]:
+        queued = {p.name.lower(): 0 for p in Priority}
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                queued[Priority(job.priority).name.lower()] += 1
+        return {
+            "pending": self.pending,
+            "queued": queued,
+            "in_flight": len(self._deliveries),
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "dropped": self.dropped,
+            "avg_latency_ms": round(self._latency_total / self.sent * 1000, 1) if self.sent else 0.0,
+            "max_latency_ms": round(self.max_latency * 1000, 1),
+        }
+
+
+outbox = Outbox()
+
+
+__all__ = ["Outbox", "Priority", "TokenBucket", "outbox"]
@@ -1,30 +1,14 @@
 from aiogram import F
 from aiogram.fsm.context import FSMContext
-from datetime import datetime
 
 from aiogram.types import CallbackQuery, Message
 
 from . import router
-from .helpers import _notify_admins, _order_title
-from ..config import ADMIN_IDS, CARD_NAME, CARD_NUMBER, CURRENCY
-from ..db import (
-    apply_discount_to_order,
-    change_wallet,
-    get_order,
-    get_user,
-    get_cart_order,
-    is_user_contact_verified,
-    get_order_payable_amount,
-    set_order_customer_message,
-    set_order_payment_type,
-    set_order_receipt,
-    set_order_status,
-    set_order_wallet_reserved,
-    set_order_wallet_used,
-    user_has_delivered_order,
-    refresh_order_deadline,
-    remove_order_discount,  # اطمینان حاصل کنید این تابع در db.py وجود دارد
-)
+from .helpers import _notify_admins, _order_closed_text, _order_title
+from ..config import CARD_NAME, CARD_NUMBER, CURRENCY
+from ..outbox import Priority
+from ..db import get_order_payable_amount
+from ..repository import repo
 from ..keyboards import (
     ik_card_receipt_prompt,
     ik_wallet_confirm,
@@ -40,27 +24,13 @@ from ..states import CheckoutStates, VerifyStates
 from ..utils import mention
 
 
-def _load_payable_order(order_id: int, user_id: int) -> dict | None:
-    order = get_cart_order(order_id, user_id)
-    if not order:
-        return None
-
-    try:
-        deadline_raw = (order.get("await_deadline") or "").strip()
-        if deadline_raw and datetime.fromisoformat(deadline_raw) <= datetime.now():
-            return None
-    except ValueError:
-        refresh_order_deadline(order_id)
-        order = get_cart_order(order_id, user_id)
-
-    if not order or (order.get("status") or "") not in {"AWAITING_PAYMENT", "PENDING_CONFIRM"}:
-        return None
-
-    return order
+async def _load_payable_order(order_id: int, user_id: int) -> dict | None:
+    # get_cart_order فقط سفارش‌های قابل پرداخت با مهلت باز را برمی‌گرداند
+    return await repo.get_cart_order(order_id, user_id)
 
 
 async def _require_contact_verification(callback: CallbackQuery, state: FSMContext) -> bool:
-    if is_user_contact_verified(callback.from_user.id):
+    if await repo.is_user_contact_verified(callback.from_user.id):
         return True
     await state.set_state(VerifyStates.wait_contact)
     await callback.message.answer(
@@ -78,7 +48,7 @@ def _order_allows_plan(order: dict) -> bool:
 # --- New Checkout Logic ---
 
 async def _show_checkout_summary(callback: CallbackQuery, state: FSMContext, order_id: int):
-    order = get_order(order_id)
+    order = await repo.get_order(order_id)
     if not order:
         await callback.answer("سفارش یافت نشد.", show_alert=True)
         return
@@ -127,7 +97,7 @@ async def _continue_payment(callback: CallbackQuery, state: FSMContext) -> None:
     order_id = int(pending.get("order_id") or 0)
     method = pending.get("method")
     
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش قابل ادامه نیست.", show_alert=True)
         await state.clear()
@@ -135,8 +105,12 @@ async def _continue_payment(callback: CallbackQuery, state: FSMContext) -> None:
 
     payable = get_order_payable_amount(order)
     if payable <= 0:
-        set_order_payment_type(order_id, method or "DISCOUNT")
-        set_order_status(order_id, "IN_PROGRESS")
+        await repo.set_order_payment_type(order_id, method or "DISCOUNT")
+        if not await repo.set_order_status(order_id, "IN_PROGRESS"):
+            await callback.message.answer(_order_closed_text(order_id), reply_markup=reply_main())
+            await state.clear()
+            await callback.answer()
+            return
         await callback.message.answer(
             f"✅ تخفیف اعمال شد و مبلغی برای پرداخت باقی نمانده است. سفارش #{order_id} در حال پردازش است.",
             reply_markup=reply_main(),
@@ -149,7 +123,7 @@ async def _continue_payment(callback: CallbackQuery, state: FSMContext) -> None:
     # await state.update_data(pending_payment=None) # حذف شد تا متد حفظ شود
 
     if method == "CARD":
-        set_order_payment_type(order_id, "CARD")
+        await repo.set_order_payment_type(order_id, "CARD")
         await state.update_data(
             order_receipt_for=order_id,
             receipt_file_id=None,
@@ -171,7 +145,7 @@ async def _continue_payment(callback: CallbackQuery, state: FSMContext) -> None:
         return
 
     if method == "WALLET":
-        user = get_user(callback.from_user.id)
+        user = await repo.get_user(callback.from_user.id)
         if int(user.get("wallet_balance") or 0) < payable:
             await callback.answer("موجودی کیف پول کافی نیست.", show_alert=True)
             return
@@ -208,7 +182,7 @@ async def cb_cart_paycard(callback: CallbackQuery, state: FSMContext) -> None:
     if not await _require_contact_verification(callback, state):
         return
     order_id = int(callback.data.split(":")[2])
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش نامعتبر یا منقضی است.", show_alert=True)
         return
@@ -220,7 +194,7 @@ async def cb_cart_paywallet(callback: CallbackQuery, state: FSMContext) -> None:
     if not await _require_contact_verification(callback, state):
         return
     order_id = int(callback.data.split(":")[2])
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش نامعتبر یا منقضی است.", show_alert=True)
         return
@@ -232,7 +206,7 @@ async def cb_cart_paymix(callback: CallbackQuery, state: FSMContext) -> None:
     if not await _require_contact_verification(callback, state):
         return
     order_id = int(callback.data.split(":")[2])
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش نامعتبر یا منقضی است.", show_alert=True)
         return
@@ -280,7 +254,7 @@ async def cb_checkout_input_disc(callback: CallbackQuery, state: FSMContext) ->
 async def cb_checkout_remove_disc(callback: CallbackQuery, state: FSMContext) -> None:
     """کاربر دکمه 'حذف کد تخفیف' را زده است."""
     order_id = int(callback.data.split(":")[3])
-    if remove_order_discount(order_id):
+    if await repo.remove_order_discount(order_id):
         await callback.answer("کد تخفیف حذف شد.", show_alert=True)
     else:
         await callback.answer("خطایی رخ داد یا کدی وجود نداشت.", show_alert=True)
@@ -291,7 +265,7 @@ async def cb_checkout_remove_disc(callback: CallbackQuery, state: FSMContext) ->
 async def cb_checkout_back(callback: CallbackQuery, state: FSMContext) -> None:
     """دکمه بازگشت به صفحه انتخاب روش پرداخت (سبد خرید)"""
     order_id = int(callback.data.split(":")[2])
-    order = get_order(order_id)
+    order = await repo.get_order(order_id)
     await state.clear()  # پاک کردن استیت‌های موقت
     
     if order and order.get("user_id") == callback.from_user.id:
@@ -356,7 +330,7 @@ async def cb_checkout_apply_disc(callback: CallbackQuery, state: FSMContext) ->
         await callback.answer("هنوز کدی ارسال نکرده‌اید!", show_alert=True)
         return
 
-    success, result, error = apply_discount_to_order(order_id, callback.from_user.id, code)
+    success, result, error = await repo.apply_discount_to_order(order_id, callback.from_user.id, code)
     
     if success:
         # پاک کردن کد موقت از استیت
@@ -375,7 +349,7 @@ async def cb_checkout_apply_disc(callback: CallbackQuery, state: FSMContext) ->
 async def on_card_receipt(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data.get("order_receipt_for")
-    order = get_order(int(order_id)) if order_id else None
+    order = await repo.get_order(int(order_id)) if order_id else None
     if not order or order["user_id"] != message.from_user.id:
         await message.answer("سفارش یافت نشد یا معتبر نیست.", reply_markup=reply_main())
         await state.clear()
@@ -417,7 +391,7 @@ async def on_card_receipt(message: Message, state: FSMContext) -> None:
 async def on_card_comment(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data.get("order_receipt_for")
-    order = get_order(int(order_id)) if order_id else None
+    order = await repo.get_order(int(order_id)) if order_id else None
     if not order or order["user_id"] != message.from_user.id:
         await message.answer("سفارش یافت نشد یا معتبر نیست.", reply_markup=reply_main())
         await state.clear()
@@ -467,7 +441,7 @@ async def cb_receipt_confirm(callback: CallbackQuery, state: FSMContext) -> None
     if not current or int(current) != order_id:
         await callback.answer("رسید برای این سفارش پیدا نشد.", show_alert=True)
         return
-    order = get_order(order_id)
+    order = await repo.get_order(order_id)
     if not order or order["user_id"] != callback.from_user.id:
         await callback.answer("سفارش یافت نشد یا منقضی شده است.", show_alert=True)
         await state.clear()
@@ -478,9 +452,13 @@ async def cb_receipt_confirm(callback: CallbackQuery, state: FSMContext) -> None
     receipt_comment = data.get("receipt_comment") or ""
     receipt_kind = data.get("receipt_kind")
 
-    set_order_receipt(order_id, receipt_file_id, receipt_text)
-    set_order_customer_message(order_id, receipt_comment)
-    set_order_status(order_id, "PENDING_CONFIRM")
+    if not await repo.set_order_status(order_id, "PENDING_CONFIRM"):
+        await callback.message.answer(_order_closed_text(order_id), reply_markup=reply_main())
+        await callback.answer()
+        await state.clear()
+        return
+    await repo.set_order_receipt(order_id, receipt_file_id, receipt_text)
+    await repo.set_order_customer_message(order_id, receipt_comment)
 
     await callback.message.answer(
         f"✅ رسید سفارش #{order_id} ثبت شد.\nوضعیت: «در انتظار تایید پرداخت»",
@@ -497,26 +475,22 @@ async def cb_receipt_confirm(callback: CallbackQuery, state: FSMContext) -> None
     if receipt_comment:
         admin_caption += f"\n\n📝 توضیح مشتری:\n{receipt_comment}"
 
-    for admin_id in ADMIN_IDS:
-        try:
-            if receipt_file_id and receipt_kind == "photo":
-                await callback.bot.send_photo(admin_id, receipt_file_id, caption=admin_caption)
-            elif receipt_file_id and receipt_kind == "document":
-                await callback.bot.send_document(admin_id, receipt_file_id, caption=admin_caption)
-            else:
-                text_body = admin_caption
-                if receipt_text:
-                    text_body += f"\n\nمتن رسید:\n{receipt_text}"
-                await callback.bot.send_message(admin_id, text_body)
-        except Exception:
-            pass
+    if receipt_file_id and receipt_kind == "photo":
+        await _notify_admins(callback.bot, admin_caption, photo=receipt_file_id, priority=Priority.HIGH)
+    elif receipt_file_id and receipt_kind == "document":
+        await _notify_admins(callback.bot, admin_caption, document=receipt_file_id, priority=Priority.HIGH)
+    else:
+        text_body = admin_caption
+        if receipt_text:
+            text_body += f"\n\nمتن رسید:\n{receipt_text}"
+        await _notify_admins(callback.bot, text_body, priority=Priority.HIGH)
 
 
 @router.message(CheckoutStates.wait_wallet_comment)
 async def on_wallet_comment(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data.get("wallet_for")
-    order = get_order(int(order_id)) if order_id else None
+    order = await repo.get_order(int(order_id)) if order_id else None
     if not order or order["user_id"] != message.from_user.id:
         await message.answer("سفارش معتبر نیست یا منقضی شده است.", reply_markup=reply_main())
         await state.clear()
@@ -541,7 +515,7 @@ async def cb_wallet_confirm(callback: CallbackQuery, state: FSMContext) -> None:
     if not current or int(current) != order_id:
         await callback.answer("پرداخت کیف پول برای این سفارش فعال نیست.", show_alert=True)
         return
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش قابل پرداخت نیست.", show_alert=True)
         await state.clear()
@@ -549,18 +523,18 @@ async def cb_wallet_confirm(callback: CallbackQuery, state: FSMContext) -> None:
     payable = get_order_payable_amount(order)
     amount = int(data.get("wallet_amount") or payable)
     amount = min(amount, payable)
-    user = get_user(callback.from_user.id)
+    user = await repo.get_user(callback.from_user.id)
     if int(user["wallet_balance"]) < amount:
         await callback.answer("موجودی کیف پول کافی نیست.", show_alert=True)
         return
-    if not change_wallet(callback.from_user.id, -amount, "DEBIT", note=f"Order #{order_id}", order_id=order_id):
-        await callback.answer("عدم امکان کسر از کیف پول.", show_alert=True)
-        return
     comment = data.get("wallet_comment") or ""
-    set_order_wallet_used(order_id, amount)
-    set_order_payment_type(order_id, "WALLET")
-    set_order_customer_message(order_id, comment)
-    set_order_status(order_id, "IN_PROGRESS")
+    # کسر از کیف پول و تغییر وضعیت با هم انجام می‌شوند؛ سفارش منقضی‌شده پولی کسر نمی‌کند
+    ok, _, error = await repo.pay_order_from_wallet(order_id, callback.from_user.id, amount, comment)
+    if not ok:
+        await callback.message.answer(f"⚠️ {error}\nمبلغی از کیف پول شما کسر نشد.", reply_markup=reply_main())
+        await callback.answer()
+        await state.clear()
+        return
     await callback.message.answer(
         f"✅ پرداخت کیف پول برای سفارش #{order_id} انجام شد.\nوضعیت: «در حال انجام»",
         reply_markup=reply_main(),
@@ -570,7 +544,7 @@ async def cb_wallet_confirm(callback: CallbackQuery, state: FSMContext) -> None:
     notice = f"👛 پرداخت کیف پول — سفارش #{order_id} توسط {mention(callback.from_user)}"
     if comment:
         notice += f"\n\n📝 توضیح مشتری:\n{comment}"
-    await _notify_admins(callback.bot, notice)
+    await _notify_admins(callback.bot, notice, priority=Priority.HIGH)
 
 
 @router.callback_query(F.data.startswith("cart:payplan:"))
@@ -578,7 +552,7 @@ async def cb_cart_payplan(callback: CallbackQuery, state: FSMContext) -> None:
     if not await _require_contact_verification(callback, state):
         return
     order_id = int(callback.data.split(":")[2])
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش نامعتبر یا منقضی است.", show_alert=True)
         return
@@ -586,11 +560,11 @@ async def cb_cart_payplan(callback: CallbackQuery, state: FSMContext) -> None:
     if not allow_plan:
         await callback.answer("این طرح فقط برای سفارش‌های مجاز در دسترس است.", show_alert=True)
         return
-    if user_has_delivered_order(callback.from_user.id):
+    if await repo.user_has_delivered_order(callback.from_user.id):
         await callback.answer("شما قبلاً از این طرح استفاده کرده‌اید.", show_alert=True)
         await callback.message.answer("⚠️ شما قبلاً سفارش تحویل‌شده دارید و امکان استفاده مجدد از طرح خرید اول وجود ندارد.")
         return
-    set_order_payment_type(order_id, "FIRST_PLAN")
+    await repo.set_order_payment_type(order_id, "FIRST_PLAN")
     await state.update_data(plan_for=order_id, plan_comment="")
     await state.set_state(CheckoutStates.wait_plan_comment)
     await callback.message.answer(
@@ -604,7 +578,7 @@ async def cb_cart_payplan(callback: CallbackQuery, state: FSMContext) -> None:
 async def on_plan_comment(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data.get("plan_for")
-    order = get_order(int(order_id)) if order_id else None
+    order = await repo.get_order(int(order_id)) if order_id else None
     if not order or order["user_id"] != message.from_user.id:
         await message.answer("سفارش یافت نشد یا معتبر نیست.", reply_markup=reply_main())
         await state.clear()
@@ -652,7 +626,7 @@ async def cb_plan_confirm(callback: CallbackQuery, state: FSMContext) -> None:
     if not current or int(current) != order_id:
         await callback.answer("طرح خرید اول برای این سفارش فعال نیست.", show_alert=True)
         return
-    order = _load_payable_order(order_id, callback.from_user.id)
+    order = await _load_payable_order(order_id, callback.from_user.id)
     if not order:
         await callback.answer("سفارش یافت نشد یا منقضی شده است.", show_alert=True)
         await state.clear()
@@ -663,9 +637,13 @@ async def cb_plan_confirm(callback: CallbackQuery, state: FSMContext) -> None:
         await state.clear()
         return
     comment = data.get("plan_comment") or ""
-    set_order_customer_message(order_id, comment)
-    set_order_status(order_id, "PENDING_PLAN")
-    set_order_payment_type(order_id, "FIRST_PLAN")
+    if not await repo.set_order_status(order_id, "PENDING_PLAN"):
+        await callback.message.answer(_order_closed_text(order_id), reply_markup=reply_main())
+        await callback.answer()
+        await state.clear()
+        return
+    await repo.set_order_customer_message(order_id, comment)
+    await repo.set_order_payment_type(order_id, "FIRST_PLAN")
     await callback.message.answer(
         f"✅ درخواست طرح خرید اول برای سفارش #{order_id} ثبت شد.\nوضعیت: «در انتظار تایید طرح»",
         reply_markup=reply_main(),
@@ -686,7 +664,7 @@ async def cb_plan_confirm(callback: CallbackQuery, state: FSMContext) -> None:
     )
     if comment:
         notice += f"\n\n📝 توضیح مشتری:\n{comment}"
-    await _notify_admins(callback.bot, notice)
+    await _notify_admins(callback.bot, notice, priority=Priority.HIGH)
 
 
 @router.message(CheckoutStates.wait_mixed_amount)
@@ -698,30 +676,23 @@ async def on_mixed_amount(message: Message, state: FSMContext) -> None:
     amt_wallet = int(text)
     data = await state.get_data()
     order_id = int(data.get("mixed_for"))
-    order = _load_payable_order(order_id, message.from_user.id)
+    order = await _load_payable_order(order_id, message.from_user.id)
     if not order:
         await message.answer("سفارش نامعتبر یا منقضی است.", reply_markup=reply_main())
         await state.clear()
         return
     total = int(data.get("mixed_total") or get_order_payable_amount(order))
-    user = get_user(message.from_user.id)
+    user = await repo.get_user(message.from_user.id)
     if amt_wallet <= 0 or amt_wallet > total:
         await message.answer("مقدار نامعتبر است.")
         return
     if int(user["wallet_balance"]) < amt_wallet:
         await message.answer("موجودی کیف پول کافی نیست.")
         return
-    if not change_wallet(
-        message.from_user.id,
-        -amt_wallet,
-        "RESERVE",
-        note=f"Reserve for order #{order_id}",
-        order_id=order_id,
-    ):
-        await message.answer("امکان رزرو کیف پول نیست.")
-        return
-    set_order_wallet_reserved(order_id, amt_wallet)
-    set_order_payment_type(order_id, "MIXED")
+    ok, _, error = await repo.reserve_order_wallet(order_id, message.from_user.id, amt_wallet)
+    if not ok:
+        await message.answer(f"⚠️ {error}\nمبلغی از کیف پول شما کسر نشد.")
+        return
     await state.update_data(
         order_receipt_for=order_id,
         receipt_file_id=None,
@@ -743,14 +714,13 @@ async def on_mixed_amount(message: Message, state: FSMContext) -> None:
 @router.callback_query(F.data.startswith("cart:cancel:"))
 async def cb_cart_cancel(callback: CallbackQuery, state: FSMContext) -> None:
     order_id = int(callback.data.split(":")[2])
-    order = get_order(order_id)
+    order = await repo.get_order(order_id)
     if not order or order["user_id"] != callback.from_user.id or order["status"] not in ("AWAITING_PAYMENT", "PENDING_CONFIRM"):
         await callback.answer("قابل لغو نیست.", show_alert=True)
         return
-    reserved = int(order.get("wallet_reserved_amount") or 0)
-    if reserved > 0:
-        change_wallet(callback.from_user.id, reserved, "REFUND", note=f"Cancel order #{order_id}", order_id=order_id)
-        set_order_wallet_reserved(order_id, 0)
-    set_order_status(order_id, "CANCELED")
+    # لغو و بازگرداندن رزرو کیف پول در یک تراکنش؛ دوبار لغو هم‌زمان فقط یک بار اعمال می‌شود
+    if not await repo.transition_order(order_id, "CANCELED", expected=order["status"]):
+        await callback.answer("قابل لغو نیست.", show_alert=True)
+        return
     await callback.message.answer(f"❌ سفارش #{order_id} لغو شد.", reply_markup=reply_main())
     await callback.answer()
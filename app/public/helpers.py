@@ -4,7 +4,10 @@ from html import escape
 from html import escape
 from typing import Any
 
+from aiogram.methods import SendDocument, SendMessage, SendPhoto
+
 from ..config import CURRENCY, ADMIN_IDS
+from ..outbox import Priority, outbox
 
 
 def _price_to_int(value: str) -> int:
@@ -34,6 +37,14 @@ def _status_fa(code: str) -> str:
     }.get(code, code)
 
 
+def _order_closed_text(order_id: int) -> str:
+    # تغییر وضعیت رد شد؛ معمولاً چون مهلت پرداخت سفارش هم‌زمان تمام شده است
+    return (
+        f"⚠️ سفارش #{order_id} دیگر قابل ادامه نیست (ممکن است مهلت پرداخت آن تمام شده باشد).\n"
+        "در صورت پرداخت، با پشتیبانی تماس بگیرید."
+    )
+
+
 def _order_title(
     service_category: str,
     code: str,
@@ -63,12 +74,23 @@ def _order_title(
     return "سفارش"
 
 
-async def _notify_admins(bot: Any, text: str) -> None:
+async def _notify_admins(
+    bot: Any,
+    text: str,
+    *,
+    photo: str | None = None,
+    document: str | None = None,
+    priority: int = Priority.NORMAL,
+) -> None:
+    # فقط در صف ارسال گذاشته می‌شود؛ هندلر منتظر تحویل به همهٔ ادمین‌ها نمی‌ماند
     for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, text)
-        except Exception:
-            pass
+        if photo:
+            method = SendPhoto(chat_id=admin_id, photo=photo, caption=text)
+        elif document:
+            method = SendDocument(chat_id=admin_id, document=document, caption=text)
+        else:
+            method = SendMessage(chat_id=admin_id, text=text)
+        outbox.send(bot, method, priority=priority)
 
 
 def _fmt_order_for_user(order: dict[str, Any]) -> str:
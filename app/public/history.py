@@ -5,7 +5,7 @@ from aiogram.types import CallbackQuery
 from . import router
 from .helpers import _fmt_order_for_user
 from ..config import CURRENCY
-from ..db import count_orders_by_category, get_user_stats, list_orders_by_category
+from ..repository import repo
 from ..keyboards import ik_history_menu, ik_history_more, ik_profile_actions
 
 
@@ -17,7 +17,7 @@ async def cb_hist_menu(callback: CallbackQuery, state: FSMContext) -> None:
 
 @router.callback_query(F.data == "hist:back")
 async def cb_hist_back(callback: CallbackQuery, state: FSMContext) -> None:
-    stats = get_user_stats(callback.from_user.id)
+    stats = await repo.get_user_stats(callback.from_user.id)
     await callback.message.answer(
         "👤 <b>اطلاعات کاربری</b>\n"
         f"• موجودی کیف پول: <b>{stats['wallet_balance']} {CURRENCY}</b>\n"
@@ -34,9 +34,9 @@ async def cb_hist_back(callback: CallbackQuery, state: FSMContext) -> None:
 @router.callback_query(F.data.startswith("hist:show:"))
 async def cb_hist_show(callback: CallbackQuery, state: FSMContext) -> None:
     _, _, category, page_token = callback.data.split(":")
-    page = int(page_token.replace("p", "")) if page_token.startswith("p") else 1
+    # «b<id>»: ادامهٔ فهرست از سفارش‌های قدیمی‌تر از id؛ هر توکن دیگری یعنی صفحهٔ اول
+    before_id = int(page_token[1:]) if page_token.startswith("b") and page_token[1:].isdigit() else None
     page_size = 10
-    offset = (page - 1) * page_size
 
     category_label = {
         "inprog": "🟡 سفارشات در حال انجام",
@@ -44,26 +44,29 @@ async def cb_hist_show(callback: CallbackQuery, state: FSMContext) -> None:
         "all": "📚 تمام سفارشات",
     }.get(category, category)
 
-    total = count_orders_by_category(callback.from_user.id, category)
-    rows = list_orders_by_category(callback.from_user.id, category, limit=page_size, offset=offset)
+    rows = await repo.list_orders_by_category(
+        callback.from_user.id, category, limit=page_size + 1, before_id=before_id
+    )
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
 
-    if page == 1:
+    if before_id is None:
+        total = await repo.count_orders_by_category(callback.from_user.id, category)
         await callback.message.answer(f"{category_label} — مجموع: {total}")
 
     if not rows:
-        if page == 1:
-            await callback.message.answer("موردی یافت نشد.", reply_markup=ik_history_menu())
-        else:
-            await callback.message.answer("مورد دیگری برای نمایش نیست.", reply_markup=ik_history_more(category, page))
+        await callback.message.answer(
+            "موردی یافت نشد." if before_id is None else "مورد دیگری برای نمایش نیست.",
+            reply_markup=ik_history_menu(),
+        )
         await callback.answer()
         return
 
     for order in rows:
         await callback.message.answer(_fmt_order_for_user(order))
 
-    has_more = (offset + len(rows)) < total
     if has_more:
-        await callback.message.answer("—", reply_markup=ik_history_more(category, page + 1))
+        await callback.message.answer("—", reply_markup=ik_history_more(category, rows[-1]["id"]))
     else:
         await callback.message.answer("پایان لیست.", reply_markup=ik_history_menu())
 
@@ -8,7 +8,8 @@ from . import router
 from .channel_gate import ensure_member_for_message
 from .helpers import _order_title, _status_fa
 from ..config import CURRENCY, SUPPORT_USERNAME
-from ..db import ensure_user, get_order_payable_amount, get_user_stats, list_cart_orders
+from ..db import get_order_payable_amount
+from ..repository import repo
 from ..keyboards import (
     REPLY_BTN_CART,
     REPLY_BTN_PRODUCTS,
@@ -25,12 +26,12 @@ from ..keyboards import (
 async def on_reply_cart(message: Message, state: FSMContext) -> None:
     if not await ensure_member_for_message(message):
         return
-    ensure_user(
+    await repo.ensure_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name or "",
     )
-    orders = list_cart_orders(message.from_user.id)
+    orders = await repo.list_cart_orders(message.from_user.id)
     if not orders:
         await message.answer("🧺 سبد خرید شما خالی است.", reply_markup=reply_main())
         return
@@ -75,12 +76,12 @@ async def on_reply_cart(message: Message, state: FSMContext) -> None:
 async def on_reply_profile(message: Message, state: FSMContext) -> None:
     if not await ensure_member_for_message(message):
         return
-    ensure_user(
+    await repo.ensure_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name or "",
     )
-    stats = get_user_stats(message.from_user.id)
+    stats = await repo.get_user_stats(message.from_user.id)
     await message.answer(
         "👤 <b>اطلاعات کاربری</b>\n"
         f"• موجودی کیف پول: <b>{stats['wallet_balance']} {CURRENCY}</b>\n"
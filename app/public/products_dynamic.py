@@ -4,16 +4,9 @@ from aiogram.types import CallbackQuery, Message, User
 
 from . import router
 from .channel_gate import ensure_member_for_message
-from .helpers import _notify_admins
+from .helpers import _notify_admins, _order_closed_text
 from ..config import CURRENCY
-from ..db import (
-    create_order,
-    ensure_user,
-    get_user,
-    set_order_customer_message,
-    set_order_payment_type,
-    set_order_status,
-)
+from ..repository import repo
 from ..keyboards import (
     REPLY_BTN_PRODUCTS,
     ik_cart_actions,
@@ -46,7 +39,7 @@ def _resolve_price(product: dict, mode: str | None) -> tuple[int, bool]:
 
 
 async def _show_root(message: Message) -> None:
-    items = list_public_children()
+    items = await repo.read(list_public_children)
     if not items:
         await message.answer("هیچ محصول فعالی ثبت نشده است.", reply_markup=reply_main())
         return
@@ -65,8 +58,8 @@ async def _create_order_and_confirm(
     password: str | None,
 ) -> None:
     # Use tg_user explicitly instead of message.from_user to ensure we get the buyer, not the bot
-    ensure_user(tg_user.id, tg_user.username, tg_user.first_name or "")
-    user = get_user(tg_user.id)
+    await repo.ensure_user(tg_user.id, tg_user.username, tg_user.first_name or "")
+    user = await repo.get_user(tg_user.id)
     
     # Determine which requirement flags to store in order based on mode
     req_user = False
@@ -81,7 +74,7 @@ async def _create_order_and_confirm(
         req_user = bool(product.get("require_username"))
         req_pass = bool(product.get("require_password"))
 
-    order_id = create_order(
+    order_id = await repo.create_order(
         user=user,
         title=product.get("title") or f"محصول #{product_id}",
         amount_total=price,
@@ -222,7 +215,7 @@ async def on_reply_products(message: Message, state: FSMContext) -> None:
 async def cb_products_root(callback: CallbackQuery, state: FSMContext) -> None:
     await state.clear()
     await callback.message.edit_text("به فروشگاه خوش آمدید.")
-    await callback.message.answer("منو:", reply_markup=ik_dynamic_products(list_public_children()))
+    await callback.message.answer("منو:", reply_markup=ik_dynamic_products(await repo.read(list_public_children)))
     await callback.answer()
 
 
@@ -235,14 +228,14 @@ async def cb_open_category(callback: CallbackQuery, state: FSMContext) -> None:
         return
 
     parent_id = target_id or None
-    items = list_public_children(parent_id)
+    items = await repo.read(list_public_children, parent_id)
     if not items:
         await callback.answer("موردی یافت نشد.", show_alert=True)
         return
 
     back_parent = None
     if parent_id:
-        parent = find_public_product(parent_id)
+        parent = await repo.read(find_public_product, parent_id)
         title = parent.get("title") if parent else "دسته"
         back_parent = parent.get("parent_id") if parent else None
     else:
@@ -259,7 +252,7 @@ async def cb_view_product(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer("درخواست نامعتبر است.", show_alert=True)
         return
 
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product or product.get("is_category"):
         await callback.answer("این گزینه در دسترس نیست.", show_alert=True)
         return
@@ -289,7 +282,7 @@ async def cb_choose_mode(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer("درخواست نامعتبر است.", show_alert=True)
         return
 
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product or product.get("is_category"):
         await callback.answer("این گزینه در دسترس نیست.", show_alert=True)
         return
@@ -304,7 +297,7 @@ async def cb_buy_product(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer("درخواست نامعتبر است.", show_alert=True)
         return
 
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product or product.get("is_category"):
         await callback.answer("این مورد در دسترس نیست.", show_alert=True)
         return
@@ -318,7 +311,7 @@ async def cb_request_product(callback: CallbackQuery, state: FSMContext) -> None
     except (IndexError, ValueError):
         await callback.answer("درخواست نامعتبر است.", show_alert=True)
         return
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product or product.get("is_category"):
         await callback.answer("این مورد در دسترس نیست.", show_alert=True)
         return
@@ -336,15 +329,15 @@ async def cb_request_product(callback: CallbackQuery, state: FSMContext) -> None
 async def on_request_text(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     product_id = int(data.get("product_id") or 0)
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product:
         await message.answer("این درخواست دیگر در دسترس نیست.", reply_markup=reply_main())
         await state.clear()
         return
 
-    ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
-    user = get_user(message.from_user.id)
-    order_id = create_order(
+    await repo.ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
+    user = await repo.get_user(message.from_user.id)
+    order_id = await repo.create_order(
         user=user,
         title=product.get("title") or f"محصول #{product_id}",
         amount_total=0,
@@ -360,9 +353,12 @@ async def on_request_text(message: Message, state: FSMContext) -> None:
         await state.clear()
         return
 
-    set_order_customer_message(order_id, message.text or "")
-    set_order_payment_type(order_id, "REQUEST")
-    set_order_status(order_id, "IN_PROGRESS")
+    await repo.set_order_customer_message(order_id, message.text or "")
+    await repo.set_order_payment_type(order_id, "REQUEST")
+    if not await repo.set_order_status(order_id, "IN_PROGRESS"):
+        await message.answer(_order_closed_text(order_id), reply_markup=reply_main())
+        await state.clear()
+        return
     await _notify_admins(
         message.bot,
         "\n".join(
@@ -386,7 +382,7 @@ async def on_username(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     pending = data.get("pending_purchase") or {}
     product_id = int(pending.get("product_id") or 0)
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product:
         await message.answer("این محصول دیگر در دسترس نیست.", reply_markup=reply_main())
         await state.clear()
@@ -421,7 +417,7 @@ async def on_password(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     pending = data.get("pending_purchase") or {}
     product_id = int(pending.get("product_id") or 0)
-    product = find_public_product(product_id)
+    product = await repo.read(find_public_product, product_id)
     if not product:
         await message.answer("این محصول دیگر در دسترس نیست.", reply_markup=reply_main())
         await state.clear()
@@ -5,7 +5,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 
 from . import router
-from ..db import ensure_user, redeem_coupon
+from ..repository import repo
 from ..keyboards import ik_coupon_controls
 from ..states import ProfileStates
 from ..config import CURRENCY
@@ -48,8 +48,8 @@ async def cb_coupon_submit(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer("لطفاً ابتدا کد کوپن را ارسال کنید.", show_alert=True)
         return
 
-    ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
-    success, result, error = redeem_coupon(callback.from_user.id, code)
+    await repo.ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
+    success, result, error = await repo.redeem_coupon(callback.from_user.id, code)
     if not success:
         await callback.answer(error or "امکان اعمال کوپن نبود.", show_alert=True)
         return
@@ -5,13 +5,12 @@ from aiogram.types import CallbackQuery, Message
 from . import router
 from .helpers import _notify_admins, _price_to_int
 from ..config import (
-    ADMIN_IDS,
     BUILD_BOT_BASE_PRICE,
     BUILD_BOT_DESC,
     CURRENCY,
     OTHER_SERVICES_DESC,
 )
-from ..db import create_service_message, ensure_user, get_user
+from ..repository import repo
 from ..keyboards import ik_build_actions, ik_other_services_actions, reply_main
 from ..states import ShopStates
 from ..utils import mention
@@ -57,8 +56,8 @@ async def on_buildbot_requirements(message: Message, state: FSMContext) -> None:
         await message.answer("درخواست ساخت ربات لغو شد.", reply_markup=reply_main())
         await state.clear()
         return
-    ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
-    user = get_user(message.from_user.id) or {}
+    await repo.ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
+    user = await repo.get_user(message.from_user.id) or {}
     phone = user.get("contact_phone") or ""
     admin_text = (
         "🤖 <b>درخواست جدید ساخت ربات تلگرام</b>\n"
@@ -67,7 +66,7 @@ async def on_buildbot_requirements(message: Message, state: FSMContext) -> None:
     if phone:
         admin_text += f"📱 شماره تماس: <code>{phone}</code>\n"
     admin_text += "\n" + text
-    create_service_message(
+    await repo.create_service_message(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name,
@@ -113,8 +112,8 @@ async def on_other_request(message: Message, state: FSMContext) -> None:
         await message.answer("درخواست شما لغو شد.", reply_markup=reply_main())
         await state.clear()
         return
-    ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
-    user = get_user(message.from_user.id) or {}
+    await repo.ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
+    user = await repo.get_user(message.from_user.id) or {}
     phone = user.get("contact_phone") or ""
     await state.update_data(other_request_text=text, other_request_phone=phone)
     await message.answer(
@@ -152,7 +151,7 @@ async def on_other_request_attachment(message: Message, state: FSMContext) -> No
     if extra_text:
         final_text = f"{base_text}\n\n{extra_text}" if base_text else extra_text
 
-    ensure_user(user.id, user.username, user.first_name or "")
+    await repo.ensure_user(user.id, user.username, user.first_name or "")
     admin_text = (
         "🧰 <b>درخواست خدمات دیگر</b>\n"
         f"مشتری: {mention(user)} (@{user.username or '—'})\n"
@@ -163,7 +162,7 @@ async def on_other_request_attachment(message: Message, state: FSMContext) -> No
         admin_text += "📎 دارای پیوست تصویر/فایل\n"
     admin_text += "\n" + (final_text or "—")
 
-    create_service_message(
+    await repo.create_service_message(
         user.id,
         user.username,
         user.first_name,
@@ -173,17 +172,9 @@ async def on_other_request_attachment(message: Message, state: FSMContext) -> No
     )
 
     if attachment_id and message.photo:
-        for admin_id in ADMIN_IDS:
-            try:
-                await message.bot.send_photo(admin_id, attachment_id, caption=admin_text)
-            except Exception:
-                pass
+        await _notify_admins(message.bot, admin_text, photo=attachment_id)
     elif attachment_id and message.document:
-        for admin_id in ADMIN_IDS:
-            try:
-                await message.bot.send_document(admin_id, attachment_id, caption=admin_text)
-            except Exception:
-                pass
+        await _notify_admins(message.bot, admin_text, document=attachment_id)
     else:
         await _notify_admins(message.bot, admin_text)
 
@@ -5,7 +5,7 @@ from aiogram.types import CallbackQuery, Message
 from . import router
 from ..catalog import AI_VARIANT_MAP, get_variant
 from ..config import AI_PLANS, CURRENCY
-from ..db import create_order, ensure_user, get_user
+from ..repository import repo
 from ..keyboards import ik_ai_buy_modes, ik_ai_confirm_purchase, ik_ai_main, ik_cart_actions, reply_main
 from ..states import ShopStates
 from ..utils import is_valid_email
@@ -184,7 +184,7 @@ async def on_ai_team_email(message: Message, state: FSMContext) -> None:
     if not is_valid_email(email):
         await message.answer("ایمیل نامعتبر است. دوباره وارد کنید:")
         return
-    ensure_user(
+    await repo.ensure_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name or "",
@@ -199,8 +199,8 @@ async def on_ai_team_email(message: Message, state: FSMContext) -> None:
         await message.answer("قیمت این سرویس هنوز تنظیم نشده است.", reply_markup=reply_main())
         await state.clear()
         return
-    user = get_user(message.from_user.id)
-    order_id = create_order(
+    user = await repo.get_user(message.from_user.id)
+    order_id = await repo.create_order(
         user=user,
         title="اکانت ChatGPT Team",
         amount_total=amount,
@@ -253,7 +253,7 @@ async def cb_ai_team_mode_my_buy(callback: CallbackQuery, state: FSMContext) ->
 
 @router.callback_query(F.data == "ai:team:mode:pre:buy")
 async def cb_ai_team_mode_pre_buy(callback: CallbackQuery, state: FSMContext) -> None:
-    ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
+    await repo.ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
     variant = _variant_data("team", "pre")
     if not variant["available"]:
         await _alert_unavailable(callback, variant)
@@ -263,8 +263,8 @@ async def cb_ai_team_mode_pre_buy(callback: CallbackQuery, state: FSMContext) ->
         await callback.message.answer("قیمت این سرویس هنوز تنظیم نشده است.", reply_markup=reply_main())
         await callback.answer()
         return
-    user = get_user(callback.from_user.id)
-    order_id = create_order(
+    user = await repo.get_user(callback.from_user.id)
+    order_id = await repo.create_order(
         user=user,
         title="اکانت ChatGPT Team",
         amount_total=amount,
@@ -316,7 +316,7 @@ async def on_ai_plus_password(message: Message, state: FSMContext) -> None:
     if len(password) < 8:
         await message.answer("رمز خیلی کوتاه است. دوباره وارد کنید (حداقل ۸ کاراکتر):")
         return
-    ensure_user(
+    await repo.ensure_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name or "",
@@ -332,8 +332,8 @@ async def on_ai_plus_password(message: Message, state: FSMContext) -> None:
         await message.answer("قیمت این سرویس هنوز تنظیم نشده است.", reply_markup=reply_main())
         await state.clear()
         return
-    user = get_user(message.from_user.id)
-    order_id = create_order(
+    user = await repo.get_user(message.from_user.id)
+    order_id = await repo.create_order(
         user=user,
         title="اکانت ChatGPT Plus",
         amount_total=amount,
@@ -387,7 +387,7 @@ async def cb_ai_plus_mode_my_buy(callback: CallbackQuery, state: FSMContext) ->
 
 @router.callback_query(F.data == "ai:plus:mode:pre:buy")
 async def cb_ai_plus_mode_pre_buy(callback: CallbackQuery, state: FSMContext) -> None:
-    ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
+    await repo.ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
     variant = _variant_data("plus", "pre")
     if not variant["available"]:
         await _alert_unavailable(callback, variant)
@@ -397,8 +397,8 @@ async def cb_ai_plus_mode_pre_buy(callback: CallbackQuery, state: FSMContext) ->
         await callback.message.answer("قیمت این سرویس هنوز تنظیم نشده است.", reply_markup=reply_main())
         await callback.answer()
         return
-    user = get_user(callback.from_user.id)
-    order_id = create_order(
+    user = await repo.get_user(callback.from_user.id)
+    order_id = await repo.create_order(
         user=user,
         title="اکانت ChatGPT Plus",
         amount_total=amount,
@@ -435,7 +435,7 @@ async def cb_ai_google_mode_pre(callback: CallbackQuery, state: FSMContext) -> N
 
 @router.callback_query(F.data == "ai:google:mode:pre:buy")
 async def cb_ai_google_mode_pre_buy(callback: CallbackQuery, state: FSMContext) -> None:
-    ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
+    await repo.ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
     variant = _variant_data("google", "pre")
     if not variant["available"]:
         await _alert_unavailable(callback, variant)
@@ -445,8 +445,8 @@ async def cb_ai_google_mode_pre_buy(callback: CallbackQuery, state: FSMContext)
         await callback.message.answer("قیمت این سرویس هنوز تنظیم نشده است.", reply_markup=reply_main())
         await callback.answer()
         return
-    user = get_user(callback.from_user.id)
-    order_id = create_order(
+    user = await repo.get_user(callback.from_user.id)
+    order_id = await repo.create_order(
         user=user,
         title="اکانت Google AI Pro",
         amount_total=amount,
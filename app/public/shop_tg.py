@@ -3,10 +3,10 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 
 from . import router
-from .helpers import _order_title
+from .helpers import _notify_admins, _order_title
 from ..catalog import TG_PREMIUM_VARIANTS, get_variant
-from ..config import ADMIN_IDS, CURRENCY, TG_READY_PREBUILT
-from ..db import create_order, create_service_message, ensure_user, get_user
+from ..config import CURRENCY, TG_READY_PREBUILT
+from ..repository import repo
 from ..keyboards import (
     ik_tg_main,
     ik_tg_premium_durations,
@@ -93,7 +93,7 @@ async def on_tg_premium_id(message: Message, state: FSMContext) -> None:
     if not is_valid_tg_id(user_id_text):
         await message.answer("آیدی نامعتبر است. بدون @ و حداقل ۵ کاراکتر (حروف/عدد/_.). دوباره ارسال کنید:")
         return
-    ensure_user(
+    await repo.ensure_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name or "",
@@ -111,9 +111,9 @@ async def on_tg_premium_id(message: Message, state: FSMContext) -> None:
         await message.answer("قیمت این سرویس هنوز تنظیم نشده است.", reply_markup=reply_main())
         await state.clear()
         return
-    user = get_user(message.from_user.id)
+    user = await repo.get_user(message.from_user.id)
     title = _order_title("TG", f"premium_{period}")
-    order_id = create_order(
+    order_id = await repo.create_order(
         user=user,
         title=title,
         amount_total=amount,
@@ -173,8 +173,8 @@ async def on_ready_country_text(message: Message, state: FSMContext) -> None:
     if not text:
         await message.answer("لطفاً جزئیات را به‌صورت متن ارسال کنید:")
         return
-    ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
-    create_service_message(
+    await repo.ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
+    await repo.create_service_message(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name,
@@ -182,18 +182,14 @@ async def on_ready_country_text(message: Message, state: FSMContext) -> None:
         text,
     )
     note = f"📩 درخواست اکانت با کشور دلخواه از {mention(message.from_user)}:\n\n{text}"
-    for admin_id in ADMIN_IDS:
-        try:
-            await message.bot.send_message(admin_id, note)
-        except Exception:
-            pass
+    await _notify_admins(message.bot, note)
     await message.answer("✅ درخواست شما ثبت شد؛ در اسرع وقت پاسخ دریافت می‌کنید.", reply_markup=reply_main())
     await state.clear()
 
 
 @router.callback_query(F.data == "tg:ready:pre:buy")
 async def cb_tg_ready_pre_buy(callback: CallbackQuery, state: FSMContext) -> None:
-    ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
+    await repo.ensure_user(callback.from_user.id, callback.from_user.username, callback.from_user.first_name or "")
     variant = get_variant("tg_ready_pre")
     if not variant["available"]:
         await _alert_variant_unavailable(callback)
@@ -204,9 +200,9 @@ async def cb_tg_ready_pre_buy(callback: CallbackQuery, state: FSMContext) -> Non
         await callback.answer()
         return
 
-    user = get_user(callback.from_user.id)
+    user = await repo.get_user(callback.from_user.id)
     title = _order_title("TG", "ready_pre")
-    order_id = create_order(
+    order_id = await repo.create_order(
         user=user,
         title=title,
         amount_total=amount,
@@ -3,7 +3,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
 from . import router
-from ..db import ensure_user
+from ..repository import repo
 from ..keyboards import reply_main
 from .channel_gate import ensure_member_for_message
 from ..texts import HELP_TEXT, WELCOME_TEXT
@@ -11,7 +11,7 @@ from ..texts import HELP_TEXT, WELCOME_TEXT
 
 @router.message(CommandStart())
 async def on_start(message: Message, state: FSMContext) -> None:
-    ensure_user(
+    await repo.ensure_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name or "",
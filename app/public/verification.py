@@ -2,7 +2,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
 from . import router
-from ..db import ensure_user, set_user_contact_verified
+from ..repository import repo
 from ..keyboards import reply_main, reply_request_contact
 from ..states import VerifyStates
 
@@ -26,8 +26,8 @@ async def on_wait_contact(message: Message, state: FSMContext) -> None:
             reply_markup=reply_request_contact(),
         )
         return
-    ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
-    set_user_contact_verified(message.from_user.id, message.contact.phone_number)
+    await repo.ensure_user(message.from_user.id, message.from_user.username, message.from_user.first_name or "")
+    await repo.set_user_contact_verified(message.from_user.id, message.contact.phone_number)
     await message.answer(
         "✅ احراز هویت شما با موفقیت انجام شد. اکنون می‌توانید از بخش سبد خرید را ادامه دهید.",
         reply_markup=reply_main(),
@@ -0,0 +1,393 @@
+"""Coupon and discount-code redemption.
+
+Every limit is enforced by the statement that consumes it rather than by a
+read beforehand:
+
+* the code's global use is claimed with one conditional
+  ``UPDATE ... SET used_count=used_count+1 WHERE ... used_count < usage_limit``
+  that also checks ``is_active``, the amount and the expiry;
+* the user's use is claimed with an upsert on ``(code id, user_id)`` whose
+  ``DO UPDATE`` only fires while ``times_used`` is below the per-user limit;
+* a discount is attached with an ``UPDATE orders ... WHERE status=
+  'AWAITING_PAYMENT' AND discount_code=''``.
+
+All of it runs in a single transaction on one connection, and any claim that
+matches no row rolls the whole redemption back, so concurrent redemptions of
+one code can never push ``used_count`` past ``usage_limit``.  The row is only
+read again on a failed claim, to pick the message shown to the user.
+
+Active discount codes, with their eligible products from
+``discount_products``, are also kept in memory by normalised code
+(:func:`active_discounts`).  A checkout turns away an expired code without a
+query and claims a known code by primary key.  The order's product is
+always checked against the claimed row's ``applies_all`` and its
+``discount_products`` read in the same transaction, so a restriction added
+in another process applies at once.  The writers in :mod:`app.db` call
+:func:`invalidate_discounts`.
+
+Functions here take ids and codes and must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from . import cache, ledger
+from .config import CACHE_TTL_SECONDS
+from .db_pool import get_connection, transaction
+
+Result = tuple[bool, dict[str, Any] | None, str | None]
+
+COUPON_MESSAGES = {
+    "empty": "کد کوپن نامعتبر است.",
+    "missing": "چنین کدی وجود ندارد.",
+    "inactive": "این کوپن غیرفعال است.",
+    "amount": "مبلغ این کوپن معتبر نیست.",
+    "limit": "ظرفیت استفاده از این کوپن تکمیل شده است.",
+    "expired": "تاریخ انقضای این کوپن گذشته است.",
+    "per_user": "سقف استفاده شما از این کد تکمیل شده است.",
+    "wallet": "امکان واریز مبلغ کوپن وجود ندارد.",
+}
+
+DISCOUNT_MESSAGES = {
+    "empty": "کد تخفیف نامعتبر است.",
+    "missing": "کد تخفیف یافت نشد.",
+    "inactive": "این کد تخفیف غیرفعال است.",
+    "amount": "مبلغ تخفیف معتبر نیست.",
+    "limit": "ظرفیت استفاده از این کد تکمیل شده است.",
+    "expired": "تاریخ انقضای این کد گذشته است.",
+    "per_user": "سقف استفاده شما از این کد تکمیل شده است.",
+    "product": "این کد برای محصول انتخاب‌شده معتبر نیست.",
+    "order": "سفارش نامعتبر است.",
+    "status": "وضعیت سفارش اجازه ثبت تخفیف نمی‌دهد.",
+    "applied": "روی این سفارش قبلاً کد تخفیف ثبت شده است.",
+}
+
+
+class _Rejected(Exception):
+    """Raised inside the transaction to roll back the claims made so far."""
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def normalize_code(code: str | None) -> str:
+    return (code or "").strip().upper()
+
+
+def order_product_id(order: dict | None) -> int | None:
+    if not order:
+        return None
+    code = order.get("service_code") or ""
+    if code.startswith("product:"):
+        try:
+            return int(code.split(":", 1)[1])
+        except (IndexError, ValueError):
+            return None
+    return None
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _expired(expires_at: str | None, now: datetime) -> bool:
+    if not expires_at:
+        return False
+    try:
+        return datetime.fromisoformat(str(expires_at)) < now
+    except ValueError:
+        return False
+
+
+# --- نقشهٔ کدهای تخفیف فعال ------------------------------------------------------
+
+
+@dataclass(frozen=True)
+class ActiveDiscount:
+    id: int
+    code: str
+    amount: int
+    applies_all: bool
+    product_ids: frozenset[int]
+    expires_at: str | None
+
+    def allows(self, product_id: int | None) -> bool:
+        return self.applies_all or not self.product_ids or product_id is None or product_id in self.product_ids
+
+
+_active_discounts: dict[str, ActiveDiscount] = {}
+_active_loaded_at: float | None = None
+_active_lock = threading.Lock()
+
+
+def _product_ids(con, discount_id: int) -> frozenset[int]:
+    rows = con.execute("SELECT product_id FROM discount_products WHERE discount_id=?", (discount_id,))
+    return frozenset(int(row[0]) for row in rows)
+
+
+def _load_active_discounts(con) -> dict[str, ActiveDiscount]:
+    products: dict[int, set[int]] = {}
+    for discount_id, product_id in con.execute(
+        """
+        SELECT dp.discount_id, dp.product_id FROM discount_products dp
+        JOIN discounts d ON d.id=dp.discount_id
+        WHERE IFNULL(d.is_active, 0) != 0
+        """
+    ):
+        products.setdefault(int(discount_id), set()).add(int(product_id))
+    active: dict[str, ActiveDiscount] = {}
+    for row in con.execute(
+        """
+        SELECT id, code, code_norm, amount, applies_all, expires_at FROM discounts
+        WHERE IFNULL(is_active, 0) != 0 AND code_norm IS NOT NULL
+        """
+    ):
+        active[row["code_norm"]] = ActiveDiscount(
+            id=int(row["id"]),
+            code=row["code"],
+            amount=int(row["amount"] or 0),
+            applies_all=bool(int(row["applies_all"] or 0)),
+            product_ids=frozenset(products.get(int(row["id"]), ())),
+            expires_at=row["expires_at"] or None,
+        )
+    return active
+
+
+def active_discounts() -> dict[str, ActiveDiscount]:
+    """Active discount codes by normalised code, reloaded after :func:`invalidate_discounts`.
+
+    The TTL bounds how long a change made by another process (the web
+    admin) goes unseen; the claim itself re-checks everything in SQL.
+    """
+
+    global _active_discounts, _active_loaded_at
+    loaded_at = _active_loaded_at
+    if loaded_at is not None and time.monotonic() - loaded_at < CACHE_TTL_SECONDS:
+        return _active_discounts
+    with _active_lock:
+        # نخ دیگری ممکن است همین حالا بارگذاری کرده باشد
+        if _active_loaded_at is loaded_at:
+            _active_discounts = _load_active_discounts(get_connection(primary=True))
+            _active_loaded_at = time.monotonic()
+        return _active_discounts
+
+
+def invalidate_discounts() -> None:
+    global _active_loaded_at
+    with _active_lock:
+        _active_loaded_at = None
+
+
+# --- ادعای سهم از کد -----------------------------------------------------------
+
+
+def _claim_code(con, table: str, column: str, key: Any, now: str) -> dict[str, Any] | None:
+    # usage_limit صفر یعنی بدون سقف؛ انقضای نامعتبر (غیرقابل‌خواندن) نادیده گرفته می‌شود
+    row = con.execute(
+        f"""
+        UPDATE {table} SET used_count=IFNULL(used_count, 0)+1, updated_at=?
+        WHERE {column}=?
+          AND IFNULL(is_active, 0) != 0
+          AND amount > 0
+          AND (IFNULL(usage_limit, 0) <= 0 OR IFNULL(used_count, 0) < usage_limit)
+          AND (datetime(expires_at) IS NULL OR datetime(expires_at) >= datetime(?))
+        RETURNING *
+        """,
+        (now, key, now),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def _code_rejection(con, table: str, column: str, key: Any, now: str) -> str:
+    row = con.execute(f"SELECT * FROM {table} WHERE {column}=?", (key,)).fetchone()
+    if row is None:
+        return "missing"
+    if not int(row["is_active"] or 0):
+        return "inactive"
+    try:
+        amount = int(row["amount"] or 0)
+    except (TypeError, ValueError):
+        amount = 0
+    if amount <= 0:
+        return "amount"
+    limit = int(row["usage_limit"] or 0)
+    if limit and int(row["used_count"] or 0) >= limit:
+        return "limit"
+    if _expired(row["expires_at"], datetime.fromisoformat(now)):
+        return "expired"
+    # وضعیت کد بین UPDATE و این خواندن عوض نمی‌شود (قفل نوشتن دست ماست)؛ محض احتیاط
+    return "limit"
+
+
+def _per_user_limit(row: dict[str, Any]) -> int:
+    # مثل قبل: مقدار خالی یا صفر یعنی یک بار برای هر کاربر
+    return int(row.get("usage_limit_per_user") or 1)
+
+
+def _claim_user_slot(
+    con, table: str, key: str, code_row: dict[str, Any], user_id: int, values: dict[str, Any]
+) -> bool:
+    # مبلغ ثبت‌شده در اولین استفاده می‌ماند؛ بقیهٔ ستون‌ها با استفادهٔ تازه به‌روز می‌شوند
+    columns = [key, "user_id", "times_used", *values]
+    updates = ["times_used=IFNULL(times_used, 0)+1", *(f"{col}=excluded.{col}" for col in values if col != "amount")]
+    cur = con.execute(
+        f"""
+        INSERT INTO {table}({', '.join(columns)}) VALUES({', '.join('?' * len(columns))})
+        ON CONFLICT({key}, user_id) DO UPDATE SET {', '.join(updates)}
+        WHERE IFNULL(times_used, 0) < ?
+        """,
+        (code_row["id"], user_id, 1, *values.values(), _per_user_limit(code_row)),
+    )
+    return cur.rowcount == 1
+
+
+# --- کوپن کیف پول ---------------------------------------------------------------
+
+
+def redeem_coupon(user_id: int, code: str) -> Result:
+    """Credit a wallet coupon to ``user_id``; ``(ok, {amount, balance, code}, error)``."""
+
+    normalized = normalize_code(code)
+    if not normalized:
+        return False, None, COUPON_MESSAGES["empty"]
+    now = _now()
+    try:
+        with transaction() as con:
+            coupon = _claim_code(con, "coupons", "UPPER(code)", normalized, now)
+            if coupon is None:
+                raise _Rejected(_code_rejection(con, "coupons", "UPPER(code)", normalized, now))
+            amount = int(coupon["amount"])
+            if not _claim_user_slot(
+                con, "coupon_redemptions", "coupon_id", coupon, user_id, {"amount": amount, "redeemed_at": now}
+            ):
+                raise _Rejected("per_user")
+            if not ledger.post(user_id, amount, "CREDIT", note=f"COUPON:{coupon['code']}"):
+                raise _Rejected("wallet")
+            row = con.execute("SELECT wallet_balance FROM users WHERE user_id=?", (user_id,)).fetchone()
+    except _Rejected as exc:
+        return False, None, COUPON_MESSAGES[exc.reason]
+    balance = int(row["wallet_balance"] or 0) if row else 0
+    return True, {"amount": amount, "balance": balance, "code": coupon["code"]}, None
+
+
+# --- کد تخفیف سفارش -------------------------------------------------------------
+
+
+def _order_rejection(con, order_id: int, user_id: int) -> str | None:
+    row = con.execute("SELECT user_id, status, discount_code FROM orders WHERE id=?", (order_id,)).fetchone()
+    if row is None or row["user_id"] != user_id:
+        return "order"
+    if row["status"] != "AWAITING_PAYMENT":
+        return "status"
+    if (row["discount_code"] or "").strip():
+        return "applied"
+    return None
+
+
+def apply_discount(order_id: int, user_id: int, code: str) -> Result:
+    """Attach a discount code to an unpaid order; ``(ok, {discount, payable, code}, error)``."""
+
+    normalized = normalize_code(code)
+    # کد ناشناخته یا غیرفعال در نقشه نیست و از خود جدول بررسی می‌شود (مثلاً کدی که همین حالا ساخته شده)
+    active = active_discounts().get(normalized) if normalized else None
+    if active is not None:
+        if active.amount <= 0:
+            return False, None, DISCOUNT_MESSAGES["amount"]
+        if _expired(active.expires_at, datetime.now()):
+            return False, None, DISCOUNT_MESSAGES["expired"]
+    column, key = ("id", active.id) if active is not None else ("code_norm", normalized)
+
+    now = _now()
+    try:
+        with transaction() as con:
+            if not normalized:
+                raise _Rejected(_order_rejection(con, order_id, user_id) or "empty")
+            discount = _claim_code(con, "discounts", column, key, now)
+            if discount is None:
+                raise _Rejected(
+                    _order_rejection(con, order_id, user_id) or _code_rejection(con, "discounts", column, key, now)
+                )
+            order = con.execute(
+                """
+                UPDATE orders
+                SET discount_id=?, discount_code=?,
+                    discount_amount=MIN(?, MAX(COALESCE(NULLIF(amount_total, 0), price, 0), 0)),
+                    updated_at=?
+                WHERE id=? AND user_id=? AND status='AWAITING_PAYMENT' AND TRIM(IFNULL(discount_code, ''))=''
+                RETURNING *
+                """,
+                (discount["id"], discount["code"], max(int(discount["amount"]), 0), now, order_id, user_id),
+            ).fetchone()
+            if order is None:
+                raise _Rejected(_order_rejection(con, order_id, user_id) or "order")
+            order = dict(order)
+            # محدودیت محصول از همین ردیف claim‌شده خوانده می‌شود، نه از نقشهٔ کش‌شده
+            claimed = ActiveDiscount(
+                id=int(discount["id"]),
+                code=discount["code"],
+                amount=int(discount["amount"]),
+                applies_all=bool(int(discount["applies_all"] or 0)),
+                product_ids=_product_ids(con, discount["id"]),
+                expires_at=discount["expires_at"],
+            )
+            if not claimed.allows(order_product_id(order)):
+                raise _Rejected("product")
+            discount_value = int(order["discount_amount"] or 0)
+            if not _claim_user_slot(
+                con,
+                "discount_redemptions",
+                "discount_id",
+                discount,
+                user_id,
+                {"order_id": order_id, "amount": discount_value, "redeemed_at": now, "status": "CONFIRMED"},
+            ):
+                raise _Rejected("per_user")
+            cache.invalidate(f"order:{order_id}")
+    except _Rejected as exc:
+        return False, None, DISCOUNT_MESSAGES[exc.reason]
+    base_amount = int(order.get("amount_total") or order.get("price") or 0)
+    payable = max(base_amount - discount_value, 0)
+    return True, {"discount": discount_value, "payable": payable, "code": discount["code"]}, None
+
+
+def release_discount(order_id: int) -> bool:
+    """Detach an order's discount and give back the use it claimed; ``False`` if the order is missing."""
+
+    now = _now()
+    with transaction() as con:
+        row = con.execute("SELECT discount_id FROM orders WHERE id=?", (order_id,)).fetchone()
+        if row is None:
+            return False
+        discount_id = row["discount_id"]
+        if not discount_id:
+            return True  # قبلاً تخفیف نداشته
+        con.execute("DELETE FROM discount_redemptions WHERE order_id=?", (order_id,))
+        con.execute(
+            "UPDATE discounts SET used_count=MAX(0, IFNULL(used_count, 0)-1), updated_at=? WHERE id=?",
+            (now, discount_id),
+        )
+        con.execute(
+            "UPDATE orders SET discount_id=NULL, discount_code='', discount_amount=0, updated_at=? WHERE id=?",
+            (now, order_id),
+        )
+        cache.invalidate(f"order:{order_id}")
+    return True
+
+
+__all__ = [
+    "ActiveDiscount",
+    "COUPON_MESSAGES",
+    "DISCOUNT_MESSAGES",
+    "active_discounts",
+    "apply_discount",
+    "invalidate_discounts",
+    "normalize_code",
+    "order_product_id",
+    "redeem_coupon",
+    "release_discount",
+]
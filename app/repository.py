@@ -0,0 +1,165 @@
+"""Async facade over :mod:`app.db` for handlers and web routes.
+
+``await repo.get_order(order_id)`` runs :func:`app.db.get_order` on a
+dedicated thread pool instead of the event loop.  Reads (``get_*``,
+``list_*``, ``count_*`` ...) share a small pool of reader threads, which WAL
+lets run next to a write; everything else is serialised on one writer
+thread.  Each lane admits at most ``DB_QUEUE_LIMIT`` calls at a time, so a
+burst of updates waits on the event loop instead of piling up in the pool.
+Writes handed to the write coalescer are awaited until their batch commits.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import ModuleType
+from typing import Any, Callable
+
+from . import db
+from .config import DB_QUEUE_LIMIT, DB_READ_WORKERS
+
+_READ_PREFIXES = ("get_", "list_", "count_", "is_", "has_", "user_has_")
+# توابعی که با وجود نام «خواندنی» روی دیتابیس می‌نویسند
+_WRITE_OVERRIDES: set[str] = set()
+
+
+def is_read_only(name: str) -> bool:
+    return name.startswith(_READ_PREFIXES) and name not in _WRITE_OVERRIDES
+
+
+class _Lane:
+    def __init__(self, name: str, workers: int, limit: int) -> None:
+        self.name = name
+        self.workers = max(int(workers), 1)
+        self.limit = max(int(limit), 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"db-{name}")
+        self._slots: asyncio.Semaphore | None = None
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.queued = 0
+        self.running = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        ctx = contextvars.copy_context()
+        enqueued = time.perf_counter()
+        with self._lock:
+            self.submitted += 1
+            self.queued += 1
+            self.max_depth = max(self.max_depth, self.queued + self.running + self.waiting)
+
+        def call() -> Any:
+            started = time.perf_counter()
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_seconds += started - enqueued
+            try:
+                return ctx.run(fn, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.run_seconds += time.perf_counter() - started
+
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.completed += 1
+            self._slots.release()
+        if isinstance(result, Future):
+            # نوشتن گروهی: کار روی نخ نویسنده تمام شده و فقط منتظر commit دسته هستیم
+            return await asyncio.wrap_future(result)
+        return result
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            done = max(self.completed, 1)
+            return {
+                "workers": self.workers,
+                "limit": self.limit,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "running": self.running,
+                "depth": self.waiting + self.queued + self.running,
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait_ms": round(self.wait_seconds * 1000 / done, 3),
+                "avg_run_ms": round(self.run_seconds * 1000 / done, 3),
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncRepository:
+    """Mirror of the :mod:`app.db` API whose functions return awaitables."""
+
+    def __init__(
+        self,
+        module: ModuleType = db,
+        *,
+        read_workers: int = DB_READ_WORKERS,
+        queue_limit: int = DB_QUEUE_LIMIT,
+    ) -> None:
+        self._module = module
+        self._reads = _Lane("read", read_workers, queue_limit)
+        self._writes = _Lane("write", 1, queue_limit)
+
+    def __getattr__(self, name: str) -> Any:
+        target = getattr(self._module, name)
+        if name.startswith("_") or not callable(target):
+            return target
+        lane = self._reads if is_read_only(name) else self._writes
+
+        @functools.wraps(target)
+        async def call(*args: Any, **kwargs: Any) -> Any:
+            return await lane.run(target, *args, **kwargs)
+
+        setattr(self, name, call)
+        return call
+
+    async def read(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run an arbitrary read-only callable (e.g. from ``app.products``) on the reader pool."""
+
+        return await self._reads.run(fn, *args, **kwargs)
+
+    async def write(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run an arbitrary callable on the single writer thread."""
+
+        return await self._writes.run(fn, *args, **kwargs)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {"read": self._reads.stats(), "write": self._writes.stats()}
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._reads.shutdown(wait)
+        self._writes.shutdown(wait)
+
+
+repo = AsyncRepository()
+
+__all__ = ["AsyncRepository", "is_read_only", "repo"]
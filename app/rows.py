@@ -0,0 +1,75 @@
+"""Compact read-only result rows.
+
+``db_execute(fetchall=True)`` turns every row into a ``dict``, which costs a
+hash table per row on top of the ``sqlite3.Row`` it was copied from.  The
+rows here are plain tuples (``namedtuple`` classes with ``__slots__ = ()``)
+that also answer ``row["col"]``, ``row.get("col")``, ``row.col``,
+``keys()`` and ``dict(row)``, so templates and handlers written against
+dict rows keep working.  They are immutable: copy with ``dict(row)`` before
+changing a field.
+
+One class is built per column list and reused.  Functions here take a raw
+cursor and must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+import functools
+from collections import namedtuple
+from typing import Any, Iterator
+
+
+class _Mapping:
+    __slots__ = ()
+    _keys: tuple[str, ...] = ()
+    _index: dict[str, int] = {}
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, str):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._index
+
+    def get(self, key: str, default: Any = None) -> Any:
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self) -> tuple[str, ...]:
+        return self._keys
+
+    def values(self) -> tuple[Any, ...]:
+        return tuple(self)
+
+    def items(self) -> Iterator[tuple[str, Any]]:
+        return zip(self._keys, self)
+
+    def __repr__(self) -> str:
+        return "Row(" + ", ".join(f"{k}={v!r}" for k, v in zip(self._keys, self)) + ")"
+
+
+@functools.lru_cache(maxsize=256)
+def row_class(columns: tuple[str, ...]) -> type:
+    # نام ستون‌هایی مثل COUNT(*) شناسهٔ معتبر نیستند؛ با row["COUNT(*)"] در دسترس می‌مانند
+    base = namedtuple("Row", columns, rename=True)
+    index = {name: i for i, name in enumerate(columns)}
+    return type("Row", (_Mapping, base), {"__slots__": (), "_keys": columns, "_index": index})
+
+
+def iterate(cur, batch_size: int = 256) -> Iterator[Any]:
+    """Yield the rows of an executed cursor (whose ``row_factory`` is ``None``) as :func:`row_class` tuples."""
+
+    cls = row_class(tuple(d[0] for d in cur.description or ()))
+    new = tuple.__new__
+    while True:
+        batch = cur.fetchmany(batch_size)
+        if not batch:
+            return
+        for row in batch:
+            yield new(cls, row)
+
+
+__all__ = ["iterate", "row_class"]
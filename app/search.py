@@ -0,0 +1,142 @@
+"""FTS5 search index for the admin lists (orders, users, service messages).
+
+Each searchable table has a trigram FTS5 shadow (``orders_fts``,
+``users_fts``, ``service_messages_fts``) whose rowid is the source row id.
+Triggers keep the shadows current.  Text is normalised on the way in, both
+in the triggers and in :func:`match_query`, so Arabic ``ي``/``ك`` match
+Persian ``ی``/``ک``, Persian and Arabic digits match ASCII digits, and a
+zero-width non-joiner counts as a space.
+
+The trigram tokenizer needs at least three characters per term.  When
+:func:`match_query` returns ``None`` for a shorter search, callers fall
+back to ``LIKE``.  Functions here take a raw connection and must not
+import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+import re
+
+# حروف عربی → فارسی و نیم‌فاصله → فاصله
+_LETTER_MAP: dict[str, str] = {
+    "ي": "ی",
+    "ى": "ی",
+    "ك": "ک",
+    "ة": "ه",
+    "ۀ": "ه",
+    "\u200c": " ",
+}
+# ارقام فارسی/عربی → لاتین
+_DIGIT_MAP: dict[str, str] = {
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+}
+_TRANSLATE = str.maketrans({**_LETTER_MAP, **_DIGIT_MAP})
+
+MIN_TERM_LENGTH = 3
+
+# table -> (fts table, key column, indexed columns)
+INDEXES: dict[str, tuple[str, str, tuple[str, ...]]] = {
+    "orders": (
+        "orders_fts",
+        "id",
+        ("plan_title", "service_code", "username", "first_name", "customer_email"),
+    ),
+    "users": (
+        "users_fts",
+        "user_id",
+        ("username", "first_name", "contact_phone"),
+    ),
+    "service_messages": (
+        "service_messages_fts",
+        "id",
+        ("username", "first_name", "message_text"),
+    ),
+}
+
+
+def normalize(text: str | None) -> str:
+    return (text or "").translate(_TRANSLATE).lower()
+
+
+def _replace_sql(expr: str, mapping: dict[str, str]) -> str:
+    for src, dst in mapping.items():
+        expr = f"replace({expr}, '{src}', '{dst}')"
+    return expr
+
+
+def _normalized_select(key: str, columns: tuple[str, ...], *, row: str = "", table: str = "") -> str:
+    # یک replace تودرتو برای همهٔ ۲۶ نگاشت از عمق پارسر SQLite بیشتر می‌شود؛
+    # برای همین حروف و ارقام در دو لایهٔ SELECT جدا اعمال می‌شوند.
+    prefix = f"{row}." if row else ""
+    inner = ", ".join(
+        _replace_sql(f"lower(COALESCE({prefix}{col}, ''))", _LETTER_MAP) + f" AS {col}" for col in columns
+    )
+    outer = ", ".join(_replace_sql(col, _DIGIT_MAP) for col in columns)
+    source = f" FROM {table}" if table else ""
+    return f"SELECT k, {outer} FROM (SELECT {prefix}{key} AS k, {inner}{source})"
+
+
+def _insert_sql(fts: str, key: str, columns: tuple[str, ...], row: str) -> str:
+    return f"INSERT INTO {fts}(rowid, {', '.join(columns)}) {_normalized_select(key, columns, row=row)};"
+
+
+def install(con) -> None:
+    """Create (or re-create) the FTS tables and their sync triggers."""
+
+    for table, (fts, key, columns) in INDEXES.items():
+        con.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"{', '.join(columns)}, tokenize='trigram')"
+        )
+        triggers = {
+            f"trg_{fts}_ins": f"AFTER INSERT ON {table} BEGIN\n    {_insert_sql(fts, key, columns, 'NEW')}\nEND",
+            f"trg_{fts}_del": f"AFTER DELETE ON {table} BEGIN\n    DELETE FROM {fts} WHERE rowid=OLD.{key};\nEND",
+            f"trg_{fts}_upd": (
+                f"AFTER UPDATE OF {', '.join(columns)} ON {table} BEGIN\n"
+                f"    DELETE FROM {fts} WHERE rowid=OLD.{key};\n"
+                f"    {_insert_sql(fts, key, columns, 'NEW')}\nEND"
+            ),
+        }
+        for name, body in triggers.items():
+            con.execute(f"DROP TRIGGER IF EXISTS {name}")
+            con.execute(f"CREATE TRIGGER {name} {body}")
+
+
+def rebuild(con, table: str | None = None) -> None:
+    """Re-index from the source tables (run inside a write transaction)."""
+
+    for name, (fts, key, columns) in INDEXES.items():
+        if table and name != table:
+            continue
+        select = _normalized_select(key, columns, table=name)
+        con.execute(f"DELETE FROM {fts}")
+        con.execute(f"INSERT INTO {fts}(rowid, {', '.join(columns)}) {select}")
+        con.execute(f"INSERT INTO {fts}({fts}) VALUES('optimize')")
+
+
+def terms(search: str | None) -> list[str]:
+    return [part for part in re.split(r"\s+", normalize(search).strip()) if part]
+
+
+def match_query(search: str | None) -> str | None:
+    """FTS5 MATCH expression for ``search`` or ``None`` if it needs the LIKE fallback."""
+
+    parts = terms(search)
+    if not parts or any(len(part) < MIN_TERM_LENGTH for part in parts):
+        return None
+    return " ".join('"' + part.replace('"', '""') + '"' for part in parts)
+
+
+def like_clause(columns: tuple[str, ...], search: str | None) -> tuple[str, list[str]]:
+    """``LIKE`` fallback for short terms: every term must appear in one of the columns."""
+
+    clauses: list[str] = []
+    params: list[str] = []
+    for part in terms(search):
+        like = f"%{part}%"
+        clauses.append("(" + " OR ".join(f"LOWER({col}) LIKE ?" for col in columns) + ")")
+        params.extend([like] * len(columns))
+    return " AND ".join(clauses) or "1=1", params
+
+
+__all__ = ["INDEXES", "MIN_TERM_LENGTH", "install", "like_clause", "match_query", "normalize", "rebuild", "terms"]
@@ -0,0 +1,170 @@
+"""Periodically refreshed read-only copy of the database for the web admin.
+
+With ``DB_SNAPSHOT_PATH`` set, :func:`refresh` copies the primary database
+into that file with the SQLite online backup API.  The copy is taken in one
+step, i.e. inside a single read transaction, which WAL lets run next to
+the bot's commits.  It is written to a temporary file first and then
+renamed over the snapshot, so open readers keep the copy they started on
+and nobody ever sees a half-written file.  That also makes the snapshot
+immutable once in place, and readers open it with ``immutable=1`` (no
+locking at all).
+
+Reads in a context marked with :func:`app.db_pool.read_from_snapshot` go
+to :func:`connection`, which refreshes first when the copy is older than
+``DB_SNAPSHOT_MAX_AGE_SECONDS``; :func:`refresh_loop` normally keeps it
+fresher than that so requests do not wait.  Writes, transactions and the
+read cache keep using the primary.  The cold-order archive is not copied,
+it is attached read-only as is.  For up to one snapshot age an order that
+was archived meanwhile can therefore show up twice in a ``UNION ALL`` list.
+
+Like the other storage helpers this module must not import :mod:`app.db`.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+from urllib.parse import quote
+
+from . import db_pool
+from .config import (
+    ARCHIVE_DB_PATH,
+    DB_BUSY_TIMEOUT_MS,
+    DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE,
+    DB_SNAPSHOT_MAX_AGE_SECONDS,
+    DB_SNAPSHOT_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_local = threading.local()
+# monotonic زمان آخرین کپی موفق؛ None یعنی هنوز کپی‌ای در این پروسه ساخته نشده
+_refreshed_at: float | None = None
+_generation = 0
+_stats: dict[str, Any] = {"refreshes": 0, "failures": 0, "last_seconds": 0.0, "last_bytes": 0}
+
+
+def enabled() -> bool:
+    return bool(DB_SNAPSHOT_PATH)
+
+
+def age() -> float | None:
+    refreshed_at = _refreshed_at
+    return None if refreshed_at is None else time.monotonic() - refreshed_at
+
+
+def _fresh(max_age: float) -> bool:
+    current = age()
+    return current is not None and current < max_age
+
+
+def refresh(*, max_age: float | None = None) -> bool:
+    """Copy the primary into the snapshot unless it is younger than ``max_age``; ``True`` if copied."""
+
+    global _refreshed_at, _generation
+    if not enabled():
+        return False
+    with _lock:
+        # نخ دیگری ممکن است همین حالا کپی گرفته باشد
+        if max_age is not None and _fresh(max_age):
+            return False
+        started = time.perf_counter()
+        tmp_path = f"{DB_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+        source = db_pool.open_connection()
+        try:
+            target = sqlite3.connect(tmp_path)
+            try:
+                # pages=-1: کل کپی در یک تراکنش خواندن؛ کپی مرحله‌ای با هر commit از نو شروع می‌شود
+                source.backup(target, pages=-1, name="main")
+                target.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                target.close()
+            os.replace(tmp_path, DB_SNAPSHOT_PATH)
+        except BaseException:
+            _stats["failures"] += 1
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            source.close()
+        _refreshed_at = time.monotonic()
+        _generation += 1
+        _stats["refreshes"] += 1
+        _stats["last_seconds"] = round(time.perf_counter() - started, 3)
+        _stats["last_bytes"] = os.path.getsize(DB_SNAPSHOT_PATH)
+        return True
+
+
+def _open() -> sqlite3.Connection:
+    con = sqlite3.connect(
+        f"file:{quote(os.path.abspath(DB_SNAPSHOT_PATH))}?immutable=1",
+        uri=True,
+        timeout=max(int(DB_BUSY_TIMEOUT_MS), 0) / 1000,
+        check_same_thread=False,
+    )
+    con.row_factory = sqlite3.Row
+    con.execute(f"PRAGMA cache_size=-{max(int(DB_CACHE_SIZE_KB), 0)};")
+    con.execute(f"PRAGMA mmap_size={max(int(DB_MMAP_SIZE), 0)};")
+    con.execute("PRAGMA temp_store=MEMORY;")
+    if ARCHIVE_DB_PATH and os.path.exists(ARCHIVE_DB_PATH):
+        con.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+    # بایگانی فایل زنده است؛ query_only جلوی نوشتن روی آن را هم می‌گیرد
+    con.execute("PRAGMA query_only=ON;")
+    return con
+
+
+def connection() -> sqlite3.Connection | None:
+    """The calling thread's snapshot connection, refreshed first if too old; ``None`` falls back to the primary."""
+
+    if not _fresh(DB_SNAPSHOT_MAX_AGE_SECONDS):
+        try:
+            refresh(max_age=DB_SNAPSHOT_MAX_AGE_SECONDS)
+        except Exception:
+            logger.exception("snapshot refresh failed; reading from the primary database")
+            return None
+    con = getattr(_local, "con", None)
+    if con is None or getattr(_local, "generation", None) != _generation:
+        if con is not None:
+            con.close()
+        con = _open()
+        _local.con, _local.generation = con, _generation
+    return con
+
+
+def install() -> bool:
+    """Route snapshot reads of this process to :func:`connection`; ``False`` when no path is configured."""
+
+    db_pool.set_snapshot_source(connection if enabled() else None)
+    return enabled()
+
+
+async def refresh_loop(interval: float | None = None) -> None:
+    # کپی زودتر از مهلت تازه می‌شود تا درخواست‌ها منتظر کپی نمانند
+    interval = float(interval if interval is not None else DB_SNAPSHOT_MAX_AGE_SECONDS / 2)
+    while True:
+        try:
+            await asyncio.to_thread(refresh, max_age=interval)
+        except Exception as e:
+            logger.exception("snapshot refresh_loop error: %s", e)
+        await asyncio.sleep(max(interval, 1.0))
+
+
+def stats() -> dict[str, Any]:
+    current = age()
+    return {
+        "enabled": enabled(),
+        "age": round(current, 1) if current is not None else None,
+        "max_age": DB_SNAPSHOT_MAX_AGE_SECONDS,
+        **_stats,
+    }
+
+
+__all__ = ["age", "connection", "enabled", "install", "refresh", "refresh_loop", "stats"]
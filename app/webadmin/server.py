@@ -7,74 +7,34 @@ from typing import Any
 from urllib.parse import quote
 
 import httpx
+import asyncio
 import secrets
 import sqlite3
 import string
-from aiogram import Bot
+import time
 from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request, status
 from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 
+from .. import cache, notifications, order_machine, write_coalescer
+from .. import snapshot as db_snapshot
 from ..products import get_admin_tree, seed_default_catalog
-from ..config import ADMIN_WEB_PASS, ADMIN_WEB_SECRET, ADMIN_WEB_USER, BOT_TOKEN, CURRENCY, LOG_FILE
-from ..db import (
-    ORDER_STATUS_LABELS,
-    PAYMENT_TYPE_LABELS,
-    change_wallet,
-    count_orders,
-    count_users,
-    get_dashboard_snapshot,
-    get_order,
-    get_user,
-    get_user_stats,
-    get_wallet_summary,
-    init_db,
-    list_orders,
-    list_recent_orders,
-    list_recent_users,
-    list_recent_wallet_tx,
-    list_users,
-    list_wallet_tx_for_order,
-    list_wallet_tx_for_user,
-    list_service_messages,
-    create_discount,
-    delete_discount,
-    get_discount,
-    list_discounts,
-    list_discount_redemptions,
-    set_discount_active,
-    update_discount,
-    count_service_messages,
-    get_service_message,
-    list_service_message_replies,
-    add_service_message_reply,
-    set_service_message_status,
-    set_order_payment_type,
-    set_order_status,
-    set_order_wallet_reserved,
-    set_order_wallet_used,
-    update_order_notes,
-    set_user_blocked,
-    add_order_manager_message,
-    add_user_manager_message,
-    create_coupon,
-    delete_coupon,
-    create_product,
-    get_product,
-    delete_product,
-    get_coupon,
-    list_coupons,
-    list_coupon_redemptions,
-    set_coupon_active,
-    list_order_manager_messages,
-    list_user_manager_messages,
-    update_product,
-    set_order_financials,
-    has_sort_conflict,
-    delete_service_message,
+from ..config import (
+    ADMIN_WEB_PASS,
+    ADMIN_WEB_SECRET,
+    ADMIN_WEB_USER,
+    BOT_TOKEN,
+    CURRENCY,
+    DB_SNAPSHOT_MAX_AGE_SECONDS,
+    LOG_FILE,
+    TELEGRAM_API_URL,
 )
+from ..db import COUNT_CAP, ORDER_STATUS_LABELS, PAYMENT_TYPE_LABELS, init_db
+from ..db_pool import close_all_connections, read_from_snapshot, reading_snapshot
+from ..outbox import Priority
+from ..repository import repo
 
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATES_DIR = BASE_DIR / "templates"
@@ -90,8 +50,8 @@ SERVICE_MESSAGE_LABELS = {
 }
 
 
-bot = Bot(BOT_TOKEN, parse_mode="HTML")
-TELEGRAM_API_BASE = "https://api.telegram.org"
+# پنل وب ربات ندارد؛ فقط برای دانلود رسیدها مستقیم به Bot API درخواست می‌دهد
+TELEGRAM_API_BASE = TELEGRAM_API_URL.rstrip("/")
 
 
 def _format_amount(value: Any) -> str:
@@ -144,6 +104,18 @@ def _collect_recent_logs(minutes: int = 5) -> str:
     return "\n".join(lines) if lines else "در بازهٔ ۵ دقیقهٔ اخیر لاگی موجود نیست."
 
 
+def _page_context(total: int, page: dict[str, Any], cursor: str, *, exact: bool) -> dict[str, Any]:
+    # جمع‌های بدون فیلتر از شمارنده‌ها دقیق‌اند؛ فقط شمارش فیلترشده در COUNT_CAP بریده می‌شود
+    capped = not exact and total > COUNT_CAP
+    return {
+        "total": COUNT_CAP if capped else total,
+        "total_capped": capped,
+        "next_cursor": page["next"],
+        "prev_cursor": page["prev"],
+        "cursor": cursor,
+    }
+
+
 def _flash(request: Request, text: str, category: str = "success") -> None:
     messages = request.session.get("messages") or []
     messages.append({"text": text, "category": category})
@@ -166,13 +138,83 @@ def _render(request: Request, template_name: str, context: dict[str, Any] | None
     return templates.TemplateResponse(template_name, ctx)
 
 
-async def _notify_user(user_id: int, text: str) -> None:
+async def _notify_user(
+    user_id: int,
+    text: str,
+    *,
+    priority: int = Priority.NORMAL,
+    order_id: int | None = None,
+    dedupe_key: str | None = None,
+) -> None:
     if not user_id:
         return
-    try:
-        await bot.send_message(user_id, text)
-    except Exception as e:
-        print(f"Error sending message to user {user_id}: {e}")
+    # فقط در جدول outbox ثبت می‌شود؛ پروسهٔ ربات آن را ارسال و وضعیتش را ثبت می‌کند
+    await notifications.enqueue(user_id, text, priority=priority, order_id=order_id, dedupe_key=dedupe_key)
+
+
+async def _notify_transition(user_id: int, moved: order_machine.Transition, order_title: str, *, plan_approval: bool = False) -> None:
+    order = moved.order
+    order_id = order["id"]
+    product_title = order.get("plan_title") or order.get("service_code") or order_title
+    # کلید یکتای همین تغییر وضعیت؛ ثبت دوباره پیام تکراری در outbox نمی‌سازد
+    key = f"order:{order_id}:{moved.from_status}>{moved.to_status}:{order.get('updated_at')}"
+    if moved.cashback > 0:
+        await _notify_user(
+            user_id,
+            (
+                f"🎁 مبلغ {_format_amount(moved.cashback)} {CURRENCY} بابت سفارش «{product_title}» به کیف پول شما اضافه شد.\n\n"
+                "منتظر خریدهای بعدی‌تان هستیم! 🌹"
+            ),
+            priority=Priority.HIGH,
+            order_id=order_id,
+            dedupe_key=f"{key}:cashback",
+        )
+
+    if plan_approval:
+        await _notify_user(
+            user_id,
+            (
+                f"✅ طرح خرید اول سفارش شما تایید شد و در حال انجام می‌باشد.\n"
+                f"سفارش #{order_id} - {product_title}"
+            ),
+            priority=Priority.HIGH,
+            order_id=order_id,
+            dedupe_key=key,
+        )
+    elif moved.to_status == "REJECTED":
+        await _notify_user(
+            user_id,
+            (
+                f"❌ سفارش «{order_title}» (#{order_id}) رد شد و مبلغ {moved.refunded} تومان به کیف پول شما واریز شد.\n"
+                "لطفاً در صورت نیاز با پشتیبانی تماس بگیرید."
+            ),
+            priority=Priority.HIGH,
+            order_id=order_id,
+            dedupe_key=key,
+        )
+    elif moved.to_status == "IN_PROGRESS":
+        await _notify_user(
+            user_id,
+            f"✅ پرداخت سفارش «{order_title}» (#{order_id}) تایید شد و در حال انجام است.",
+            priority=Priority.HIGH,
+            order_id=order_id,
+            dedupe_key=key,
+        )
+    elif moved.to_status == "COMPLETED":
+        manager_note_text = (order.get("manager_note") or "").strip()
+        message = f"🎉 سفارش «{order_title}» (#{order_id}) تکمیل شد."
+        if manager_note_text:
+            message += f"\n\nپیام مدیر:\n{manager_note_text}"
+        await _notify_user(user_id, message, priority=Priority.HIGH, order_id=order_id, dedupe_key=key)
+    else:
+        label = ORDER_STATUS_LABELS.get(moved.to_status, moved.to_status)
+        await _notify_user(
+            user_id,
+            f"📦 وضعیت سفارش «{order_title}» (#{order_id}) به «{label}» تغییر کرد.",
+            priority=Priority.HIGH,
+            order_id=order_id,
+            dedupe_key=key,
+        )
 
 
 async def _telegram_file_response(file_id: str) -> StreamingResponse:
@@ -235,8 +277,26 @@ def _login_required(request: Request) -> str:
     raise HTTPException(status.HTTP_303_SEE_OTHER, headers={"Location": location})
 
 
+async def _snapshot_reads(request: Request) -> None:
+    """Serve this request's reads from the snapshot, unless the session changed something recently."""
+
+    # وابستگی async در همان context مسیر اجرا می‌شود و علامت به نخ‌های repo هم می‌رسد
+    if db_snapshot.enabled() and time.time() >= float(request.session.get("primary_until") or 0):
+        read_from_snapshot()
+
+
 def create_admin_app() -> FastAPI:
     app = FastAPI(title="Premium Bot Admin", docs_url=None, redoc_url=None)
+
+    @app.middleware("http")
+    async def _remember_writes(request: Request, call_next):
+        # پیش از SessionMiddleware ثبت می‌شود تا داخل آن اجرا شود و به نشست دسترسی داشته باشد؛
+        # کسی که چیزی را تغییر داده تا پایان بازهٔ کهنگی نتیجه را از دیتابیس اصلی می‌بیند
+        response = await call_next(request)
+        if request.method not in {"GET", "HEAD"} and db_snapshot.enabled():
+            request.session["primary_until"] = time.time() + DB_SNAPSHOT_MAX_AGE_SECONDS
+        return response
+
     app.add_middleware(SessionMiddleware, secret_key=ADMIN_WEB_SECRET, same_site="lax")
     app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
@@ -244,10 +304,15 @@ def create_admin_app() -> FastAPI:
     async def _startup() -> None:
         init_db()
         seed_default_catalog()
+        if db_snapshot.install():
+            asyncio.create_task(db_snapshot.refresh_loop())
 
     @app.on_event("shutdown")
     async def _shutdown() -> None:
-        await bot.session.close()
+        # صف‌ها پیش از بستن اتصال‌ها کامل خالی می‌شوند
+        repo.shutdown(wait=True)
+        write_coalescer.shutdown()
+        close_all_connections()
 
     @app.get("/", include_in_schema=False)
     async def index(request: Request):
@@ -298,18 +363,30 @@ def create_admin_app() -> FastAPI:
         return RedirectResponse(target, status.HTTP_303_SEE_OTHER)
 
     @app.get("/dashboard", name="dashboard")
-    async def dashboard(request: Request, user: str = Depends(_login_required)):
-        snapshot = get_dashboard_snapshot()
-        snapshot["messages_total"] = count_service_messages()
-        recent_orders = list_recent_orders()
-        recent_users = list_recent_users()
-        recent_wallet = list_recent_wallet_tx()
+    async def dashboard(
+        request: Request, user: str = Depends(_login_required), _: None = Depends(_snapshot_reads)
+    ):
+        snapshot = await repo.get_dashboard_snapshot()
+        recent_orders = await repo.list_recent_orders()
+        recent_users = await repo.list_recent_users()
+        recent_wallet = await repo.list_recent_wallet_tx()
+        schema = await repo.get_migration_status()
+        runtime = await repo.list_runtime_metrics()
+        bot_metrics = runtime.get("bot") or {}
+        cache_rows = [("ربات", bot_metrics.get("cache"), bot_metrics.get("updated_at"))]
+        cache_rows.append(("پنل وب", cache.stats(), None))
         return _render(
             request,
             "dashboard.html",
             {
                 "title": "داشبورد",
                 "snapshot": snapshot,
+                "schema": schema,
+                "cache_rows": cache_rows,
+                "dispatch_stats": bot_metrics.get("dispatch"),
+                "outbox_stats": bot_metrics.get("outbox"),
+                "notification_counts": await notifications.counts(),
+                "snapshot_stats": db_snapshot.stats() if reading_snapshot() else None,
                 "recent_orders": recent_orders,
                 "recent_users": recent_users,
                 "recent_wallet": recent_wallet,
@@ -323,25 +400,24 @@ def create_admin_app() -> FastAPI:
     async def orders_page(
         request: Request,
         user: str = Depends(_login_required),
+        _: None = Depends(_snapshot_reads),
         status_filter: str = Query("all", alias="status"),
         q: str = Query("", alias="q"),
-        page: int = Query(1, ge=1),
+        cursor: str = Query(""),
+        direction: str = Query("next", alias="dir"),
     ):
         per_page = 20
-        total = count_orders(status=status_filter, search=q or None)
-        pages = max((total + per_page - 1) // per_page, 1)
-        page = min(page, pages)
-        offset = (page - 1) * per_page
-        items = list_orders(status=status_filter, search=q or None, limit=per_page, offset=offset)
+        total = await repo.count_orders(status=status_filter, search=q or None, cap=COUNT_CAP)
+        page = await repo.list_orders_page(
+            status=status_filter, search=q or None, cursor=cursor or None, direction=direction, limit=per_page
+        )
         return _render(
             request,
             "orders.html",
             {
                 "title": "مدیریت سفارش‌ها",
-                "orders": items,
-                "total": total,
-                "page": page,
-                "pages": pages,
+                "orders": page["items"],
+                **_page_context(total, page, cursor, exact=not q),
                 "status_filter": status_filter,
                 "query": q,
                 "format_amount": _format_amount,
@@ -354,26 +430,27 @@ def create_admin_app() -> FastAPI:
     async def messages_page(
         request: Request,
         user: str = Depends(_login_required),
+        _: None = Depends(_snapshot_reads),
         category: str = Query("all"),
-        page: int = Query(1, ge=1),
+        q: str = Query("", alias="q"),
+        cursor: str = Query(""),
+        direction: str = Query("next", alias="dir"),
     ):
         per_page = 20
         filter_value = None if category == "all" else category
-        total = count_service_messages(filter_value)
-        pages = max((total + per_page - 1) // per_page, 1)
-        page = min(page, pages)
-        offset = (page - 1) * per_page
-        items = list_service_messages(category=filter_value, limit=per_page, offset=offset)
+        total = await repo.count_service_messages(filter_value, q, cap=COUNT_CAP)
+        page = await repo.list_service_messages_page(
+            category=filter_value, search=q, cursor=cursor or None, direction=direction, limit=per_page
+        )
         return _render(
             request,
             "messages.html",
             {
                 "title": "پیام‌های دریافتی",
-                "messages_list": items,
-                "total": total,
-                "page": page,
-                "pages": pages,
+                "messages_list": page["items"],
+                **_page_context(total, page, cursor, exact=not filter_value and not q.strip()),
                 "category": category,
+                "query": q,
                 "nav": "messages",
                 "format_datetime": _format_datetime,
             },
@@ -381,7 +458,7 @@ def create_admin_app() -> FastAPI:
 
     @app.get("/products", name="products_page")
     async def products_page(request: Request, user: str = Depends(_login_required)):
-        items = get_admin_tree()
+        items = await repo.read(get_admin_tree)
         parent_options = [{"id": 0, "title": "(بدون والد)"}] + [
             {"id": row["id"], "title": row["path_display"] or row["title"]}
             for row in items
@@ -465,7 +542,7 @@ def create_admin_app() -> FastAPI:
             cashback_enabled = False
             cashback_percent = 0
         elif parent_id:
-            parent = get_product(parent_id)
+            parent = await repo.get_product(parent_id)
             if not parent or not parent.get("is_category"):
                 _flash(request, "والد باید یک دسته باشد.", "error")
                 return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
@@ -485,13 +562,13 @@ def create_admin_app() -> FastAPI:
             cashback_enabled = False
             cashback_percent = 0
 
-        if has_sort_conflict(
+        if await repo.has_sort_conflict(
             parent_id=parent_id, is_category=is_category, sort_order=sort_order, exclude_id=None
         ):
             _flash(request, "ترتیب انتخابی تکراری است. لطفاً عدد دیگری انتخاب کنید.", "error")
             return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
 
-        create_product(
+        await repo.create_product(
             title,
             is_category=is_category,
             parent_id=parent_id,
@@ -519,7 +596,7 @@ def create_admin_app() -> FastAPI:
         product_id: int,
         user: str = Depends(_login_required),
     ):
-        item = get_product(product_id)
+        item = await repo.get_product(product_id)
         if not item:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="محصول یافت نشد")
         form = await request.form()
@@ -586,7 +663,7 @@ def create_admin_app() -> FastAPI:
             cashback_enabled = False
             cashback_percent = 0
         elif parent_id:
-            parent = get_product(parent_id)
+            parent = await repo.get_product(parent_id)
             if not parent or not parent.get("is_category"):
                 _flash(request, "والد باید یک دسته باشد.", "error")
                 return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
@@ -603,13 +680,13 @@ def create_admin_app() -> FastAPI:
             self_require_username = False
             self_require_password = False
 
-        if has_sort_conflict(
+        if await repo.has_sort_conflict(
             parent_id=parent_id, is_category=is_category, sort_order=sort_order, exclude_id=product_id
         ):
             _flash(request, "ترتیب انتخابی تکراری است. لطفاً عدد دیگری انتخاب کنید.", "error")
             return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
 
-        ok = update_product(
+        ok = await repo.update_product(
             product_id,
             title=title,
             is_category=is_category,
@@ -644,9 +721,9 @@ def create_admin_app() -> FastAPI:
         product_id: int,
         user: str = Depends(_login_required),
     ):
-        if not get_product(product_id):
+        if not await repo.get_product(product_id):
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="محصول یافت نشد")
-        delete_product(product_id)
+        await repo.delete_product(product_id)
         _flash(request, "محصول/دسته حذف شد.")
         return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
 
@@ -665,7 +742,7 @@ def create_admin_app() -> FastAPI:
         seen_orders: set[tuple[int | None, bool, int]] = set()
 
         for pid in ids:
-            item = get_product(pid)
+            item = await repo.get_product(pid)
             if not item:
                 continue
             is_category = bool(int(form.get(f"is_category-{pid}") or (1 if item.get("is_category") else 0)))
@@ -734,7 +811,7 @@ def create_admin_app() -> FastAPI:
                 cashback_enabled = False
                 cashback_percent = 0
             elif parent_id:
-                parent = get_product(parent_id)
+                parent = await repo.get_product(parent_id)
                 if not parent or not parent.get("is_category"):
                     _flash(request, "والد باید یک دسته باشد.", "error")
                     return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
@@ -760,7 +837,7 @@ def create_admin_app() -> FastAPI:
                 return RedirectResponse(request.url_for("products_page"), status.HTTP_303_SEE_OTHER)
             seen_orders.add(signature)
 
-            if has_sort_conflict(
+            if await repo.has_sort_conflict(
                 parent_id=parent_id, is_category=is_category, sort_order=sort_order, exclude_id=pid
             ):
                 _flash(request, "ترتیب انتخابی تکراری است. لطفاً عدد دیگری انتخاب کنید.", "error")
@@ -792,7 +869,7 @@ def create_admin_app() -> FastAPI:
             )
 
         for payload in pending:
-            update_product(
+            await repo.update_product(
                 payload["pid"],
                 title=payload["title"],
                 parent_id=payload["parent_id"],
@@ -820,17 +897,18 @@ def create_admin_app() -> FastAPI:
 
     @app.get("/orders/{order_id}")
     async def order_detail(request: Request, order_id: int, user: str = Depends(_login_required)):
-        order = get_order(order_id)
+        order = await repo.get_order(order_id, fresh=True)
         if not order:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="سفارش یافت نشد")
-        customer = get_user(order.get("user_id")) if order.get("user_id") else None
-        wallet_history = list_wallet_tx_for_order(order_id)
+        customer = await repo.get_user(order.get("user_id"), fresh=True) if order.get("user_id") else None
+        wallet_history = await repo.list_wallet_tx_for_order(order_id)
         related_orders = []
         if order.get("user_id"):
             related_orders = [
-                o for o in list_orders(user_id=order["user_id"], limit=5) if o["id"] != order_id
+                o for o in await repo.list_orders(user_id=order["user_id"], limit=5) if o["id"] != order_id
             ]
-        manager_messages = list_order_manager_messages(order_id, limit=50)
+        manager_messages = await repo.list_order_manager_messages(order_id, limit=50)
+        order_notifications = await notifications.for_order(order_id)
         order_title = order.get("plan_title") or order.get("service_code") or f"سفارش #{order_id}"
         return _render(
             request,
@@ -842,6 +920,8 @@ def create_admin_app() -> FastAPI:
                 "wallet_history": wallet_history,
                 "related_orders": related_orders,
                 "manager_messages": manager_messages,
+                "order_notifications": order_notifications,
+                "notification_labels": notifications.STATUS_LABELS,
                 "order_title": order_title,
                 "format_amount": _format_amount,
                 "format_datetime": _format_datetime,
@@ -851,14 +931,14 @@ def create_admin_app() -> FastAPI:
 
     @app.get("/orders/{order_id}/receipt")
     async def order_receipt(order_id: int, user: str = Depends(_login_required)):
-        order = get_order(order_id)
+        order = await repo.get_order(order_id, fresh=True)
         if not order or not order.get("receipt_file_id"):
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="رسید برای این سفارش وجود ندارد")
         return await _telegram_file_response(order["receipt_file_id"])
 
     @app.get("/messages/{message_id}/attachment")
     async def message_attachment(message_id: int, user: str = Depends(_login_required)):
-        message = get_service_message(message_id)
+        message = await repo.get_service_message(message_id)
         if not message or not message.get("attachment_file_id"):
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="پیوست یافت نشد")
         return await _telegram_file_response(message["attachment_file_id"])
@@ -869,11 +949,11 @@ def create_admin_app() -> FastAPI:
         message_id: int,
         user: str = Depends(_login_required),
     ):
-        message = get_service_message(message_id)
+        message = await repo.get_service_message(message_id)
         if not message:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="پیام یافت نشد")
-        replies = list_service_message_replies(message_id)
-        customer = get_user(message.get("user_id")) if message.get("user_id") else None
+        replies = await repo.list_service_message_replies(message_id)
+        customer = await repo.get_user(message.get("user_id"), fresh=True) if message.get("user_id") else None
         category_label = SERVICE_MESSAGE_LABELS.get(message.get("category"), message.get("category"))
         return _render(
             request,
@@ -896,20 +976,21 @@ def create_admin_app() -> FastAPI:
         user: str = Depends(_login_required),
         reply_text: str = Form(...),
     ):
-        message = get_service_message(message_id)
+        message = await repo.get_service_message(message_id)
         if not message:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="پیام یافت نشد")
         text = (reply_text or "").strip()
         if not text:
             _flash(request, "متن پیام نمی‌تواند خالی باشد.", "error")
             return RedirectResponse(request.url_for("message_detail", message_id=message_id), status.HTTP_303_SEE_OTHER)
-        add_service_message_reply(message_id, message.get("user_id"), text)
+        reply_id = await repo.add_service_message_reply(message_id, message.get("user_id"), text)
         user_id = message.get("user_id")
         if user_id:
             category_label = SERVICE_MESSAGE_LABELS.get(message.get("category"), message.get("category"))
             await _notify_user(
                 int(user_id),
                 f"📨 پاسخ مدیریت درباره درخواست «{category_label}»:\n\n{text}",
+                dedupe_key=f"service-reply:{reply_id}",
             )
         _flash(request, "پاسخ برای مشتری ارسال شد.")
         return RedirectResponse(request.url_for("message_detail", message_id=message_id), status.HTTP_303_SEE_OTHER)
@@ -921,11 +1002,11 @@ def create_admin_app() -> FastAPI:
         user: str = Depends(_login_required),
         new_status: str = Form(...),
     ):
-        message = get_service_message(message_id)
+        message = await repo.get_service_message(message_id)
         if not message:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="پیام یافت نشد")
         resolved = (new_status or "").lower() == "closed"
-        set_service_message_status(message_id, resolved)
+        await repo.set_service_message_status(message_id, resolved)
         label = "بسته" if resolved else "باز"
         _flash(request, f"وضعیت پیام به «{label}» تغییر کرد.")
         return RedirectResponse(request.url_for("message_detail", message_id=message_id), status.HTTP_303_SEE_OTHER)
@@ -936,11 +1017,11 @@ def create_admin_app() -> FastAPI:
         message_id: int,
         user: str = Depends(_login_required),
     ):
-        message = get_service_message(message_id)
+        message = await repo.get_service_message(message_id)
         if not message:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="پیام یافت نشد")
         
-        delete_service_message(message_id)
+        await repo.delete_service_message(message_id)
         _flash(request, "پیام با موفقیت حذف شد.", "success")
         return RedirectResponse(request.url_for("messages"), status.HTTP_303_SEE_OTHER)
 
@@ -955,7 +1036,7 @@ def create_admin_app() -> FastAPI:
         manager_note: str = Form(""),
         cost_amount: str = Form("0"),
     ):
-        order = get_order(order_id)
+        order = await repo.get_order(order_id, fresh=True)
         if not order:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="سفارش یافت نشد")
 
@@ -979,129 +1060,40 @@ def create_admin_app() -> FastAPI:
             if new_status not in ORDER_STATUS_LABELS:
                 raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="وضعیت نامعتبر است")
 
-            status_changed = original_status != new_status
-            if status_changed:
-                set_order_status(order_id, new_status)
-
-            if status_changed and new_status in {"IN_PROGRESS", "READY_TO_DELIVER", "DELIVERED", "COMPLETED"}:
-                reserved_amount = int(order.get("wallet_reserved_amount") or 0)
-                if reserved_amount > 0:
-                    used_amount = int(order.get("wallet_used_amount") or 0)
-                    set_order_wallet_reserved(order_id, 0)
-                    set_order_wallet_used(order_id, used_amount + reserved_amount)
-
-            # بررسی کش‌بک
-            prev_cashback = int(order.get("cashback_applied_amount") or 0)
-            updated = get_order(order_id)
-            curr_cashback = int(updated.get("cashback_applied_amount") or 0) if updated else 0
-            cashback_delta = curr_cashback - prev_cashback
-
-            if status_changed and updated and user_id:
-                # اگر کش‌بک اضافه شده، پیام بفرست
-                if cashback_delta > 0:
-                    product_title = updated.get("plan_title") or updated.get("service_code") or order_title
-                    await _notify_user(
-                        int(user_id),
-                        (
-                            f"🎁 مبلغ {_format_amount(cashback_delta)} {CURRENCY} بابت سفارش «{product_title}» به کیف پول شما اضافه شد.\n\n"
-                            "منتظر خریدهای بعدی‌تان هستیم! 🌹"
-                        )
-                    )
+            if original_status == new_status:
+                _flash(request, "تغییری در وضعیت سفارش ایجاد نشد.", "info")
+                return RedirectResponse(request.url_for("order_detail", order_id=order_id), status.HTTP_303_SEE_OTHER)
+            if not order_machine.can_transition(original_status, new_status, admin=True):
+                _flash(request, "این تغییر وضعیت برای سفارش مجاز نیست.", "error")
+                return RedirectResponse(request.url_for("order_detail", order_id=order_id), status.HTTP_303_SEE_OTHER)
 
-                if plan_approval:
-                    product_title = updated.get("plan_title") or updated.get("service_code") or order_title
-                    await _notify_user(
-                        int(user_id),
-                        (
-                            f"✅ طرح خرید اول سفارش شما تایید شد و در حال انجام می‌باشد.\n"
-                            f"سفارش #{order_id} - {product_title}"
-                        ),
-                    )
-                elif new_status == "REJECTED":
-                    reserved_amount = int(updated.get("wallet_reserved_amount") or 0)
-                    used_amount = int(updated.get("wallet_used_amount") or 0)
-                    total_amount = int(updated.get("amount_total") or 0)
-                    card_part = max(total_amount - reserved_amount - used_amount, 0)
-                    refund_total = 0
-                    if reserved_amount > 0:
-                        change_wallet(
-                            user_id,
-                            reserved_amount,
-                            "REFUND",
-                            note=f"Order #{order_id} rejected",
-                            order_id=order_id,
-                        )
-                        set_order_wallet_reserved(order_id, 0)
-                        refund_total += reserved_amount
-                    if used_amount > 0:
-                        change_wallet(
-                            user_id,
-                            used_amount,
-                            "REFUND",
-                            note=f"Order #{order_id} rejected",
-                            order_id=order_id,
-                        )
-                        set_order_wallet_used(order_id, 0)
-                        refund_total += used_amount
-                    if card_part > 0:
-                        change_wallet(
-                            user_id,
-                            card_part,
-                            "CREDIT",
-                            note=f"Order #{order_id} card refund",
-                            order_id=order_id,
-                        )
-                        refund_total += card_part
-                    await _notify_user(
-                        int(user_id),
-                        (
-                            f"❌ سفارش «{order_title}» (#{order_id}) رد شد و مبلغ {refund_total} تومان به کیف پول شما واریز شد.\n"
-                            "لطفاً در صورت نیاز با پشتیبانی تماس بگیرید."
-                        ),
-                    )
-                elif new_status == "IN_PROGRESS":
-                    await _notify_user(
-                        int(user_id),
-                        f"✅ پرداخت سفارش «{order_title}» (#{order_id}) تایید شد و در حال انجام است.",
-                    )
-                elif new_status == "COMPLETED":
-                    manager_note_text = (updated.get("manager_note") or "").strip()
-                    message = f"🎉 سفارش «{order_title}» (#{order_id}) تکمیل شد."
-                    if manager_note_text:
-                        message += f"\n\nپیام مدیر:\n{manager_note_text}"
-                    await _notify_user(int(user_id), message)
-                else:
-                    label = ORDER_STATUS_LABELS.get(new_status, new_status)
-                    await _notify_user(
-                        int(user_id),
-                        f"📦 وضعیت سفارش «{order_title}» (#{order_id}) به «{label}» تغییر کرد.",
-                    )
+            moved = await repo.transition_order(order_id, new_status, expected=original_status or "", admin=True)
+            if moved is None:
+                _flash(request, "وضعیت سفارش هم‌زمان تغییر کرده است؛ صفحه را تازه کنید و دوباره تلاش کنید.", "error")
+                return RedirectResponse(request.url_for("order_detail", order_id=order_id), status.HTTP_303_SEE_OTHER)
+
+            if user_id:
+                await _notify_transition(int(user_id), moved, order_title, plan_approval=plan_approval)
 
             _flash(request, "وضعیت سفارش به‌روزرسانی شد.")
 
         elif action == "payment":
             normalized_payment = payment_type or None
             if (order.get("payment_type") or None) != normalized_payment:
-                set_order_payment_type(order_id, normalized_payment)
+                await repo.set_order_payment_type(order_id, normalized_payment)
                 _flash(request, "نوع پرداخت سفارش به‌روزرسانی شد.")
             else:
                 _flash(request, "تغییری در نوع پرداخت ایجاد نشد.", "info")
 
         elif action == "plan_confirm":
-            if order.get("status") != "PENDING_PLAN":
+            moved = None
+            if order.get("status") == "PENDING_PLAN":
+                moved = await repo.transition_order(order_id, "IN_PROGRESS", expected="PENDING_PLAN")
+            if moved is None:
                 _flash(request, "امکان تایید طرح وجود ندارد (وضعیت نامعتبر است).", "error")
             else:
-                set_order_status(order_id, "IN_PROGRESS")
-                updated = get_order(order_id)
                 if user_id:
-                    product_title = updated.get("plan_title") or updated.get("service_code") or order_title
-                    await _notify_user(
-                        int(user_id),
-                        (
-                            f"✅ طرح خرید اول سفارش شما تایید شد و در حال انجام می‌باشد.\n"
-                            f"سفارش #{order_id} - {product_title}"
-                        ),
-                    )
+                    await _notify_transition(int(user_id), moved, order_title, plan_approval=True)
                 _flash(request, "طرح خرید اول تایید و سفارش در حال انجام شد.")
 
         elif action == "manager_note":
@@ -1109,12 +1101,14 @@ def create_admin_app() -> FastAPI:
             if not text:
                 _flash(request, "متن پیام مدیر نمی‌تواند خالی باشد.", "error")
             else:
-                update_order_notes(order_id, text)
-                add_order_manager_message(order_id, user_id, text)
+                await repo.update_order_notes(order_id, text)
+                message_id = await repo.add_order_manager_message(order_id, user_id, text)
                 if user_id:
                     await _notify_user(
                         int(user_id),
                         f"📬 پیام جدید درباره سفارش «{order_title}» (#{order_id}):\n\n{text}",
+                        order_id=order_id,
+                        dedupe_key=f"order-message:{message_id}",
                     )
                 _flash(request, "پیام مدیر برای مشتری ارسال شد.")
 
@@ -1123,7 +1117,7 @@ def create_admin_app() -> FastAPI:
                 cost_value = int(cost_amount)
             except (TypeError, ValueError):
                 cost_value = 0
-            set_order_financials(order_id, cost_value)
+            await repo.set_order_financials(order_id, cost_value)
             _flash(request, "اطلاعات مالی سفارش ذخیره شد.")
 
         else:
@@ -1135,24 +1129,23 @@ def create_admin_app() -> FastAPI:
     async def users_page(
         request: Request,
         user: str = Depends(_login_required),
+        _: None = Depends(_snapshot_reads),
         q: str = Query("", alias="q"),
-        page: int = Query(1, ge=1),
+        cursor: str = Query(""),
+        direction: str = Query("next", alias="dir"),
     ):
         per_page = 20
-        total = count_users(search=q or None)
-        pages = max((total + per_page - 1) // per_page, 1)
-        page = min(page, pages)
-        offset = (page - 1) * per_page
-        items = list_users(search=q or None, limit=per_page, offset=offset)
+        total = await repo.count_users(search=q or None, cap=COUNT_CAP)
+        page = await repo.list_users_page(
+            search=q or None, cursor=cursor or None, direction=direction, limit=per_page
+        )
         return _render(
             request,
             "users.html",
             {
                 "title": "مدیریت کاربران",
-                "users": items,
-                "total": total,
-                "page": page,
-                "pages": pages,
+                "users": page["items"],
+                **_page_context(total, page, cursor, exact=not q),
                 "query": q,
                 "format_datetime": _format_datetime,
                 "format_amount": _format_amount,
@@ -1162,12 +1155,12 @@ def create_admin_app() -> FastAPI:
 
     @app.get("/users/{user_id}")
     async def user_detail(request: Request, user_id: int, user: str = Depends(_login_required)):
-        profile = get_user(user_id)
+        profile = await repo.get_user(user_id, fresh=True)
         if not profile:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کاربر یافت نشد")
-        stats = get_user_stats(user_id)
-        orders = list_orders(user_id=user_id, limit=10)
-        wallet_history_rows = list_wallet_tx_for_user(user_id, limit=25)
+        stats = await repo.get_user_stats(user_id)
+        orders = await repo.list_orders(user_id=user_id, limit=10)
+        wallet_history_rows = await repo.list_wallet_tx_for_user(user_id, limit=25)
         wallet_history: list[dict[str, Any]] = []
         for tx in wallet_history_rows:
             note = str(tx.get("note") or "")
@@ -1183,7 +1176,7 @@ def create_admin_app() -> FastAPI:
                     "coupon_code": coupon_code.strip() if coupon_code else None,
                 }
             )
-        manager_messages = list_user_manager_messages(user_id, limit=20)
+        manager_messages = await repo.list_user_manager_messages(user_id, limit=20)
         return _render(
             request,
             "user_detail.html",
@@ -1209,7 +1202,7 @@ def create_admin_app() -> FastAPI:
         amount: int = Form(...),
         note: str = Form(""),
     ):
-        profile = get_user(user_id)
+        profile = await repo.get_user(user_id, fresh=True)
         if not profile:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کاربر یافت نشد")
         if amount <= 0:
@@ -1225,12 +1218,12 @@ def create_admin_app() -> FastAPI:
             tx_type = "REFUND"
         elif action == "reserve":
             tx_type = "RESERVE"
-        success = change_wallet(user_id, delta, tx_type, note=note or "")
+        success = await repo.change_wallet(user_id, delta, tx_type, note=note or "")
         if not success:
             _flash(request, "امکان اعمال تغییر وجود ندارد (موجودی کافی نیست؟)", "error")
         else:
             _flash(request, "تغییر موجودی با موفقیت ثبت شد.")
-            new_profile = get_user(user_id)
+            new_profile = await repo.get_user(user_id, fresh=True)
             balance = int(new_profile.get("wallet_balance") if new_profile else 0)
             sign = "+" if delta > 0 else "-"
             await _notify_user(
@@ -1239,6 +1232,7 @@ def create_admin_app() -> FastAPI:
                     f"📢 موجودی کیف پول شما {sign}{abs(delta)} تومان تغییر کرد.\n"
                     f"موجودی فعلی: {balance} تومان."
                 ),
+                priority=Priority.HIGH,
             )
         return RedirectResponse(request.url_for("user_detail", user_id=user_id), status.HTTP_303_SEE_OTHER)
 
@@ -1249,7 +1243,7 @@ def create_admin_app() -> FastAPI:
         user: str = Depends(_login_required),
         message_text: str = Form(...),
     ):
-        profile = get_user(user_id)
+        profile = await repo.get_user(user_id, fresh=True)
         if not profile:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کاربر یافت نشد")
         text = (message_text or "").strip()
@@ -1257,8 +1251,8 @@ def create_admin_app() -> FastAPI:
             _flash(request, "متن پیام نمی‌تواند خالی باشد.", "error")
             return RedirectResponse(request.url_for("user_detail", user_id=user_id), status.HTTP_303_SEE_OTHER)
 
-        add_user_manager_message(user_id, text)
-        await _notify_user(int(user_id), f"📬 پیام مدیر\n\n{text}")
+        message_id = await repo.add_user_manager_message(user_id, text)
+        await _notify_user(int(user_id), f"📬 پیام مدیر\n\n{text}", dedupe_key=f"user-message:{message_id}")
         _flash(request, "پیام برای کاربر ارسال شد.")
         return RedirectResponse(request.url_for("user_detail", user_id=user_id), status.HTTP_303_SEE_OTHER)
 
@@ -1269,15 +1263,15 @@ def create_admin_app() -> FastAPI:
         user: str = Depends(_login_required),
         action: str = Form(...),
     ):
-        profile = get_user(user_id)
+        profile = await repo.get_user(user_id, fresh=True)
         if not profile:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کاربر یافت نشد")
         if action == "block":
-            set_user_blocked(user_id, True)
+            await repo.set_user_blocked(user_id, True)
             _flash(request, "کاربر مسدود شد.")
             await _notify_user(int(user_id), "⛔️ دسترسی شما به خدمات ربات توسط مدیریت مسدود شد.")
         elif action == "unblock":
-            set_user_blocked(user_id, False)
+            await repo.set_user_blocked(user_id, False)
             _flash(request, "کاربر از حالت مسدود خارج شد.")
             await _notify_user(int(user_id), "✅ دسترسی شما به خدمات ربات دوباره فعال شد.")
         else:
@@ -1285,9 +1279,11 @@ def create_admin_app() -> FastAPI:
         return RedirectResponse(request.url_for("user_detail", user_id=user_id), status.HTTP_303_SEE_OTHER)
 
     @app.get("/wallet")
-    async def wallet_page(request: Request, user: str = Depends(_login_required)):
-        summary = get_wallet_summary()
-        recent = list_recent_wallet_tx(limit=50)
+    async def wallet_page(
+        request: Request, user: str = Depends(_login_required), _: None = Depends(_snapshot_reads)
+    ):
+        summary = await repo.get_wallet_summary()
+        recent = await repo.list_recent_wallet_tx(limit=50)
         
         # اصلاح نمایش نوع تراکنش برای کش‌بک
         display_transactions = []
@@ -1313,7 +1309,7 @@ def create_admin_app() -> FastAPI:
 
     @app.get("/coupons")
     async def coupons_page(request: Request, user: str = Depends(_login_required)):
-        coupons = list_coupons(limit=200)
+        coupons = await repo.list_coupons(limit=200)
         now_dt = datetime.now()
         for item in coupons:
             try:
@@ -1346,7 +1342,7 @@ def create_admin_app() -> FastAPI:
             item["is_expired"] = is_expired
             item["remaining"] = max(item["usage_limit"] - item["used_count"], 0)
             item["is_active"] = bool(item.get("is_active"))
-            redemptions = list_coupon_redemptions(item.get("id")) if item.get("id") else []
+            redemptions = await repo.list_coupon_redemptions(item.get("id")) if item.get("id") else []
             item["redeemed_users"] = [
                 {"user_id": row.get("user_id"), "times": int(row.get("times_used") or 0)}
                 for row in redemptions
@@ -1391,7 +1387,7 @@ def create_admin_app() -> FastAPI:
             expires_at = f"{expires_input}T23:59:59"
 
         try:
-            create_coupon(
+            await repo.create_coupon(
                 normalized_code,
                 amount,
                 usage_limit,
@@ -1418,7 +1414,7 @@ def create_admin_app() -> FastAPI:
         usage_limit_per_user: int = Form(...),
         expires_on: str = Form(""),
     ):
-        coupon = get_coupon(coupon_id)
+        coupon = await repo.get_coupon(coupon_id)
         if not coupon:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کوپن یافت نشد")
 
@@ -1444,7 +1440,7 @@ def create_admin_app() -> FastAPI:
             _flash(request, "کد کوپن نمی‌تواند خالی باشد.", "error")
             return RedirectResponse(request.url_for("coupons_page"), status.HTTP_303_SEE_OTHER)
         try:
-            success = update_coupon(
+            success = await repo.update_coupon(
                 coupon_id,
                 code=normalized_code,
                 amount=amount,
@@ -1469,12 +1465,12 @@ def create_admin_app() -> FastAPI:
         coupon_id: int,
         user: str = Depends(_login_required),
     ):
-        coupon = get_coupon(coupon_id)
+        coupon = await repo.get_coupon(coupon_id)
         if not coupon:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کوپن یافت نشد")
 
         is_active = bool(coupon.get("is_active"))
-        set_coupon_active(coupon_id, not is_active)
+        await repo.set_coupon_active(coupon_id, not is_active)
         state_text = "فعال" if not is_active else "غیرفعال"
         _flash(request, f"کوپن {coupon.get('code')} {state_text} شد.")
 
@@ -1484,10 +1480,10 @@ def create_admin_app() -> FastAPI:
     async def coupon_redemptions_page(
         request: Request, coupon_id: int, user: str = Depends(_login_required)
     ):
-        coupon = get_coupon(coupon_id)
+        coupon = await repo.get_coupon(coupon_id)
         if not coupon:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کوپن یافت نشد")
-        redemptions = list_coupon_redemptions(coupon_id)
+        redemptions = await repo.list_coupon_redemptions(coupon_id)
         for r in redemptions:
             r["times_used"] = int(r.get("times_used") or 0)
         return _render(
@@ -1507,18 +1503,18 @@ def create_admin_app() -> FastAPI:
     async def coupon_delete(
         request: Request, coupon_id: int, user: str = Depends(_login_required)
     ):
-        coupon = get_coupon(coupon_id)
+        coupon = await repo.get_coupon(coupon_id)
         if not coupon:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="کوپن یافت نشد")
-        delete_coupon(coupon_id)
+        await repo.delete_coupon(coupon_id)
         _flash(request, f"کوپن {coupon.get('code')} حذف شد.")
         return RedirectResponse(request.url_for("coupons_page"), status.HTTP_303_SEE_OTHER)
 
     @app.get("/discounts")
     async def discounts_page(request: Request, user: str = Depends(_login_required)):
-        discounts = list_discounts(limit=200)
+        discounts = await repo.list_discounts(limit=200)
         now_dt = datetime.now()
-        products = [p for p in get_admin_tree() if not p.get("is_category")]
+        products = [p for p in await repo.read(get_admin_tree) if not p.get("is_category")]
         for item in discounts:
             try:
                 item["amount"] = int(item.get("amount") or 0)
@@ -1589,7 +1585,7 @@ def create_admin_app() -> FastAPI:
             expires_at = f"{expires_input}T23:59:59"
 
         try:
-            create_discount(
+            await repo.create_discount(
                 normalized_code,
                 amount,
                 usage_limit,
@@ -1621,7 +1617,7 @@ def create_admin_app() -> FastAPI:
         expires_on: str = Form(""),
         is_active: bool = Form(False),
     ):
-        discount = get_discount(discount_id)
+        discount = await repo.get_discount(discount_id)
         if not discount:
             _flash(request, "کد یافت نشد.", "error")
             return RedirectResponse(request.url_for("discounts_page"), status.HTTP_303_SEE_OTHER)
@@ -1636,7 +1632,7 @@ def create_admin_app() -> FastAPI:
         if expires_input:
             expires_at = f"{expires_input}T23:59:59"
 
-        success = update_discount(
+        success = await repo.update_discount(
             discount_id,
             code=code,
             amount=amount,
@@ -1657,12 +1653,12 @@ def create_admin_app() -> FastAPI:
     async def discount_toggle(
         request: Request, discount_id: int, user: str = Depends(_login_required)
     ):
-        discount = get_discount(discount_id)
+        discount = await repo.get_discount(discount_id)
         if not discount:
             _flash(request, "کد یافت نشد.", "error")
             return RedirectResponse(request.url_for("discounts_page"), status.HTTP_303_SEE_OTHER)
         is_active = bool(discount.get("is_active"))
-        set_discount_active(discount_id, not is_active)
+        await repo.set_discount_active(discount_id, not is_active)
         state_text = "فعال" if not is_active else "غیرفعال"
         _flash(request, f"کد {discount.get('code')} {state_text} شد.")
         return RedirectResponse(request.url_for("discounts_page"), status.HTTP_303_SEE_OTHER)
@@ -1671,11 +1667,11 @@ def create_admin_app() -> FastAPI:
     async def discount_delete(
         request: Request, discount_id: int, user: str = Depends(_login_required)
     ):
-        discount = get_discount(discount_id)
+        discount = await repo.get_discount(discount_id)
         if not discount:
             _flash(request, "کد یافت نشد.", "error")
             return RedirectResponse(request.url_for("discounts_page"), status.HTTP_303_SEE_OTHER)
-        delete_discount(discount_id)
+        await repo.delete_discount(discount_id)
         _flash(request, f"کد {discount.get('code')} حذف شد.")
         return RedirectResponse(request.url_for("discounts_page"), status.HTTP_303_SEE_OTHER)
 
@@ -1683,11 +1679,11 @@ def create_admin_app() -> FastAPI:
     async def discount_redemptions_page(
         request: Request, discount_id: int, user: str = Depends(_login_required)
     ):
-        discount = get_discount(discount_id)
+        discount = await repo.get_discount(discount_id)
         if not discount:
             _flash(request, "کد یافت نشد.", "error")
             return RedirectResponse(request.url_for("discounts_page"), status.HTTP_303_SEE_OTHER)
-        redemptions = list_discount_redemptions(discount_id)
+        redemptions = await repo.list_discount_redemptions(discount_id)
         for r in redemptions:
             r["times_used"] = int(r.get("times_used") or 0)
         return _render(
@@ -0,0 +1,176 @@
+"""Receiving Telegram updates through a webhook instead of long polling.
+
+With ``BOT_MODE=webhook`` Telegram POSTs every update to
+``WEBHOOK_BASE_URL + WEBHOOK_PATH``.  :class:`WebhookHandler` checks the
+``X-Telegram-Bot-Api-Secret-Token`` header, parses the update and answers
+200 right away; the update is then handled by ``Dispatcher.feed_update`` in
+a background task, so a slow handler never holds Telegram's connection
+(which would make it retry and slow down every other update).  When more
+than ``WEBHOOK_MAX_PENDING`` updates are still being handled, requests get
+503 and Telegram delivers them again later.
+
+:func:`mount` adds the endpoint to any FastAPI app, :func:`create_app`
+builds a standalone one, and :func:`serve` runs it with uvicorn, either on
+its own (``WEBHOOK_BIND`` / ``WEBHOOK_PORT``) or mounted into the admin
+panel when ``WEBHOOK_WITH_ADMIN`` is set.  Point ``TELEGRAM_API_URL`` at a
+local fake Bot API server to test the whole path without Telegram.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import secrets
+import time
+from typing import Any
+
+import uvicorn
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from fastapi import FastAPI, Request, Response
+from pydantic import ValidationError
+
+from .config import (
+    ADMIN_WEB_BIND,
+    ADMIN_WEB_PORT,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_BIND,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_MAX_PENDING,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_WITH_ADMIN,
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        *,
+        secret: str = WEBHOOK_SECRET,
+        max_pending: int = WEBHOOK_MAX_PENDING,
+    ) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.max_pending = max(int(max_pending), 1)
+        self._tasks: set[asyncio.Task] = set()
+        self.received = 0
+        self.rejected = 0
+        self.busy = 0
+        self.failed = 0
+        self.handled = 0
+        self._handle_seconds = 0.0
+
+    async def handle(self, request: Request) -> Response:
+        if self.secret and not secrets.compare_digest(
+            request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()
+        ):
+            self.rejected += 1
+            return Response(status_code=403)
+        if len(self._tasks) >= self.max_pending:
+            # تلگرام آپدیتی را که جواب 2xx نگرفته بعداً دوباره می‌فرستد
+            self.busy += 1
+            return Response(status_code=503, headers={"Retry-After": "1"})
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except (ValueError, ValidationError):
+            self.rejected += 1
+            return Response(status_code=400)
+        self.received += 1
+        task = asyncio.create_task(self._process(update), name=f"update-{update.update_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return Response(status_code=200)
+
+    async def _process(self, update: Update) -> None:
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update, bots=[self.bot])
+        except Exception:
+            self.failed += 1
+            logger.exception("webhook update %s failed", update.update_id)
+        finally:
+            self.handled += 1
+            self._handle_seconds += time.perf_counter() - started
+
+    async def startup(self) -> None:
+        await self.dp.emit_startup(bot=self.bot, dispatcher=self.dp, bots=[self.bot], **self.dp.workflow_data)
+        if WEBHOOK_BASE_URL:
+            await self.bot.set_webhook(
+                WEBHOOK_BASE_URL + WEBHOOK_PATH,
+                secret_token=self.secret or None,
+                allowed_updates=self.dp.resolve_used_update_types(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info("webhook set to %s%s", WEBHOOK_BASE_URL, WEBHOOK_PATH)
+        else:
+            logger.warning("WEBHOOK_BASE_URL is empty; setWebhook was not called")
+
+    async def shutdown(self, timeout: float = 30.0) -> None:
+        """Wait for the updates already accepted, run the dispatcher's shutdown, then close the bot session.
+
+        ``start_polling`` closes the session itself; in webhook mode nothing
+        else does, and aiohttp would warn about an unclosed client session.
+        """
+
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning("cancelled %s webhook updates still running at shutdown", len(pending))
+        try:
+            await self.dp.emit_shutdown(bot=self.bot, dispatcher=self.dp, bots=[self.bot], **self.dp.workflow_data)
+        finally:
+            # هوک‌های shutdown (relay و صف پیام) هنوز با همین نشست پیام می‌فرستند
+            await self.bot.session.close()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "pending": len(self._tasks),
+            "received": self.received,
+            "rejected": self.rejected,
+            "busy": self.busy,
+            "failed": self.failed,
+            "avg_handle_ms": round(self._handle_seconds / self.handled * 1000, 2) if self.handled else 0.0,
+        }
+
+
+def mount(app: FastAPI, handler: WebhookHandler, path: str = WEBHOOK_PATH) -> None:
+    """Add the webhook endpoint and its startup / shutdown hooks to ``app``."""
+
+    app.add_api_route(path, handler.handle, methods=["POST"], include_in_schema=False)
+    app.router.on_startup.append(handler.startup)
+    # پیش از هوک‌های خود اپ اجرا می‌شود؛ پنل وب در shutdown صف‌های دیتابیس را می‌بندد
+    app.router.on_shutdown.insert(0, handler.shutdown)
+
+
+def create_app(handler: WebhookHandler) -> FastAPI:
+    app = FastAPI(title="Premium Bot webhook", docs_url=None, redoc_url=None, openapi_url=None)
+    mount(app, handler)
+    return app
+
+
+async def serve(handler: WebhookHandler) -> None:
+    """Serve the webhook until the process is asked to stop."""
+
+    if WEBHOOK_WITH_ADMIN:
+        from .webadmin.server import app
+
+        mount(app, handler)
+        host, port = ADMIN_WEB_BIND, ADMIN_WEB_PORT
+    else:
+        app = create_app(handler)
+        host, port = WEBHOOK_BIND, WEBHOOK_PORT
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_config=None, access_log=False))
+    await server.serve()
+
+
+__all__ = ["SECRET_HEADER", "WebhookHandler", "create_app", "mount", "serve"]
@@ -0,0 +1,218 @@
+"""Optional group commit for small single-statement writes.
+
+When ``DB_WRITE_COALESCE`` is on, helpers such as ``set_order_payment_type``
+hand their ``UPDATE`` to one background writer thread instead of committing
+on their own.  The writer gathers whatever arrives within
+``DB_COALESCE_WINDOW_MS`` (up to ``DB_COALESCE_MAX_BATCH`` statements) and
+commits it as one transaction, so a burst of updates pays for one fsync.
+Each statement runs in its own savepoint: one that fails is rolled back
+alone and only its future gets the error.
+
+Every submitted statement gets a :class:`concurrent.futures.Future` that
+resolves once its batch is committed.  Any other use of the database on
+another thread first waits for the statements submitted so far, so reads
+always see earlier writes.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any
+
+from . import db_pool
+from .config import DB_COALESCE_MAX_BATCH, DB_COALESCE_WINDOW_MS, DB_WRITE_COALESCE
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteCoalescer:
+    def __init__(self, window_ms: float = DB_COALESCE_WINDOW_MS, max_batch: int = DB_COALESCE_MAX_BATCH) -> None:
+        self.window = max(float(window_ms), 0.0) / 1000
+        self.max_batch = max(int(max_batch), 1)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._done = 0
+        self._stopped = False
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.statements = 0
+        self.failed = 0
+        self.max_batch_seen = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name="db-coalescer", daemon=True)
+        self._thread.start()
+
+    # --- public API -------------------------------------------------
+    def submit(self, sql: str, params: tuple | list = ()) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("write coalescer is stopped")
+            self._submitted += 1
+            seq = self._submitted
+        self._queue.put((seq, sql, tuple(params), fut))
+        return fut
+
+    def on_writer_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Block until everything submitted so far is committed."""
+
+        if self._done >= self._submitted or self.on_writer_thread():
+            return True
+        with self._cond:
+            target = self._submitted
+            return self._cond.wait_for(lambda: self._done >= target or not self._thread.is_alive(), timeout)
+
+    def stop(self, timeout: float | None = 10) -> None:
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # اتصالش پس از close_all_connections دوباره باز می‌شود، ولی دیرکرد باید دیده شود
+            logger.warning("write coalescer still running %ss after stop", timeout)
+
+    def stats(self) -> dict[str, Any]:
+        with self._stats_lock:
+            batches = max(self.batches, 1)
+            return {
+                "pending": self._submitted - self._done,
+                "batches": self.batches,
+                "statements": self.statements,
+                "failed": self.failed,
+                "avg_batch": round(self.statements / batches, 2),
+                "max_batch": self.max_batch_seen,
+                "avg_commit_ms": round(self.commit_seconds * 1000 / batches, 3),
+                "max_commit_ms": round(self.max_commit_seconds * 1000, 3),
+            }
+
+    # --- writer thread ----------------------------------------------
+    def _collect(self, first) -> tuple[list, bool]:
+        batch = [first]
+        stop = False
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _commit(self, batch: list) -> None:
+        started = time.perf_counter()
+        applied: list[Future] = []
+        failed = 0
+        try:
+            with db_pool.transaction() as con:
+                for _, sql, params, fut in batch:
+                    try:
+                        # هر دستور در savepoint خودش؛ شکست فقط اثر همان دستور را برمی‌گرداند
+                        with db_pool.transaction():
+                            con.execute(sql, params)
+                    except Exception as exc:
+                        if not con.in_transaction:
+                            # SQLite کل تراکنش را برگردانده؛ بقیهٔ دسته هم با آن شکست می‌خورد
+                            raise
+                        failed += 1
+                        fut.set_exception(exc)
+                    else:
+                        applied.append(fut)
+        except Exception as exc:
+            pending = [fut for *_, fut in batch if not fut.done()]
+            logger.exception("Coalesced commit of %s statements failed", len(pending))
+            failed += len(pending)
+            for fut in pending:
+                fut.set_exception(exc)
+        else:
+            for fut in applied:
+                fut.set_result(None)
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self.batches += 1
+            self.statements += len(batch)
+            self.failed += failed
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.commit_seconds += elapsed
+            self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+        with self._cond:
+            self._done = max(self._done, batch[-1][0])
+            self._cond.notify_all()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                first = self._queue.get()
+                if first is _STOP:
+                    break
+                batch, stop = self._collect(first)
+                self._commit(batch)
+                if stop:
+                    break
+        finally:
+            db_pool.close_connection()
+            with self._cond:
+                self._cond.notify_all()
+
+
+_coalescer: WriteCoalescer | None = None
+_lock = threading.Lock()
+
+
+def _drain_hook() -> None:
+    coalescer = _coalescer
+    if coalescer is not None:
+        coalescer.flush()
+
+
+def active() -> WriteCoalescer | None:
+    """Return the running coalescer, starting it on first use when enabled."""
+
+    global _coalescer
+    if _coalescer is not None or not DB_WRITE_COALESCE:
+        return _coalescer
+    with _lock:
+        if _coalescer is None:
+            _coalescer = WriteCoalescer()
+            db_pool.set_drain_hook(_drain_hook)
+            atexit.register(shutdown)
+    return _coalescer
+
+
+def shutdown() -> None:
+    """Commit whatever is still queued and stop the writer thread."""
+
+    global _coalescer
+    with _lock:
+        coalescer, _coalescer = _coalescer, None
+    if coalescer is None:
+        return
+    db_pool.set_drain_hook(None)
+    coalescer.stop()
+    stats = coalescer.stats()
+    if stats["statements"]:
+        logger.info("Write coalescer stopped: %s", stats)
+
+
+def stats() -> dict[str, Any] | None:
+    coalescer = _coalescer
+    return coalescer.stats() if coalescer is not None else None
+
+
+__all__ = ["WriteCoalescer", "active", "shutdown", "stats"]
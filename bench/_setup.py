@@ -0,0 +1,28 @@
+"""Point the app at a throw-away database before ``app`` is imported.
+
+Every benchmark imports this module first, so ``DB_PATH`` (and the archive
+and log files next to it) live in a temporary directory that is removed on
+exit.  Worker processes started with ``spawn`` inherit the directory of
+their parent.  The real ``data.db`` is never opened.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+if os.environ.get("BENCH_TMP_DIR"):
+    TMP_DIR = os.environ["BENCH_TMP_DIR"]
+else:
+    _tmp = tempfile.TemporaryDirectory(prefix="bench-")
+    TMP_DIR = os.environ["BENCH_TMP_DIR"] = _tmp.name
+DB_PATH = os.path.join(TMP_DIR, "bench.db")
+
+os.environ["DB_PATH"] = DB_PATH
+os.environ["ARCHIVE_DB_PATH"] = os.path.join(TMP_DIR, "bench-archive.db")
+os.environ["LOG_FILE"] = os.path.join(TMP_DIR, "logs", "bot.log")
+os.environ.setdefault("BOT_TOKEN", "0:bench")
@@ -0,0 +1,68 @@
+"""Point reads and single-row writes: connect-per-call vs the pooled connection.
+
+The connect-per-call side repeats what ``db_execute`` did before
+``app/db_pool.py``: open, query, commit and close a ``sqlite3`` connection
+on every call.  The pooled side calls today's ``db_execute``.
+
+    python bench/db_pool_bench.py [reads] [writes]
+"""
+from __future__ import annotations
+
+import sqlite3
+import sys
+import time
+
+import _setup
+
+from app import db
+from app.db_pool import transaction
+
+READS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+WRITES = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+USERS = 1000
+
+
+def connect_per_call(sql, params=(), *, fetchone=False):
+    con = sqlite3.connect(_setup.DB_PATH)
+    con.row_factory = sqlite3.Row
+    try:
+        con.execute("PRAGMA foreign_keys=OFF;")
+        cur = con.execute(sql, params)
+        con.commit()
+        if fetchone:
+            r = cur.fetchone()
+            return dict(r) if r else None
+        return None
+    finally:
+        con.close()
+
+
+def pooled(sql, params=(), *, fetchone=False):
+    return db.db_execute(sql, params, fetchone=fetchone)
+
+
+def run(label, execute) -> None:
+    t = time.perf_counter()
+    for i in range(READS):
+        execute("SELECT * FROM users WHERE user_id=?", (1 + i % USERS,), fetchone=True)
+    reads = READS / (time.perf_counter() - t)
+    t = time.perf_counter()
+    for i in range(WRITES):
+        execute("UPDATE users SET updated_at=? WHERE user_id=?", (str(i), 1 + i % USERS))
+    writes = WRITES / (time.perf_counter() - t)
+    print(f"{label:18s} {reads:9,.0f} reads/s  {writes:9,.0f} writes/s")
+
+
+def main() -> None:
+    db.init_db()
+    with transaction() as con:
+        con.executemany(
+            "INSERT INTO users(user_id, username, first_name, wallet_balance, created_at) VALUES(?,?,?,0,?)",
+            [(u, f"u{u}", "f", "2026-01-01") for u in range(1, USERS + 1)],
+        )
+    run("connect-per-call", connect_per_call)
+    run("pooled", pooled)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Expire a backlog of overdue orders with ``expire_orders_and_refund``.
+
+Half of the orders hold a wallet reservation, so the run also measures the
+refunds.  After the run the balances, the refund rows and the reserved
+amounts left on the expired orders are printed, so a faster path that
+loses a refund shows up at once.  Run it on the parent of a change for the
+"before" figure.
+
+    python bench/expire_bench.py [orders]
+"""
+from __future__ import annotations
+
+import sys
+import time
+
+import _setup  # noqa: F401
+
+from app import db
+from app.db_pool import get_connection, transaction
+
+ORDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+USERS = 2000
+RESERVED = 50
+
+
+def main() -> None:
+    db.init_db()
+    with transaction() as con:
+        con.executemany(
+            "INSERT INTO users(user_id, username, first_name, wallet_balance, created_at) VALUES(?,?,?,0,?)",
+            [(u, f"u{u}", "f", "2026-01-01") for u in range(1, USERS + 1)],
+        )
+        con.executemany(
+            """
+            INSERT INTO orders(user_id, username, plan_title, status, amount_total, wallet_reserved_amount,
+                await_deadline, created_at)
+            VALUES(?,?,?,?,?,?,?,?)
+            """,
+            [
+                (1 + i % USERS, "u", "p", "AWAITING_PAYMENT", 100, RESERVED if i % 2 else 0,
+                 "2020-01-01T00:00:00", "2026-01-01")
+                for i in range(ORDERS)
+            ],
+        )
+
+    t = time.perf_counter()
+    rows = db.expire_orders_and_refund()
+    elapsed = time.perf_counter() - t
+
+    con = get_connection()
+    balance = con.execute("SELECT SUM(wallet_balance) FROM users").fetchone()[0]
+    reserved, expired = con.execute(
+        "SELECT SUM(wallet_reserved_amount), COUNT(*) FROM orders WHERE status='EXPIRED'"
+    ).fetchone()
+    refunds = con.execute("SELECT COUNT(*) FROM wallet_tx WHERE type='REFUND'").fetchone()[0]
+    print(f"{len(rows)} orders expired in {elapsed:.2f}s")
+    print(
+        f"balances={balance} (expected {ORDERS // 2 * RESERVED}) refund rows={refunds} "
+        f"reserved left={reserved} expired={expired}"
+    )
+
+
+if __name__ == "__main__":
+    main()
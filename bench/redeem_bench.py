@@ -0,0 +1,126 @@
+"""Concurrent coupon and discount redemptions against one usage limit.
+
+Every user redeems the same coupon, then applies the same discount code to
+their own order, from ``--threads`` threads in each of ``--procs``
+processes.  Both codes allow ``--limit`` uses; the script prints how many
+redemptions succeeded next to ``used_count``, the redemption rows and the
+wallet credits / discounted orders, which must all equal the limit.  It
+then times single-threaded successful and rejected coupon attempts.
+
+    python bench/redeem_bench.py [--users 4000] [--limit 1000] [--threads 16] [--procs 1]
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+import _setup  # noqa: F401
+
+from app import db
+from app.db_pool import get_connection, transaction
+
+
+def _work(kind: str, items: list[tuple[int, int]], out) -> None:
+    started = time.time()
+    ok = errors = 0
+    for user_id, order_id in items:
+        try:
+            if kind == "coupon":
+                result = db.redeem_coupon(user_id, "hot")
+            else:
+                result = db.apply_discount_to_order(order_id, user_id, "hotd")
+            ok += bool(result[0])
+        except Exception:
+            errors += 1
+    out.put((ok, errors, started, time.time()))
+
+
+def _run_workers(kind: str, items: list[tuple[int, int]], threads: int, procs: int) -> tuple[int, int, float]:
+    chunks = [items[i :: threads * procs] for i in range(threads * procs)]
+    if procs == 1:
+        out = queue.Queue()
+        workers = [threading.Thread(target=_work, args=(kind, chunk, out)) for chunk in chunks]
+    else:
+        # هر پروسه اتصال خودش را باز می‌کند؛ fork اتصال والد را شریک می‌کرد
+        ctx = mp.get_context("spawn")
+        out = ctx.Queue()
+        workers = [ctx.Process(target=_work_threads, args=(kind, chunks[i::procs], out)) for i in range(procs)]
+    for worker in workers:
+        worker.start()
+    results = [out.get() for _ in chunks]
+    for worker in workers:
+        worker.join()
+    # زمان از شروع اولین تا پایان آخرین worker؛ import پروسه‌ها حساب نمی‌شود
+    elapsed = max(r[3] for r in results) - min(r[2] for r in results)
+    return sum(r[0] for r in results), sum(r[1] for r in results), elapsed
+
+
+def _work_threads(kind: str, chunks: list[list[tuple[int, int]]], out) -> None:
+    threads = [threading.Thread(target=_work, args=(kind, chunk, out)) for chunk in chunks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _seed_users(first: int, last: int) -> None:
+    with transaction() as con:
+        con.executemany(
+            "INSERT INTO users(user_id, username, first_name, wallet_balance, created_at) VALUES(?,?,?,0,?)",
+            [(u, f"u{u}", "x", "2026-01-01") for u in range(first, last + 1)],
+        )
+
+
+def stress(users: int, limit: int, threads: int, procs: int) -> None:
+    _seed_users(1, users)
+    db.create_coupon("HOT", 10, limit)
+    db.create_discount("HOTD", 10, limit, applies_all=True)
+    orders = [db.create_order(db.get_user(u), "t", 1000, "IRR", "cat", "product:1") for u in range(1, users + 1)]
+    items = list(zip(range(1, users + 1), orders))
+    con = get_connection()
+    for kind in ("coupon", "discount"):
+        ok, errors, elapsed = _run_workers(kind, items, threads, procs)
+        if kind == "coupon":
+            used = con.execute("SELECT used_count FROM coupons WHERE code='HOT'").fetchone()[0]
+            rows = con.execute("SELECT COUNT(*) FROM coupon_redemptions").fetchone()[0]
+            effects = con.execute("SELECT COUNT(*) FROM wallet_tx WHERE note='COUPON:HOT'").fetchone()[0]
+        else:
+            used = con.execute("SELECT used_count FROM discounts WHERE code='HOTD'").fetchone()[0]
+            rows = con.execute("SELECT COUNT(*) FROM discount_redemptions").fetchone()[0]
+            effects = con.execute("SELECT COUNT(*) FROM orders WHERE discount_code='HOTD'").fetchone()[0]
+        print(
+            f"{kind:8s} limit={limit} ok={ok} used_count={used} rows={rows} effects={effects} "
+            f"errors={errors} {elapsed:.2f}s ({users / elapsed:,.0f} attempts/s)"
+        )
+
+
+def single_thread(attempts: int, first_user: int) -> None:
+    _seed_users(first_user, first_user + attempts - 1)
+    db.create_coupon("OPEN", 10, 0)
+    db.create_coupon("FULL", 10, 1)
+    db.redeem_coupon(first_user, "full")
+    for code, label in (("open", "successful"), ("full", "rejected")):
+        t = time.perf_counter()
+        for user_id in range(first_user, first_user + attempts):
+            db.redeem_coupon(user_id, code)
+        per_attempt = (time.perf_counter() - t) / attempts * 1e6
+        print(f"single thread, {label:10s} {per_attempt:5.0f}us per attempt")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=4000)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--procs", type=int, default=1)
+    args = parser.parse_args()
+    db.init_db()
+    stress(args.users, args.limit, max(args.threads, 1), max(args.procs, 1))
+    single_thread(3000, args.users + 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Memory and time of listing orders: ``SELECT *`` dicts vs narrow row tuples.
+
+Seeds ``orders`` and reads every row five ways: ``db_execute`` with
+``SELECT *`` and with the ``ORDER_LIST_COLUMNS`` projection (both build
+dicts, the old list path), ``db_rows`` with both queries, and ``db_iter``
+streamed.  Memory is measured with ``tracemalloc``; the timings are then
+repeated without tracing, which slows allocation down.
+
+    python bench/rows_bench.py [orders]
+"""
+from __future__ import annotations
+
+import gc
+import sys
+import time
+import tracemalloc
+
+import _setup  # noqa: F401
+
+from app import db
+from app.db_pool import transaction
+
+ORDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+def _seed() -> None:
+    with transaction() as con:
+        con.executemany(
+            """
+            INSERT INTO orders(user_id, username, first_name, plan_title, service_code, customer_email, status,
+                amount_total, price, created_at, notes)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            [
+                (i % 5000, f"user{i}", f"First {i}", f"plan {i}", "GPT_PLUS", f"u{i}@example.com", "COMPLETED",
+                 1000, 1000, f"2025-01-{1 + i % 28:02d}T00:00:00", "note " * 5)
+                for i in range(ORDERS)
+            ],
+        )
+
+
+def _measure(label: str, fn) -> None:
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print(f"{label:34s} retained {retained / 1e6:6.1f} MB  peak {peak / 1e6:6.1f} MB")
+
+
+def _time(label: str, fn) -> None:
+    gc.collect()
+    t = time.perf_counter()
+    fn()
+    print(f"{label:34s} {(time.perf_counter() - t) * 1000:7.0f} ms")
+
+
+def main() -> None:
+    db.init_db()
+    _seed()
+    narrow = f"SELECT {db._select('orders', db.ORDER_LIST_COLUMNS)} FROM orders"
+    cases = [
+        ("db_execute SELECT * -> dicts", lambda: db.db_execute("SELECT * FROM orders", fetchall=True)),
+        ("db_execute narrow -> dicts", lambda: db.db_execute(narrow, fetchall=True)),
+        ("db_rows SELECT * -> rows", lambda: db.db_rows("SELECT * FROM orders")),
+        ("db_rows narrow -> rows", lambda: db.db_rows(narrow)),
+        ("db_iter narrow, streamed", lambda: sum(row.amount_total for row in db.db_iter(narrow))),
+    ]
+    print(f"{ORDERS} orders")
+    for label, fn in cases:
+        _measure(label, fn)
+    for label, fn in cases:
+        _time(label, fn)
+
+
+if __name__ == "__main__":
+    main()
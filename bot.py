@@ -12,7 +12,6 @@ from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardButton, InlineKeyboardMarkup
@@ -22,6 +21,7 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from app.db import ensure_order_id_floor
+from app.fsm_storage import create_storage
 from app.logging_utils import setup_logging
 
 # ------------------ Config & Globals ------------------
@@ -42,7 +42,7 @@ SLA_HOURS_MAX = int(os.getenv("SLA_HOURS_MAX", "4"))
 setup_logging()
 
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=create_storage())
 rt = Router()
 dp.include_router(rt)
 
@@ -451,7 +451,10 @@ async def on_admin_send_message(m: Message, state: FSMContext):
 async def main():
     init_db()
     logging.info("Starting bot...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await dp.storage.close()
 
 if __name__ == "__main__":
     try: